@@ -8,7 +8,10 @@
 # This program is provided as is without any guarantees or warranty. In no event shall the authors be liable for any damages or losses arising from the use of this program.
 # This program does not guarantee the correctness of the comparison results. Please check the results manually.
 
+import csv
+import heapq
 import os
+import pickle
 
 class Similarity:
     def __init__(self, student_id_a, student_id_b, mse, ssim, psnr):
@@ -18,11 +21,223 @@ class Similarity:
         self.ssim = ssim
         self.psnr = psnr
 
+# Columns of the similarity stores, in the order of the flattened similarity values
+image_columns = ['mse_min', 'mse_max', 'mse_avg', 'ssim_min', 'ssim_max', 'ssim_avg', 'psnr_min', 'psnr_max', 'psnr_avg']
+similarity_columns = ['similarity_min', 'similarity_max', 'similarity_avg']
+
+def image_score(similarity):
+    # Maximum SSIM of the image pairs
+    return similarity[1][0][1]
+
+def similarity_score(similarity):
+    # Maximum similarity of the code or text file pairs
+    return similarity[0][0][1]
+
+def flatten_similarity(similarity):
+    # ([(min, max, avg)], ...) to [min, max, avg, ...]
+    return [value for values in similarity for value in values[0]]
+
+class SimilarityStore:
+    '''
+    Append-only columnar store of the pair similarities.
+    The ids are interned to integers and every pair is stored once in chunks of a NumPy structured array.
+    A symmetric row (a, b) is a match of a and of b, the other rows (student and reference) only of a.
+    '''
+    def __init__(self, columns, chunk_size=1 << 16):
+        # NumPy is only loaded once a store is created, importing this module for its paths stays light
+        import numpy as np
+        self.columns = list(columns)
+        self.dtype = np.dtype([('a', '<i4'), ('b', '<i4'), ('symmetric', '?')] + [(c, '<f8') for c in self.columns])
+        self.chunk_size = chunk_size
+        self.ids = []           # Interned ids, the rows refer to their index
+        self._id_index = {}     # Key: id, Value: index in ids
+        self._chunks = []       # Full chunks, or compacted rows
+        self._chunk = np.empty(chunk_size, dtype=self.dtype)
+        self._size = 0          # Rows used in _chunk
+
+    def __len__(self):
+        return sum(len(chunk) for chunk in self._chunks) + self._size
+
+    def __getstate__(self):
+        # Only the used rows are pickled
+        state = self.__dict__.copy()
+        state['_chunks'] = [self.table()]
+        state['_chunk'] = None
+        state['_size'] = 0
+        return state
+
+    def __setstate__(self, state):
+        import numpy as np
+        self.__dict__.update(state)
+        self._chunk = np.empty(self.chunk_size, dtype=self.dtype)
+
+    def intern(self, entity_id):
+        index = self._id_index.get(entity_id)
+        if index is None:
+            index = self._id_index[entity_id] = len(self.ids)
+            self.ids.append(entity_id)
+        return index
+
+    def append(self, id_a, id_b, values, symmetric=True):
+        import numpy as np
+        if self._size == len(self._chunk):
+            self._chunks.append(self._chunk)
+            self._chunk = np.empty(self.chunk_size, dtype=self.dtype)
+            self._size = 0
+        self._chunk[self._size] = (self.intern(id_a), self.intern(id_b), symmetric, *values)
+        self._size += 1
+
+    def table(self):
+        # Every row as one structured array
+        import numpy as np
+        return np.concatenate(self._chunks + [self._chunk[:self._size]])
+
+    def _replace(self, table):
+        import numpy as np
+        self._chunks = [table] if len(table) > 0 else []
+        self._chunk = np.empty(self.chunk_size, dtype=self.dtype)
+        self._size = 0
+
+    def remove(self, entity_ids):
+        # Remove every row from or to the ids, the other rows are compacted
+        import numpy as np
+        removed = np.array([self._id_index[e] for e in entity_ids if e in self._id_index], dtype=np.int32)
+        table = self.table()
+        self._replace(table[~(np.isin(table['a'], removed) | np.isin(table['b'], removed))])
+
+    def lookup(self, entity_id):
+        # (other id, {column: value}) of every match of the id, in both directions of the symmetric rows
+        index = self._id_index.get(entity_id)
+        if index is None:
+            return []
+        table = self.table()
+        rows = table[(table['a'] == index) | (table['symmetric'] & (table['b'] == index))]
+        return [(self.ids[row['b'] if row['a'] == index else row['a']], {c: float(row[c]) for c in self.columns}) for row in rows]
+
+    def top(self, k, threshold, score_column):
+        '''
+        Select the k best matches of each id and the matches scoring at least threshold, best first.
+        Returns:
+            SimilarityStore of the selected rows, each row (a, b) is a match of a
+        '''
+        import numpy as np
+        table = self.table()
+        symmetric = np.flatnonzero(table['symmetric'])
+        rows = np.concatenate([np.arange(len(table)), symmetric])
+        owners = np.concatenate([table['a'], table['b'][symmetric]])
+        others = np.concatenate([table['b'], table['a'][symmetric]])
+        scores = table[score_column][rows]
+
+        # Group by owner, best score first then smaller id like TopMatches, and rank the matches of each owner
+        id_order = np.argsort(np.argsort(np.array(self.ids, dtype=object)))
+        order = np.lexsort((id_order[others], -scores, owners))
+        grouped = owners[order]
+        ranks = np.arange(len(order)) - np.searchsorted(grouped, grouped, side='left')
+        order = order[(ranks < k) | (scores[order] >= threshold)]
+
+        selected = SimilarityStore(self.columns, self.chunk_size)
+        selected.ids = list(self.ids)
+        selected._id_index = dict(self._id_index)
+        result = table[rows[order]]
+        result['a'] = owners[order]
+        result['b'] = others[order]
+        result['symmetric'] = False
+        selected._replace(result)
+        return selected
+
+    def to_frame(self):
+        # pandas DataFrame of the rows with the ids restored, each pair once
+        import numpy as np
+        import pandas as pd
+        table = self.table()
+        ids = np.array(self.ids, dtype=object)
+        frame = pd.DataFrame({'student_id_a': ids[table['a']], 'student_id_b': ids[table['b']]})
+        for column in self.columns:
+            frame[column] = table[column]
+        return frame
+
+    def export(self, path, format='csv'):
+        '''
+        Write the rows to path + '.csv' or path + '.parquet', parquet requires pyarrow.
+        Returns:
+            Path of the written file
+        '''
+        if format == 'parquet':
+            try:
+                import pyarrow
+            except ImportError:
+                raise ImportError('pyarrow is required for the parquet export, install it with pip install pyarrow') from None
+            self.to_frame().to_parquet(path + '.parquet', index=False)
+            return path + '.parquet'
+        # Written without pandas, which is only needed for parquet
+        table = self.table()
+        with open(path + '.csv', 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f, lineterminator='\n')
+            writer.writerow(['student_id_a', 'student_id_b'] + self.columns)
+            writer.writerows(zip([self.ids[i] for i in table['a'].tolist()], [self.ids[i] for i in table['b'].tolist()],
+                                 *(table[column].tolist() for column in self.columns)))
+        return path + '.csv'
+
+class _Descending:
+    # Reverses the order of an id in the heaps of TopMatches
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return self.value > other.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+class TopMatches:
+    '''
+    Most similar matches of each student kept in bounded heaps while the results stream in.
+    Matches above the threshold are always kept, even when they leave the heap.
+    '''
+    def __init__(self, k, threshold, score):
+        self.k = k
+        self.threshold = threshold
+        self.score = score
+        self.heaps = {}     # Key: student_id, Value: min-heap of (score, _Descending(student_id_b), (student_id_b, *similarity))
+        self.above = {}     # Key: student_id, Value: matches above the threshold pushed out of the heap
+
+    def push(self, student_id_a, match):
+        # Ties keep the smaller id whatever the arrival order, the matches themselves are never compared
+        item = (self.score(match[1:]), _Descending(match[0]), match)
+        heap = self.heaps.setdefault(student_id_a, [])
+        if len(heap) < self.k:
+            heapq.heappush(heap, item)
+            return
+        dropped = heapq.heappushpop(heap, item)
+        if dropped[0] >= self.threshold:
+            self.above.setdefault(student_id_a, []).append(dropped)
+
+    def connections(self, columns):
+        # SimilarityStore of the matches of each student from the most similar, each row (a, b) is a match of a
+        store = SimilarityStore(columns)
+        for student_id_a, heap in self.heaps.items():
+            for _, _, match in sorted(heap + self.above.get(student_id_a, []), reverse=True):
+                store.append(student_id_a, match[0], flatten_similarity(match[1:]), symmetric=False)
+        return store
+
 class DB:
     def __init__(self):
         self.students = {}
         self.references = {}
-        self.connections = {}   # Key: student_id, Value: reference_id and similarity
+        self.connections = SimilarityStore(image_columns)   # Every compared pair once with its similarity
+        self.code_connections = SimilarityStore(similarity_columns)
+        self.text_connections = SimilarityStore(similarity_columns)
+        self.feature_connections = SimilarityStore(similarity_columns)  # Images matched by ORB keypoints, see --matcher
+        # Kept between the runs of the incremental mode
+        self.file_hashes = {}   # Key: student_id or reference_id, Value: {path: (size, mtime, sha256)}
+        self.manifest = {}      # Key: path, Value: tools.extract.scan.FileEntry of every parsed file
+        self.fingerprints = {'image': {}, 'code': {}, 'text': {}, 'feature': {}}   # Key: path, Value: fingerprint of the file
+        self.occurrences = {}   # Key: extracted image path, Value: [(doc_path, page, xref)] where the image occurs
+        self.boilerplate = {}   # Key: 'image' or 'code', Value: boilerplate image names or code fingerprints of the last run
+        self.settings = None
+        self.top_matches = None # Key: kind, Value: TopMatches replacing the connections, see keep_top
     
     def add_student(self, student):
         self.students[student.id] = student
@@ -30,17 +245,46 @@ class DB:
     def add_reference(self, reference):
         self.references[reference.id] = reference
 
-    def add_connection(self, student_id_a, student_id_b, mse, ssim, psnr, reference=False):
+    def keep_top(self, k, threshold):
+        # Keep only the k most similar matches of each student and the matches above the threshold
+        # Maximum SSIM for images, maximum similarity for codes, texts and image features
+        self.top_matches = {'image': TopMatches(k, threshold, image_score),
+                            'code': TopMatches(k, threshold, similarity_score),
+                            'text': TopMatches(k, threshold, similarity_score),
+                            'feature': TopMatches(k, threshold, similarity_score)}
+
+    def add_connection(self, student_id_a, student_id_b, *similarity, reference=False, kind='image'):
         # If reference is True, the connection is between a student and a reference
-        if student_id_a not in self.connections:
-            self.connections[student_id_a] = []
-        self.connections[student_id_a].append((student_id_b, mse, ssim, psnr))
-
-        if not reference:
-            if student_id_b not in self.connections:
-                self.connections[student_id_b] = []
-            self.connections[student_id_b].append((student_id_a, mse, ssim, psnr))
+        # similarity is (mse, ssim, psnr) for images and (similarity,) for codes, texts and image features
+        if self.top_matches is not None:
+            self.top_matches[kind].push(student_id_a, (student_id_b, *similarity))
+            if not reference:
+                self.top_matches[kind].push(student_id_b, (student_id_a, *similarity))
+            return
+
+        connections = {'image': self.connections, 'code': self.code_connections, 'text': self.text_connections, 'feature': self.feature_connections}[kind]
+        connections.append(student_id_a, student_id_b, flatten_similarity(similarity), symmetric=not reference)
     
+    def remove_connections(self, student_ids):
+        # Remove every connection from or to the students
+        for connections in (self.connections, self.code_connections, self.text_connections, self.feature_connections):
+            connections.remove(student_ids)
+
+    def clear_connections(self, kind):
+        # Remove every connection of one kind, before all of its pairs are compared again
+        columns = image_columns if kind == 'image' else similarity_columns
+        attribute = {'image': 'connections', 'code': 'code_connections', 'text': 'text_connections', 'feature': 'feature_connections'}[kind]
+        setattr(self, attribute, SimilarityStore(columns))
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            pickle.dump(self, f)
+
+    @staticmethod
+    def load(path):
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
     def get_student(self, student_id):
         return self.students[student_id]
     
@@ -48,10 +292,26 @@ class DB:
         return self.references[reference_id]
     
     def get_connection(self, student_id):
-        return self.connections[student_id]
+        return self.connections.lookup(student_id)
     
-    def get_connections(self):
-        return self.connections
+    def get_connections(self, kind='image', top_k=None, threshold=float('inf')):
+        # Every connection, or the top_k most similar matches of each student and the matches above the threshold
+        columns = image_columns if kind == 'image' else similarity_columns
+        if self.top_matches is not None:
+            return self.top_matches[kind].connections(columns)
+        connections = {'image': self.connections, 'code': self.code_connections, 'text': self.text_connections, 'feature': self.feature_connections}[kind]
+        if top_k is None:
+            return connections
+        return connections.top(top_k, threshold, 'ssim_max' if kind == 'image' else 'similarity_max')
+
+    def get_matches(self, student_id, kind='image', top_k=None, threshold=float('inf')):
+        # (other id, {column: value}) of the matches of one student, best first, like get_connections for one student
+        connections = {'image': self.connections, 'code': self.code_connections, 'text': self.text_connections, 'feature': self.feature_connections}[kind]
+        score = 'ssim_max' if kind == 'image' else 'similarity_max'
+        matches = sorted(connections.lookup(student_id), key=lambda match: (-match[1][score], match[0]))
+        if top_k is None:
+            return matches
+        return [match for i, match in enumerate(matches) if i < top_k or match[1][score] >= threshold]
     
     def get_documents(self):
         sub_doc_names = []
@@ -111,13 +371,15 @@ project_root = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
 
 # buffer_dir is a directory where temporary files are stored
 # it will be deleted after the program is finished
-# If buffer_dir does not exist, create it
-os.makedirs(os.path.join(project_root, 'buffer'), exist_ok=True)
+# It is created by the extraction, importing this module has no side effect
 buffer_dir = os.path.join(project_root, 'buffer')
 
 # Supported file types
 supported_doc_types = ['docx', 'pdf']
 supported_code_types = ['c', 'cpp', 'h', 'hpp', 'py', 'java', 'mat', 'm', 'cs', 'asm', 'js', 'v', 'vhd', 'vhdl', 'r']
+# Pygments lexer of each code type, mat is a binary MATLAB workspace and is not tokenized
+code_languages = {'c': 'c', 'cpp': 'cpp', 'h': 'c', 'hpp': 'cpp', 'py': 'python', 'java': 'java', 'mat': None, 'm': 'matlab',
+                  'cs': 'csharp', 'asm': 'nasm', 'js': 'javascript', 'v': 'verilog', 'vhd': 'vhdl', 'vhdl': 'vhdl', 'r': 'r'}
 supported_etc_types = ['txt', 'csv', 'json', 'xml', 'html', 'css', 'yml', 'yaml']
 supported_types = supported_doc_types + supported_code_types + supported_etc_types
 
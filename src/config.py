@@ -11,17 +11,56 @@
 import argparse
 import warnings
 
+from tools import instrument
+
 shape_threshold = 5
 error_threshold = 0.01
 warnings.filterwarnings("ignore")
 
-def get_config():
+def get_parser():
     parser = argparse.ArgumentParser(description='')
     parser.add_argument('--input-dir', dest='input_dir', type=str, default='submission', help='Directory containing submissions')
     parser.add_argument('--reference-dir', dest='reference_dir', type=str, default='reference', help='Directory containing reference images')
     parser.add_argument('--output-dir', dest='output_dir', type=str, default='out', help='Directory to save the result')
     parser.add_argument('--check_filetype', dest='check_filetype', type=str, default='pdf,cpp', help='Filetype to check')
     parser.add_argument('--p', dest='p', type=int, default=16, help='Number of processes')
+    parser.add_argument('--scan-threads', dest='scan_threads', type=int, default=16, help='Number of threads listing, stating and hashing the input files')
+    parser.add_argument('--tile-size', dest='tile_size', type=int, default=32, help='Number of students per side of a tile of the comparison matrix, images are loaded once per tile')
     parser.add_argument('--shape-threshold', dest='shape_threshold', type=int, default=5, help='Threshold for shape comparison')
     parser.add_argument('--error-threshold', dest='error_threshold', type=float, default=0.01, help='Threshold for error comparison')
-    return parser.parse_args()
+    parser.add_argument('--pyramid', dest='pyramid', action='store_true', help='Compare the images from 32x32 thumbnails up to full resolution, rejecting the pairs beyond --shape-threshold or --error-threshold')
+    parser.add_argument('--hash-distance', dest='hash_distance', type=int, default=10, help='Maximum Hamming distance between image fingerprints to run a full comparison')
+    parser.add_argument('--no-prefilter', dest='prefilter', action='store_false', help='Compare every image pair without the fingerprint prefilter')
+    parser.add_argument('--matcher', dest='matcher', type=str, default='ssim', choices=['ssim', 'orb'], help='Compare the images by SSIM, or by ORB keypoints to find rotated, flipped, scaled and cropped copies')
+    parser.add_argument('--orb-keypoints', dest='orb_keypoints', type=int, default=200, help='Maximum number of ORB keypoints per image and orientation')
+    parser.add_argument('--orb-min-inliers', dest='orb_min_inliers', type=int, default=12, help='Minimum number of geometrically consistent keypoint matches of an ORB match')
+    parser.add_argument('--cache-dir', dest='cache_dir', type=str, default=None, help='Directory to cache the extracted images across runs')
+    parser.add_argument('--cache-size', dest='cache_size', type=int, default=1024, help='Maximum size of the extraction cache in MB')
+    parser.add_argument('--dummy-ratio', dest='dummy_ratio', type=float, default=0.95, help='Ratio of transparent, white or black pixels above which an image is ignored')
+    parser.add_argument('--dummy-thumbnail', dest='dummy_thumbnail', type=int, default=256, help='Size of the thumbnail used to detect dummy images, 0 uses the full image')
+    parser.add_argument('--boilerplate-ratio', dest='boilerplate_ratio', type=float, default=0.5, help='Ignore images found in more than this ratio of the submissions, like templates and logos')
+    parser.add_argument('--compare-size', dest='compare_size', type=int, default=0, help='Resize the images to compare-size x compare-size before comparison, 0 keeps the original size')
+    parser.add_argument('--store-cache', dest='store_cache', type=int, default=256, help='Size of the in-process cache of decoded images in MB')
+    parser.add_argument('--code-k', dest='code_k', type=int, default=25, help='Size of the k-grams of the code fingerprints, shorter matches are ignored')
+    parser.add_argument('--code-window', dest='code_window', type=int, default=6, help='Winnowing window of the code fingerprints')
+    parser.add_argument('--code-max-df', dest='code_max_df', type=float, default=0.5, help='Ignore code fingerprints shared by more than this ratio of the students and references')
+    parser.add_argument('--text-shingle', dest='text_shingle', type=int, default=5, help='Number of words per shingle of the text signatures')
+    parser.add_argument('--text-perm', dest='text_perm', type=int, default=128, help='Number of MinHash permutations of the text signatures')
+    parser.add_argument('--text-bands', dest='text_bands', type=int, default=32, help='Number of LSH bands, more bands find less similar texts')
+    parser.add_argument('--time-budget', dest='time_budget', type=float, default=None, help='Seconds from the start of the comparison after which no new image pair is started, the results found so far are reported')
+    parser.add_argument('--top-k', dest='top_k', type=int, default=10, help='Number of most similar matches reported per student')
+    parser.add_argument('--report-threshold', dest='report_threshold', type=float, default=0.9, help='Matches with a maximum SSIM or similarity above this are always reported')
+    parser.add_argument('--group-threshold', dest='group_threshold', type=float, default=None, help='Pairs scoring at least this connect the students of a group in groups.csv, --report-threshold if None. Below --report-threshold, only the top matches are grouped unless --full-matrix is set')
+    parser.add_argument('--full-matrix', dest='full_matrix', action='store_true', help='Report every compared pair instead of the top matches')
+    parser.add_argument('--result-format', dest='result_format', type=str, default='csv', choices=['csv', 'parquet'], help='Format of the result files, parquet requires pyarrow')
+    parser.add_argument('--trace', dest='trace', type=str, default=None, help='Save the timers and counters of the stages as JSON to this path')
+    parser.add_argument('--profile', dest='profile', type=str, default=None, choices=instrument.stages, help='Profile this stage, run with --p 1 to include the work of the workers')
+    parser.add_argument('--profiler', dest='profiler', type=str, default='cprofile', choices=['cprofile', 'pyinstrument'], help='Profiler of --profile, pyinstrument must be installed')
+    parser.add_argument('--profile-output', dest='profile_output', type=str, default=None, help='Path of the profile, profile_<stage>.prof or .html in the output directory if None')
+    parser.add_argument('--reference-index', dest='reference_index', type=str, default=None, help='Directory of the reference index, the references are looked up in it instead of read from --reference-dir')
+    parser.add_argument('--build-reference-index', dest='build_reference_index', action='store_true', help='Build the reference index of --reference-dir into --reference-index and exit')
+    parser.add_argument('--incremental', dest='incremental', action='store_true', help='Keep the results in the output directory and only compare new or changed submissions, every image or code pair is compared again when the boilerplate changes')
+    return parser
+
+def get_config():
+    return get_parser().parse_args()
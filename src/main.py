@@ -17,30 +17,27 @@
 # This program is provided as is without any guarantees or warranty. In no event shall the authors be liable for any damages or losses arising from the use of this program.
 # This program does not guarantee the correctness of the comparison results. Please check the results manually.
 
-import numpy as np
-import pandas as pd
-
-from multiprocessing import Pool
-from functools import partial
-from parmap import parmap
-from tqdm import tqdm
-
-import glob
+import importlib.util
+import shutil
 import sys
+import tempfile
 import os
+import time
 # add parent directory to sys.path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-import common
+# numpy, pandas, fitz, PIL, skimage and copydetect are imported where their file type is compared,
+# so --help and the code or text only runs do not load them
 import config
-from tools.compare.image import extract_image, compare_image, compare_image_wrapper, compare_image_wrapper_ref
-
-args = config.get_config()
-database = common.DB()
+from tools.extract.cache import ExtractionCache
+from tools.extract.scan import extension_table, scan_tree, hash_files
+from tools import instrument
+from tools.schedule import upper_tiles, cross_tiles, group_tiles, cost_chunks, imap_chunks
 
-def parse_filenames(directory, check_doc_types, check_code_types, check_etc_types, database, is_reference=False):
+def parse_filenames(directory, check_doc_types, check_code_types, check_etc_types, database, is_reference=False, threads=16):
     """
     Parse filenames in the directory and add them to the database.
+    The tree is scanned once, the size, mtime and later the hash of each file are kept in database.manifest.
     
     Args:
         directory (str): Directory path to scan for files
@@ -49,41 +46,201 @@ def parse_filenames(directory, check_doc_types, check_code_types, check_etc_type
         check_etc_types (list): List of other file extensions to check
         database (common.DB): Database to store the parsed files
         is_reference (bool): Whether parsing reference files or submissions
+        threads (int): Number of threads scanning the directories
         
     Returns:
         int: Number of files parsed
     """
-    file_count = 0
-    
-    for root, dirs, files in os.walk(directory):
-        if len(files) > 0:
-            file_count += len(files)
-            # Path name as student_id or reference_id
-            entity_id = os.path.basename(root)
-            
-            if is_reference:
-                entity = common.Reference()
-            else:
-                entity = common.Student()
-                
-            entity.set_id(entity_id)
-            
-            for f in files:
-                if f.endswith(tuple(check_doc_types)):
-                    entity.add_doc_dir(os.path.join(root, f))
-                elif f.endswith(tuple(check_code_types)):
-                    entity.add_code_dir(os.path.join(root, f))
-                elif f.endswith(tuple(check_etc_types)):
-                    entity.add_etc_dir(os.path.join(root, f))
-                    
-            if is_reference:
-                database.add_reference(entity)
-            else:
-                database.add_student(entity)
+    import common
+    table = extension_table(check_doc_types, check_code_types, check_etc_types)
+    manifest, file_count = scan_tree(directory, table, threads)
+    database.manifest.update(manifest)
+
+    # Path name as student_id or reference_id, every directory holding checked files is an entity
+    entities = {}
+    for path, entry in manifest.items():
+        entity = entities.get(entry.entity_id)
+        if entity is None:
+            entity = entities[entry.entity_id] = common.Reference() if is_reference else common.Student()
+            entity.set_id(entry.entity_id)
+        {'doc': entity.add_doc_dir, 'code': entity.add_code_dir, 'etc': entity.add_etc_dir}[entry.kind](path)
+
+    for entity in entities.values():
+        if is_reference:
+            database.add_reference(entity)
+        else:
+            database.add_student(entity)
                 
     return file_count
 
-def compare_files(database, check_doc_types, check_code_types, check_etc_types, args):
+def load_state(database, state_path, settings, threads=16):
+    """
+    Restore the results of the previous run and find the students and references to compare again.
+    
+    Args:
+        database (common.DB): Database of the current run, filled by parse_filenames
+        state_path (str): Path of the database saved by the previous run
+        settings (dict): Arguments that change the results, every pair is compared again if they differ
+        threads (int): Number of threads hashing the files
+        
+    Returns:
+        set: Ids of the new or changed students and references, None if every pair must be compared
+    """
+    import common
+    entities = {s.id: s for s in database.students.values()}
+    entities.update({'ref_' + r.id: r for r in database.references.values()})
+    previous = common.DB.load(state_path) if os.path.exists(state_path) else None
+
+    # Hash the files of the manifest, unchanged size and mtime reuse the previous hash
+    known = {p: h for hashes in previous.file_hashes.values() for p, h in hashes.items()} if previous is not None else {}
+    paths = [p for entity in entities.values() for p in entity.doc_names + entity.code_names + entity.etc_names]
+    manifest = hash_files(database.manifest, paths, known, threads)
+    for entity_id, entity in entities.items():
+        database.file_hashes[entity_id] = {p: (manifest[p].size, manifest[p].mtime_ns, manifest[p].sha256)
+                                           for p in entity.doc_names + entity.code_names + entity.etc_names}
+    database.settings = settings
+
+    if previous is None or previous.settings != settings:
+        changed = None
+        stale = set(entities) | (set(previous.file_hashes) if previous is not None else set())
+    else:
+        changed = {e for e, hashes in database.file_hashes.items()
+                   if {p: h[2] for p, h in hashes.items()} != {p: h[2] for p, h in previous.file_hashes.get(e, {}).items()}}
+        removed = set(previous.file_hashes) - set(entities)
+        stale = changed | removed
+
+        # Keep the results and fingerprints of the unchanged students and references
+        database.connections = previous.connections
+        database.code_connections = previous.code_connections
+        database.text_connections = previous.text_connections
+        database.feature_connections = previous.feature_connections
+        database.boilerplate = getattr(previous, 'boilerplate', {})
+        database.remove_connections(stale)
+        stale_paths = {p for e in stale for p in previous.file_hashes.get(e, {})}
+        stale_dirs = tuple(os.path.join(common.buffer_dir, e) + os.sep for e in stale)
+        database.fingerprints = {kind: {p: f for p, f in fingerprints.items() if p not in stale_paths and not p.startswith(stale_dirs)}
+                                 for kind, fingerprints in previous.fingerprints.items()}
+        database.occurrences = {p: o for p, o in previous.occurrences.items() if not p.startswith(stale_dirs)}
+
+    # Images of the stale students and references are extracted again
+    for entity_id in stale:
+        shutil.rmtree(os.path.join(common.buffer_dir, entity_id), ignore_errors=True)
+    return changed
+
+def build_reference_index(check_doc_types, check_code_types, check_etc_types, args):
+    """
+    Extract and fingerprint the reference set once, and save it as the reference index.
+    
+    Args:
+        check_doc_types (list): List of document file extensions to check
+        check_code_types (list): List of code file extensions to check
+        check_etc_types (list): List of other file extensions to check
+        args: Command line arguments, the index is written to args.reference_index
+        
+    Returns:
+        ReferenceIndex: The new index
+    """
+    import common
+    from tqdm import tqdm
+    from tools.compare.index import build_index, clear_index
+
+    database = common.DB()
+    parse_filenames(args.reference_dir, check_doc_types, check_code_types, check_etc_types, database, is_reference=True, threads=args.scan_threads)
+    references = list(database.references.values())
+    reference_ids = ['ref_' + r.id for r in references]
+    clear_index(args.reference_index)
+
+    # The images are kept in the index, only the candidates of a run are decoded
+    images = []
+    if len(check_doc_types) > 0:
+        from tools.compare.image import extract_image_chunk
+        print('Extracting images...')
+        image_root = os.path.join(args.reference_index, 'images')
+        extract_kwargs = {'cache_dir': args.cache_dir, 'dummy_ratio': args.dummy_ratio, 'dummy_thumbnail': args.dummy_thumbnail, 'output_root': image_root}
+        if args.cache_dir is not None:
+            hash_files(database.manifest, [d for r in references for d in r.doc_names], threads=args.scan_threads)
+        doc_tasks = [(d, True, database.manifest[d].sha256) for r in references for d in r.doc_names]
+        doc_cost = lambda task: database.manifest[task[0]].size + 1
+        chunks = cost_chunks(doc_tasks, doc_cost, max(1, sum(map(doc_cost, doc_tasks)) // (max(1, args.p) * 16)))
+        fingerprints = {}
+        with tqdm(total=len(doc_tasks), desc='Extracting images...') as pbar:
+            for results, _ in imap_chunks(extract_image_chunk, chunks, processes=args.p, **extract_kwargs):
+                for doc_fingerprints, _ in results:
+                    fingerprints.update(doc_fingerprints)
+                pbar.update(len(results))
+        order = {entity_id: i for i, entity_id in enumerate(reference_ids)}
+        images = [(order[os.path.basename(os.path.dirname(path))], os.path.basename(path), fingerprint)
+                  for path, fingerprint in sorted(fingerprints.items())]
+
+    # The ORB descriptors are detected once and kept in the index, the runs never read the reference images for them
+    features = None
+    if args.matcher == 'orb':
+        from tools.compare.features import features_chunk
+        print('Detecting image features...')
+        paths = [os.path.join(args.reference_index, 'images', reference_ids[ref_idx], name) for ref_idx, name, _ in images]
+        chunks = cost_chunks(paths, lambda path: 1, max(1, len(paths) // (max(1, args.p) * 16)))
+        detected = {}
+        for results, _ in imap_chunks(features_chunk, chunks, processes=args.p, n_keypoints=args.orb_keypoints):
+            detected.update(results)
+        features = [detected[path] for path in paths]
+
+    code_files = []
+    if len(check_code_types) > 0:
+        from tools.compare.code import fingerprint_files
+        print('Fingerprinting codes...')
+        paths = [(i, path) for i, r in enumerate(references) for path in r.code_names]
+        code_files = list(zip([i for i, _ in paths], fingerprint_files([path for _, path in paths], args.code_k, args.code_window, args.p)))
+
+    # Documents and etc files are compared as texts, like in compare_files
+    text_files = []
+    paths = [(i, path) for i, r in enumerate(references)
+             for path in (r.doc_names if len(check_doc_types) > 0 else []) + (r.etc_names if len(check_etc_types) > 0 else [])]
+    if len(paths) > 0:
+        from tools.compare.text import sign_files
+        print('Signing texts...')
+        text_files = list(zip([i for i, _ in paths], sign_files([path for _, path in paths], args.text_shingle, args.text_perm, args.p)))
+
+    return build_index(args.reference_index, reference_ids, images, code_files, text_files, vars(args), features=features)
+
+def extract_documents(database, doc_tasks, args, executor=None):
+    """
+    Extract the images of the documents into the buffer, and record their fingerprints and occurrences in the database.
+    
+    Args:
+        database (common.DB): Database holding the manifest of the documents
+        doc_tasks (list): (document path, is_reference) of the documents to extract
+        args: Command line arguments
+        executor (ProcessPoolExecutor): Pool kept by the caller, a pool is started if None
+    """
+    from tqdm import tqdm
+    from tools.compare.image import extract_image_chunk
+
+    # Submissions and references share one pool, chunks are balanced by file size
+    extract_kwargs = {'cache_dir': args.cache_dir, 'dummy_ratio': args.dummy_ratio, 'dummy_thumbnail': args.dummy_thumbnail}
+    # The cache is keyed by the content hash, hashed in threads unless the incremental mode already did
+    if args.cache_dir is not None:
+        hash_files(database.manifest, [d for d, _ in doc_tasks], threads=args.scan_threads)
+    doc_tasks = [(d, is_reference, database.manifest[d].sha256) for d, is_reference in doc_tasks]
+    doc_cost = lambda task: database.manifest[task[0]].size + 1
+    chunks = cost_chunks(doc_tasks, doc_cost, max(1, sum(map(doc_cost, doc_tasks)) // (max(1, args.p) * 16)))
+    extract_result = []
+    with tqdm(total=len(doc_tasks), desc='Extracting images...') as pbar:
+        for results, _ in imap_chunks(extract_image_chunk, chunks, processes=args.p, executor=executor, **extract_kwargs):
+            extract_result += results
+            pbar.update(len(results))
+    fingerprints = database.fingerprints['image']
+    for doc_fingerprints, doc_occurrences in extract_result:
+        fingerprints.update(doc_fingerprints)
+        # Documents of the same student may share an image
+        for path, occurrences in doc_occurrences.items():
+            database.occurrences.setdefault(path, []).extend(occurrences)
+
+    # Keep the extraction cache within its size limit
+    if args.cache_dir is not None:
+        ExtractionCache(args.cache_dir, max_size=args.cache_size << 20).evict()
+
+def compare_files(database, check_doc_types, check_code_types, check_etc_types, args, changed=None, reference_index=None,
+                  store=None, executor=None, boilerplate=None):
     """
     Compare files based on their types and save results.
     
@@ -93,90 +250,311 @@ def compare_files(database, check_doc_types, check_code_types, check_etc_types,
         check_code_types (list): List of code file extensions to check
         check_etc_types (list): List of other file extensions to check
         args: Command line arguments
+        changed (set): Only the pairs involving these students and references are compared, every pair if None
+        reference_index (ReferenceIndex): The references are looked up in this index instead of the database if not None
+        store (ImageStore): Store extended with the images of this run and kept by the caller, a new store is built if None
+        executor (ProcessPoolExecutor): Pool kept by the caller across runs, a pool is started per stage if None
+        boilerplate (set): Names of the images that are not compared, found among the submissions of this run if None
         
     Returns:
-        None
+        bool: False if the time budget ran out before every pair was compared
     """
+    import common
+    from tools.plan import PlanLog
+
+    def is_changed(*entity_ids):
+        return changed is None or any(e in changed for e in entity_ids)
+
+    # The comparison stops starting new work when the budget runs out, the results so far are exported
+    deadline = None if args.time_budget is None else time.monotonic() + args.time_budget
+    complete = True
+    plan_log = PlanLog()
+
+    # Only the top matches of each student are reported unless the full matrix is requested
+    top_k = None if args.full_matrix else args.top_k
+
+    # Text files are compared together, documents and etc files alike
+    text_entities = []
+
     # If check document
     if len(check_doc_types) > 0:
-        # Get student and reference directories
-        sub_doc_names, ref_doc_names = database.get_documents()
+        import pandas as pd
+        from tqdm import tqdm
+        from tools.compare.image import compare_image_chunk, find_boilerplate
+        from tools.compare.phash import hash_directories, find_candidates, hamming
+        from tools.plan import image_pixels, pair_cost, count_pairs, plan_tiles, timed_chunk
+        from tools.compare.store import ImageStore
+
+        # Get the documents to extract, unchanged students and references keep their extracted images
+        def needs_extraction(entity_id):
+            return is_changed(entity_id) or not os.path.isdir(os.path.join(common.buffer_dir, entity_id))
+        sub_doc_names = [d for s in database.students.values() if needs_extraction(s.id) for d in s.doc_names]
+        ref_doc_names = [d for r in database.references.values() if needs_extraction('ref_' + r.id) for d in r.doc_names]
         
         ### Extract images from document files ###
-        print('Checking document files...')
-        print('Extracting images...')
-        if args.p > 1:
-            parmap.map(extract_image, sub_doc_names, pm_pbar=True, pm_processes=args.p)
-            parmap.map(extract_image, ref_doc_names, pm_pbar=True, pm_processes=args.p, is_reference=True)
-        else:
-            for s in tqdm(sub_doc_names, desc='Extracting images... (Submission)'):
-                extract_image(s)
-            for r in tqdm(ref_doc_names, desc='Extracting images... (Reference)'):
-                extract_image(r, is_reference=True)
-                
-        # Get directories in buffer
-        sub_image_dirs = glob.glob(os.path.join(common.buffer_dir, '*'))
-        ref_image_dirs = glob.glob(os.path.join(common.buffer_dir, 'ref_*'))
-
-        # Remove ref_image_dirs from sub_image_dirs
-        sub_image_dirs = [s for s in sub_image_dirs if s not in ref_image_dirs]
+        with instrument.stage('extraction'):
+            print('Checking document files...')
+            print('Extracting images...')
+            extract_documents(database, [(d, False) for d in sub_doc_names] + [(d, True) for d in ref_doc_names], args, executor)
+
+        # Get directories in buffer, directories left by other runs are ignored
+        sub_image_dirs = [os.path.join(common.buffer_dir, s) for s in database.students]
+        ref_image_dirs = [os.path.join(common.buffer_dir, 'ref_' + r) for r in database.references]
+        sub_image_dirs = [d for d in sub_image_dirs if os.path.isdir(d)]
+        ref_image_dirs = [d for d in ref_image_dirs if os.path.isdir(d)]
+        if reference_index is not None:
+            ref_image_dirs = reference_index.image_dirs()
         print(f'Finished extracting images')
-        
-        ### Compare images ###
-        print('Comparing images... (Submission and Submission)')
 
-        if args.p > 1:
-            compare_args = [(s0, s1) for i, s0 in enumerate(sub_image_dirs) for s1 in sub_image_dirs[i+1:]]
-            compare_result = parmap.map(compare_image_wrapper, compare_args, pm_pbar=True, pm_processes=args.p)
+        # Images shared by most submissions (templates, logos) would connect every student, they are not compared
+        if boilerplate is None:
+            boilerplate = find_boilerplate(sub_image_dirs, args.boilerplate_ratio)
+        if len(boilerplate) > 0:
+            print(f'Ignoring {len(boilerplate)} boilerplate images')
+        # The pairs kept from the previous run were compared without its boilerplate, every pair is compared again if it changed
+        image_changed = changed
+        image_kind = 'feature' if args.matcher == 'orb' else 'image'
+        if changed is not None and database.boilerplate.get('image') != boilerplate:
+            print('The boilerplate images changed, comparing every image pair again')
+            image_changed = None
+            database.clear_connections(image_kind)
+        database.boilerplate['image'] = boilerplate
+
+        def image_pair_changed(*entity_ids):
+            return image_changed is None or any(e in image_changed for e in entity_ids)
+
+        if args.matcher == 'orb':
+            ### Compare images by their keypoints ###
+            # Rotated, flipped, scaled and cropped copies match, only the image pairs sharing descriptors are verified
+            from tools.compare.features import compare_features
+            with instrument.stage('compare_features'):
+                print('Comparing image features...')
+                feature_result, feature_complete = compare_features(sub_image_dirs, ref_image_dirs if reference_index is None else [], boilerplate,
+                                                                    n_keypoints=args.orb_keypoints, min_inliers=args.orb_min_inliers, processes=args.p,
+                                                                    changed=image_changed, cache=database.fingerprints['feature'], executor=executor,
+                                                                    deadline=deadline, reference_index=reference_index)
+                complete = complete and feature_complete
+                for student_id_a, student_id_b, similarity, reference in feature_result:
+                    database.add_connection(student_id_a, student_id_b, similarity, reference=reference, kind='feature')
+
+            # Save the result, columns similarity_min, similarity_max, similarity_avg of the inlier ratios
+            with instrument.stage('export'):
+                database.get_connections('feature', top_k, args.report_threshold).export(os.path.join(args.output_dir, 'feature_result'), args.result_format)
         else:
-            compare_result = []
-            for i, s0 in enumerate(tqdm(sub_image_dirs, desc='Comparing images... (Submission and Submission)')):
-                for s1 in sub_image_dirs[i+1:]:
-                    compare_result.append(compare_image(s0, s1))
+            ### Select image pairs to compare ###
+            # The pairs are generated lazily, the other pairs of the incremental mode are kept from the previous run
+            with instrument.stage('prefilter'):
+                if reference_index is None:
+                    image_counts = {d: len(os.listdir(d)) for d in sub_image_dirs + ref_image_dirs}
+                else:
+                    # The reference directories are not listed, the index knows their sizes
+                    image_counts = {d: len(os.listdir(d)) for d in sub_image_dirs}
+                    image_counts.update(reference_index.image_counts())
+                if args.prefilter:
+                    # Only the image pairs with close fingerprints are fully compared
+                    print(f'Indexing image fingerprints... (Hamming distance <= {args.hash_distance})')
+                    hashes = hash_directories(sub_image_dirs + (ref_image_dirs if reference_index is None else []),
+                                              database.fingerprints['image'])
+                    hashes = {d: {name: fp for name, fp in names.items() if name not in boilerplate} for d, names in hashes.items()}
+                    sub_candidates = find_candidates(hashes, sub_image_dirs, sub_image_dirs, args.hash_distance)
+                    if reference_index is None:
+                        ref_candidates = find_candidates(hashes, sub_image_dirs, ref_image_dirs, args.hash_distance)
+                    else:
+                        # Only the reference fingerprints close to the submissions are read
+                        ref_candidates = reference_index.query_images(hashes, args.hash_distance)
+                    sub_candidates = {k: v for k, v in sub_candidates.items() if image_pair_changed(*map(os.path.basename, k))}
+                    ref_candidates = {k: v for k, v in ref_candidates.items() if image_pair_changed(*map(os.path.basename, k))}
+                    sub_tiles = group_tiles(sub_candidates, sub_image_dirs, sub_image_dirs, args.tile_size)
+                    ref_tiles = group_tiles(ref_candidates, sub_image_dirs, ref_image_dirs, args.tile_size)
+                    sub_tasks = lambda: ([(s0, s1, False, sub_candidates[(s0, s1)]) for s0, s1 in tile] for tile in sub_tiles)
+                    ref_tasks = lambda: ([(s, r, True, ref_candidates[(s, r)]) for s, r in tile] for tile in ref_tiles)
+                    # The pairs with the closest fingerprints are the most suspicious, the images of the index are not in hashes
+                    suspicion = lambda task: args.hash_distance - min((hamming(hashes[task[0]][a], hashes[task[1]][b]) for a, b in task[3]
+                                                                        if b in hashes.get(task[1], {})), default=args.hash_distance)
+                    compare_dirs = {d for k in list(sub_candidates) + list(ref_candidates) for d in k}
+                    sub_pairs = sum(map(len, sub_candidates.values()))
+                    ref_pairs = sum(map(len, ref_candidates.values()))
+
+                    # Image pairs skipped by the prefilter, including the pairs kept from the previous run
+                    sub_counts = [image_counts[d] for d in sub_image_dirs]
+                    all_pairs = (sum(sub_counts) ** 2 - sum(c * c for c in sub_counts)) // 2 + sum(sub_counts) * sum(image_counts[d] for d in ref_image_dirs)
+                    instrument.count('pairs_pruned_prefilter', all_pairs - sum(map(len, list(sub_candidates.values()) + list(ref_candidates.values()))))
+                else:
+                    sub_tasks = lambda: ([(s0, s1, False, None) for s0, s1 in tile if image_pair_changed(os.path.basename(s0), os.path.basename(s1))]
+                                         for tile in upper_tiles(sub_image_dirs, args.tile_size))
+                    ref_tasks = lambda: ([(s, r, True, None) for s, r in tile if image_pair_changed(os.path.basename(s), os.path.basename(r))]
+                                         for tile in cross_tiles(sub_image_dirs, ref_image_dirs, args.tile_size))
+                    suspicion = lambda task: 0
+                    # A changed student is compared with every other student
+                    compare_dirs = set(image_counts) if any(image_pair_changed(os.path.basename(d)) for d in image_counts) else set()
+                    dir_changed = lambda d: image_pair_changed(os.path.basename(d))
+                    sub_pairs = count_pairs({d: image_counts[d] for d in sub_image_dirs}, is_changed=dir_changed)
+                    ref_pairs = count_pairs({d: image_counts[d] for d in sub_image_dirs}, {d: image_counts[d] for d in ref_image_dirs}, dir_changed)
         
-        # Connect to database
-        for result in compare_result:
-            if result is not None:
-                database.add_connection(*result)
-
-        print('Comparing images... (Submission and Reference)')
-        if args.p > 1:
-            compare_args = [(s, r) for s in sub_image_dirs for r in ref_image_dirs]
-            compare_result = parmap.map(compare_image_wrapper, compare_args, pm_pbar=True, pm_processes=args.p)
-        else:
-            compare_result = []
-            for s in tqdm(sub_image_dirs, desc='Comparing images... (Submission and Reference)'):
-                for r in ref_image_dirs:
-                    compare_result.append(compare_image(s, r, reference=True))
-
-        # Connect to database
-        for result in compare_result:
-            if result is not None:
-                database.add_connection(*result, reference=True)
-
-        # Save the result using pandas
-        buf = [[key, *value] for key, values in database.connections.items() for value in values]
-        # Unpack ssim, psnr, mse
-        buf = [[*b[:2], *b[2][0], *b[3][0], *b[4][0]] for b in buf]
-        df = pd.DataFrame(buf, columns=['student_id_a', 'student_id_b',
-                                        'mse_min', 'mse_max', 'mse_avg',
-                                        'ssim_min', 'ssim_max', 'ssim_avg',
-                                        'psnr_min', 'psnr_max', 'psnr_avg'])
-        df.to_csv(os.path.join(args.output_dir, 'result.csv'), index=False)
+            # Each run decodes into a store of its own, so concurrent runs never overwrite each other's shards
+            own_store = store is None
+            try:
+                ### Decode images once ###
+                print('Decoding images...')
+                with instrument.stage('store'):
+                    image_paths = [os.path.join(d, name) for d in sorted(compare_dirs) for name in os.listdir(d) if name not in boilerplate]
+                    if own_store:
+                        store = ImageStore(tempfile.mkdtemp(prefix='store_', dir=args.output_dir), compare_size=args.compare_size,
+                                           cache_size=args.store_cache << 20)
+                        store.build(image_paths, processes=args.p, executor=executor)
+                    else:
+                        # The images decoded by the previous runs are kept
+                        store.extend(image_paths, processes=args.p, executor=executor)
+
+                ### Compare images ###
+                # Each task is a tile of the pair matrix, its workers load the images of the tile once
+                with instrument.stage('compare_image'):
+                    pyramid = (args.shape_threshold, args.error_threshold) if args.pyramid else None
+                    pyramid_result = []
+                    # The cost of a pair is estimated from the shapes of the decoded images
+                    pixels, dir_pixels = image_pixels(store.index)
+                    estimate = lambda task: pair_cost(task, pixels, dir_pixels)
+                    mean_pixels = sum(pixels.values()) / max(1, len(pixels))
+                    for desc, tasks, reference, image_pairs in [('Submission and Submission', sub_tasks, False, sub_pairs),
+                                                                ('Submission and Reference', ref_tasks, True, ref_pairs)]:
+                        print(f'Comparing images... ({desc})')
+                        # The chunks are sized from the number of image pairs, the tiles are not generated twice
+                        total_cost = int(image_pairs * (mean_pixels + 1))
+                        chunk_cost = max(1, total_cost // (max(1, args.p) * 16))
+                        # The suspicious and then the expensive tiles run first, so the slowest pairs do not start last.
+                        # The tiles are ordered within bounded windows, or all at once under a time budget so the best results are in when it runs out
+                        planned = []
+
+                        def plan_order(window):
+                            for order, (tile, *plan) in enumerate(plan_tiles(tasks(), estimate, suspicion, chunk_cost, window)):
+                                planned.append((len(tile), *plan))
+                                yield order, tile
+                        window = None if deadline is not None else max(1, args.p) * 64
+                        chunks = cost_chunks(plan_order(window), lambda item: planned[item[0]][1], chunk_cost)
+                        seconds = {}
+                        with tqdm(total=total_cost, desc=f'Comparing images... ({desc})', unit='px', unit_scale=True) as pbar:
+                            for timed, cost in imap_chunks(timed_chunk, chunks, processes=args.p, executor=executor, deadline=deadline,
+                                                           tile_func=compare_image_chunk, store=store, boilerplate=boilerplate, pyramid=pyramid):
+                                # Connect to database
+                                for order, tile_seconds, results in timed:
+                                    seconds[order] = tile_seconds
+                                    for result in results:
+                                        if result is None:
+                                            continue
+                                        if pyramid is not None:
+                                            *result, rejections = result
+                                            pyramid_result += [[*result[:2], *rejection] for rejection in rejections]
+                                            # Every image pair was rejected
+                                            if len(result[2]) == 0:
+                                                continue
+                                        database.add_connection(*result, reference=reference)
+                                pbar.update(cost)
+                        # The tiles left when the time budget ran out are logged as skipped
+                        for _ in chunks:
+                            pass
+                        plan_log.add('compare_image', planned, seconds)
+                        if len(seconds) < len(planned):
+                            complete = False
+                            instrument.count('pairs_skipped_budget', sum(plan[0] for order, plan in enumerate(planned) if order not in seconds))
+                            print(f'Time budget exhausted, {len(planned) - len(seconds)} of {len(planned)} tiles not compared ({desc})')
+            finally:
+                if own_store and store is not None:
+                    store.remove()
+
+            # Save the result, columns mse, ssim, psnr
+            with instrument.stage('export'):
+                database.get_connections('image', top_k, args.report_threshold).export(os.path.join(args.output_dir, 'result'), args.result_format)
+
+                # Resolution at which each image pair compared in this run was rejected, empty if it was not
+                if pyramid is not None:
+                    df = pd.DataFrame(pyramid_result, columns=['student_id_a', 'student_id_b', 'image_a', 'image_b', 'rejected_at'])
+                    df.to_csv(os.path.join(args.output_dir, 'pyramid_result.csv'), index=False)
+
+        # Map every compared image back to the pages it occurs on
+        with instrument.stage('export'):
+            buf = [[os.path.basename(path), os.path.basename(os.path.dirname(path)), doc_path, page, xref, os.path.basename(path) in boilerplate]
+                   for path, occurrences in sorted(database.occurrences.items()) for doc_path, page, xref in occurrences]
+            df = pd.DataFrame(buf, columns=['image', 'student_id', 'document', 'page', 'xref', 'boilerplate'])
+            df.to_csv(os.path.join(args.output_dir, 'image_occurrences.csv'), index=False)
             
         ### Compare texts in document files ###
+        text_entities += [(s.id, False, s.doc_names) for s in database.students.values()]
+        text_entities += [('ref_' + r.id, True, r.doc_names) for r in database.references.values()]
 
     # If check code
     if len(check_code_types) > 0:
+        from tools.compare.code import compare_code
         print('Checking code files...')
-        code_result = []
+        entities = [(s.id, False, s.code_names) for s in database.students.values()]
+        entities += [('ref_' + r.id, True, r.code_names) for r in database.references.values()]
+        with instrument.stage('compare_code'):
+            # Every pair is compared again when the boilerplate fingerprints of the cohort changed
+            code_boilerplate = database.boilerplate.setdefault('code', set())
+            previous_boilerplate = set(code_boilerplate)
+            code_result = compare_code(entities, k=args.code_k, window_size=args.code_window, max_df=args.code_max_df, processes=args.p,
+                                       changed=changed, cache=database.fingerprints['code'], reference_index=reference_index,
+                                       executor=executor, boilerplate=code_boilerplate)
+            code_changed = changed if code_boilerplate == previous_boilerplate else None
+            if changed is not None and code_changed is None:
+                print('The boilerplate code changed, comparing every code pair again')
+                database.clear_connections('code')
+            if reference_index is not None:
+                code_result += reference_index.query_code(entities, database.fingerprints['code'], max_df=args.code_max_df, changed=code_changed)
+
+            # Connect to database
+            for student_id_a, student_id_b, similarity, reference in code_result:
+                database.add_connection(student_id_a, student_id_b, similarity, reference=reference, kind='code')
+
+        with instrument.stage('export'):
+            database.get_connections('code', top_k, args.report_threshold).export(os.path.join(args.output_dir, 'code_result'), args.result_format)
     
     # If check etc
     if len(check_etc_types) > 0:
         print('Checking etc files...')
-        etc_result = []
+        text_entities += [(s.id, False, s.etc_names) for s in database.students.values()]
+        text_entities += [('ref_' + r.id, True, r.etc_names) for r in database.references.values()]
+
+    if len(text_entities) > 0:
+        from tools.compare.text import compare_text
+        print('Comparing texts...')
+        with instrument.stage('compare_text'):
+            text_result = compare_text(text_entities, k=args.text_shingle, num_perm=args.text_perm, bands=args.text_bands, processes=args.p,
+                                       changed=changed, cache=database.fingerprints['text'], executor=executor)
+            if reference_index is not None:
+                text_result += reference_index.query_text(text_entities, database.fingerprints['text'], changed=changed)
+
+            # Connect to database
+            for student_id_a, student_id_b, similarity, reference in text_result:
+                database.add_connection(student_id_a, student_id_b, similarity, reference=reference, kind='text')
+
+        with instrument.stage('export'):
+            database.get_connections('text', top_k, args.report_threshold).export(os.path.join(args.output_dir, 'text_result'), args.result_format)
+
+    ### Group the students connected in any kind ###
+    # One connected component per group, ranked by size, so a source shared by many students shows up as one row
+    kinds = (['feature' if args.matcher == 'orb' else 'image'] if len(check_doc_types) > 0 else []) + (['code'] if len(check_code_types) > 0 else [])
+    kinds += ['text'] if len(text_entities) > 0 else []
+    if len(kinds) > 0:
+        from tools.groups import find_groups, export_groups
+        with instrument.stage('groups'):
+            threshold = args.report_threshold if args.group_threshold is None else args.group_threshold
+            groups = find_groups({kind: database.get_connections(kind, top_k, args.report_threshold) for kind in kinds}, threshold)
+            export_groups(groups, os.path.join(args.output_dir, 'groups'))
+            print(f'Found {len(groups)} groups of similar submissions (score >= {threshold})')
+
+    # Estimated and actual cost of the planned tiles, to check the cost model afterwards
+    if len(plan_log.rows) > 0:
+        plan_log.export(os.path.join(args.output_dir, 'plan'))
+        summary = plan_log.summary()
+        print(f'Planned {summary["tiles"]} tiles, {summary["done"]} compared in {summary["seconds"]:.2f} s of worker time')
+    return complete
+
+def main(args=None):
+    # The command line is parsed here rather than at import, --help exits before anything heavy is loaded
+    args = config.get_config() if args is None else args
+    import common
+    database = common.DB()
 
-def main():
     # Parse check_filetype into a list
     check_filetype = args.check_filetype.split(',')
 
@@ -191,14 +569,37 @@ def main():
     check_code_types = [t for t in check_filetype if t in common.supported_code_types]   # ['c', 'cpp', ...]
     check_etc_types = [t for t in check_filetype if t in common.supported_etc_types]     # ['txt', 'csv', ...]
 
+    # Profile a stage if requested
+    if args.profile is not None:
+        extension = 'prof' if args.profiler == 'cprofile' else 'html'
+        instrument.configure_profile(args.profile, args.profiler, args.profile_output or os.path.join(args.output_dir, f'profile_{args.profile}.{extension}'))
+
+    # Fail before the comparison rather than at the export
+    assert args.result_format != 'parquet' or importlib.util.find_spec('pyarrow') is not None, 'pyarrow is required for --result-format parquet'
+
     # Set threshold values
     shape_threshold = args.shape_threshold
     error_threshold = args.error_threshold
     os.makedirs(args.output_dir, exist_ok=True)
 
+    # Build the reference index once, the later runs query it
+    if args.build_reference_index:
+        assert args.reference_index is not None, '--build-reference-index requires --reference-index'
+        reference_index = build_reference_index(check_doc_types, check_code_types, check_etc_types, args)
+        print(f'Indexed {len(reference_index.references)} references into {args.reference_index}')
+        return
+
     # Parse filenames and add to database
-    submission_count = parse_filenames(args.input_dir, check_doc_types, check_code_types, check_etc_types, database)
-    reference_count = parse_filenames(args.reference_dir, check_doc_types, check_code_types, check_etc_types, database, is_reference=True)
+    submission_count = parse_filenames(args.input_dir, check_doc_types, check_code_types, check_etc_types, database, threads=args.scan_threads)
+    if args.reference_index is not None:
+        from tools.compare.index import ReferenceIndex
+        reference_index = ReferenceIndex(args.reference_index)
+        mismatches = reference_index.mismatches(vars(args))
+        assert len(mismatches) == 0, f'The reference index was built with other {", ".join(mismatches)}, build it again'
+        reference_count = len(reference_index.references)
+    else:
+        reference_index = None
+        reference_count = parse_filenames(args.reference_dir, check_doc_types, check_code_types, check_etc_types, database, is_reference=True, threads=args.scan_threads)
 
     # Print information
     print(f'Num submissions: {submission_count}')
@@ -208,8 +609,40 @@ def main():
     print(f'Error Threshold: {error_threshold}')
     print(f'Shape Threshold: {shape_threshold}')
 
+    # Restore the previous results and find the new or changed submissions
+    changed = None
+    if args.incremental:
+        state_path = os.path.join(args.output_dir, 'state.pkl')
+        settings = {k: v for k, v in vars(args).items() if k not in ('output_dir', 'p', 'incremental', 'cache_dir', 'cache_size', 'store_cache',
+                                                                      'top_k', 'report_threshold', 'full_matrix', 'result_format', 'scan_threads', 'group_threshold', 'time_budget',
+                                                                      'trace', 'profile', 'profiler', 'profile_output', 'build_reference_index')}
+        # A rebuilt index compares every pair again
+        if reference_index is not None:
+            settings['reference_index'] = reference_index.id
+        # The signatures of the previous run are not reused once the text extraction changed
+        if len(check_doc_types + check_etc_types) > 0:
+            from tools.compare.text import signature_version
+            settings['text_signature'] = signature_version
+        changed = load_state(database, state_path, settings, args.scan_threads)
+        if changed is not None:
+            print(f'Changed submissions: {len(changed)}')
+    elif not args.full_matrix:
+        # The incremental mode keeps every connection for the next run, the others only keep the top matches
+        database.keep_top(args.top_k, args.report_threshold)
+
     # Compare files
-    compare_files(database, check_doc_types, check_code_types, check_etc_types, args)
+    complete = compare_files(database, check_doc_types, check_code_types, check_etc_types, args, changed=changed, reference_index=reference_index)
+
+    # The pairs skipped by the time budget would be taken as compared by the next incremental run
+    if args.incremental and complete:
+        database.save(state_path)
+    elif args.incremental:
+        print('The comparison is incomplete, the state is not saved and the next run compares the changed submissions again')
+
+    # Timers and counters of the run, aggregated over the workers
+    if args.trace is not None:
+        instrument.save_trace(args.trace, {'args': vars(args)})
+        print(f'Saved the trace to {args.trace}')
 
 
 '''
@@ -0,0 +1,318 @@
+# Path: src/service.py
+# Author: Jiwoon Lee
+# Last Modified: 2026-10-18
+# Description: This script runs the comparison as a long-running local service, queueing batches of submissions and streaming the result of each student as it finishes.
+# Usage: python src/service.py --reference-index <index_dir> --output-dir <output_dir> --check_filetype <check_filetype> [--port <port> | --socket <path>]
+# Example: python src/service.py --reference-index ./reference_index --output-dir ./result --check_filetype pdf,cpp --port 8765
+# API:
+#   POST /jobs {"input_dir": "<directory of student directories>"}: Queue a batch, returns the job
+#   GET /jobs: List the jobs
+#   GET /jobs/<id>: Return a job with the results of its students finished so far
+#   GET /jobs/<id>/results: Stream one JSON line per student, until the job ends
+# Options: Every option of main.py, and
+#   --host, --port: Address of the HTTP API, 127.0.0.1:8765 by default
+#   --socket: Serve the HTTP API on this Unix socket instead
+# License: MIT License
+#
+# Disclaimer
+# This program is provided as is without any guarantees or warranty. In no event shall the authors be liable for any damages or losses arising from the use of this program.
+# This program does not guarantee the correctness of the comparison results. Please check the results manually.
+
+import asyncio
+import json
+import math
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import uuid
+# add parent directory to sys.path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+import main
+
+_reasons = {200: 'OK', 202: 'Accepted', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed'}
+
+
+def _finite(value):
+    # JSON has no Infinity or NaN, e.g. the PSNR of identical images is sent as null
+    if isinstance(value, float):
+        return value if math.isfinite(value) else None
+    if isinstance(value, dict):
+        return {k: _finite(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_finite(v) for v in value]
+    return value
+
+
+def _dumps(payload):
+    return json.dumps(_finite(payload), allow_nan=False).encode()
+
+
+class Job:
+    '''
+    Batch of submissions queued in the service.
+    The fields are only changed in the thread of the event loop.
+    '''
+    def __init__(self, input_dir):
+        self.id = uuid.uuid4().hex[:12]
+        self.input_dir = input_dir
+        self.status = 'queued'  # queued, running, done or failed
+        self.error = None
+        self.students = []      # Ids of the students of the batch, known once it runs
+        self.results = []       # Matches of each student, in order, published as each student is compared
+        self._updated = asyncio.Event()
+
+    def publish(self, result=None, students=None, status=None, error=None):
+        if result is not None:
+            self.results.append(result)
+        if students is not None:
+            self.students = students
+        if status is not None:
+            self.status = status
+        if error is not None:
+            self.error = error
+        # Wake up the streams following the job
+        self._updated.set()
+        self._updated = asyncio.Event()
+
+    def finished(self):
+        return self.status in ('done', 'failed')
+
+    async def follow(self):
+        # Yield the results published so far, then the new ones until the job ends
+        i = 0
+        while True:
+            updated = self._updated
+            while i < len(self.results):
+                yield self.results[i]
+                i += 1
+            if self.finished():
+                return
+            await updated.wait()
+
+    def summary(self, results=False):
+        summary = {'id': self.id, 'input_dir': self.input_dir, 'status': self.status, 'error': self.error,
+                   'students': self.students, 'finished': len(self.results)}
+        if results:
+            summary['results'] = self.results
+        return summary
+
+
+class Service:
+    '''
+    Comparison state kept warm across the jobs: the database of every student seen so far, the references
+    (or the reference index), the decoded image store and the worker pool.
+    The jobs run one at a time, the students of a batch are compared one after the other with the students before them,
+    with the students of the earlier batches and with the references.
+    The boilerplate images are found once among the references, so the results of a student do not depend on the batches before it.
+    '''
+    def __init__(self, args):
+        import common
+        self.args = args
+        check_filetype = args.check_filetype.split(',')
+        self.check_doc_types = [t for t in check_filetype if t in common.supported_doc_types]
+        self.check_code_types = [t for t in check_filetype if t in common.supported_code_types]
+        self.check_etc_types = [t for t in check_filetype if t in common.supported_etc_types]
+        assert len(self.check_doc_types + self.check_code_types + self.check_etc_types) > 0, f'Supported file types are {common.supported_types}'
+        os.makedirs(args.output_dir, exist_ok=True)
+
+        self.database = common.DB()
+        self.reference_index = None
+        if args.reference_index is not None:
+            from tools.compare.index import ReferenceIndex
+            self.reference_index = ReferenceIndex(args.reference_index)
+            mismatches = self.reference_index.mismatches(vars(args))
+            assert len(mismatches) == 0, f'The reference index was built with other {", ".join(mismatches)}, build it again'
+        else:
+            main.parse_filenames(args.reference_dir, self.check_doc_types, self.check_code_types, self.check_etc_types, self.database, is_reference=True,
+                                 threads=args.scan_threads)
+            # Images left by other runs may be stale, the references are extracted again below
+            for reference_id in self.database.references:
+                shutil.rmtree(os.path.join(common.buffer_dir, 'ref_' + reference_id), ignore_errors=True)
+
+        self.executor = None
+        if args.p > 1:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            # The jobs run in a thread, forking a threaded process is not safe
+            self.executor = ProcessPoolExecutor(args.p, mp_context=multiprocessing.get_context('spawn'))
+
+        self.store = None
+        self.boilerplate = None
+        if len(self.check_doc_types) > 0:
+            from tools.compare.image import find_boilerplate
+            from tools.compare.store import ImageStore
+            # The service decodes into a store of its own, the CLI runs keep theirs
+            self.store = ImageStore(tempfile.mkdtemp(prefix='store_', dir=args.output_dir), compare_size=args.compare_size,
+                                    cache_size=args.store_cache << 20)
+            if self.reference_index is not None:
+                ref_image_dirs = self.reference_index.image_dirs()
+            else:
+                main.extract_documents(self.database, [(d, True) for r in self.database.references.values() for d in r.doc_names],
+                                       args, self.executor)
+                ref_image_dirs = [os.path.join(common.buffer_dir, 'ref_' + r) for r in self.database.references]
+                ref_image_dirs = [d for d in ref_image_dirs if os.path.isdir(d)]
+            self.boilerplate = find_boilerplate(ref_image_dirs, args.boilerplate_ratio)
+
+        self.jobs = {}
+        self.queue = None
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+        if self.store is not None:
+            self.store.remove()
+
+    def forget(self, student_id):
+        # Drop the results, fingerprints and images of a student before it is compared again
+        import common
+        image_dir = os.path.join(common.buffer_dir, student_id)
+        previous = self.database.students.pop(student_id, None)
+        paths = set(previous.doc_names + previous.code_names + previous.etc_names) if previous is not None else set()
+        self.database.remove_connections({student_id})
+        self.database.manifest = {p: e for p, e in self.database.manifest.items() if p not in paths}
+        self.database.fingerprints = {kind: {p: f for p, f in fingerprints.items() if p not in paths and not p.startswith(image_dir + os.sep)}
+                                      for kind, fingerprints in self.database.fingerprints.items()}
+        self.database.occurrences = {p: o for p, o in self.database.occurrences.items() if not p.startswith(image_dir + os.sep)}
+        # The decoded images of the previous submission are not compared any more
+        if self.store is not None:
+            self.store.drop([p for p in self.store.index if p.startswith(os.path.abspath(image_dir) + os.sep)])
+        shutil.rmtree(image_dir, ignore_errors=True)
+
+    def matches(self, student_id):
+        # Top matches of a student by kind, as reported in the result files
+        top_k = None if self.args.full_matrix else self.args.top_k
+        result = {'student_id': student_id}
+        image_kind = 'feature' if self.args.matcher == 'orb' else 'image'
+        for kind, types in ((image_kind, self.check_doc_types), ('code', self.check_code_types), ('text', self.check_doc_types + self.check_etc_types)):
+            if len(types) > 0:
+                result[kind] = [{'student_id': other, **values}
+                                for other, values in self.database.get_matches(student_id, kind, top_k, self.args.report_threshold)]
+        return result
+
+    def run_job(self, job, publish):
+        '''
+        Compare the students of a job one after the other, in a thread of the event loop.
+        Each student is compared with the students before it, and its result is published as soon as it finishes.
+        The pairs of a student with the students after it in the job are in their results.
+        Args:
+            job: The running job
+            publish: Called with the keyword arguments of Job.publish, safe to call from this thread
+        '''
+        import common
+        batch = common.DB()
+        main.parse_filenames(job.input_dir, self.check_doc_types, self.check_code_types, self.check_etc_types, batch, threads=self.args.scan_threads)
+        students = sorted(batch.students)
+        publish(students=students)
+        # A student submitting again replaces the previous submission, none of the job is compared with an old one
+        for student_id in students:
+            self.forget(student_id)
+        self.database.manifest.update(batch.manifest)
+        for student_id in students:
+            self.database.add_student(batch.students[student_id])
+            complete = main.compare_files(self.database, self.check_doc_types, self.check_code_types, self.check_etc_types, self.args,
+                                          changed={student_id}, reference_index=self.reference_index, store=self.store, executor=self.executor,
+                                          boilerplate=self.boilerplate)
+            if self.store is not None:
+                self.store.compact()
+            # --time-budget applies to each student, an incomplete result may miss matches
+            publish(result={**self.matches(student_id), 'complete': complete})
+
+    async def work(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await self.queue.get()
+            job.publish(status='running')
+            publish = lambda **kwargs: loop.call_soon_threadsafe(lambda: job.publish(**kwargs))
+            try:
+                await asyncio.to_thread(self.run_job, job, publish)
+                job.publish(status='done')
+            except Exception as e:
+                job.publish(status='failed', error=repr(e))
+            print(f'Job {job.id} {job.status}, {len(job.results)} students')
+
+    async def respond(self, writer, status, payload):
+        body = _dumps(payload)
+        writer.write(f'HTTP/1.1 {status} {_reasons[status]}\r\nContent-Type: application/json\r\n'
+                     f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body)
+        await writer.drain()
+
+    async def handle(self, reader, writer):
+        # One request per connection
+        try:
+            method, target, _ = (await reader.readline()).decode('latin-1').split(' ', 2)
+            headers = {}
+            while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+            parts = [part for part in target.split('?')[0].split('/') if part]
+
+            if parts == ['jobs'] and method == 'POST':
+                request = json.loads(body or b'{}')
+                input_dir = request.get('input_dir')
+                if not isinstance(input_dir, str) or not os.path.isdir(input_dir):
+                    return await self.respond(writer, 400, {'error': f'input_dir is not a directory: {input_dir}'})
+                job = Job(input_dir)
+                self.jobs[job.id] = job
+                self.queue.put_nowait(job)
+                return await self.respond(writer, 202, job.summary())
+            if parts == ['jobs'] and method == 'GET':
+                return await self.respond(writer, 200, [job.summary() for job in self.jobs.values()])
+            if len(parts) in (2, 3) and parts[0] == 'jobs' and parts[1] in self.jobs and parts[2:] in ([], ['results']):
+                if method != 'GET':
+                    return await self.respond(writer, 405, {'error': f'{method} is not allowed'})
+                job = self.jobs[parts[1]]
+                if len(parts) == 2:
+                    return await self.respond(writer, 200, job.summary(results=True))
+                # Newline-delimited JSON, the end of the job closes the connection
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\nConnection: close\r\n\r\n')
+                async for result in job.follow():
+                    writer.write(_dumps(result) + b'\n')
+                    await writer.drain()
+                return
+            return await self.respond(writer, 404, {'error': f'No route for {method} {target}'})
+        except (ValueError, asyncio.IncompleteReadError) as e:
+            await self.respond(writer, 400, {'error': str(e)})
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self):
+        self.queue = asyncio.Queue()
+        worker = asyncio.create_task(self.work())
+        if self.args.socket is not None:
+            server = await asyncio.start_unix_server(self.handle, path=self.args.socket)
+            print(f'Listening on {self.args.socket}')
+        else:
+            server = await asyncio.start_server(self.handle, self.args.host, self.args.port)
+            print(f'Listening on http://{self.args.host}:{self.args.port}')
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            worker.cancel()
+
+
+def get_config():
+    parser = config.get_parser()
+    parser.add_argument('--host', dest='host', type=str, default='127.0.0.1', help='Host of the HTTP API')
+    parser.add_argument('--port', dest='port', type=int, default=8765, help='Port of the HTTP API')
+    parser.add_argument('--socket', dest='socket', type=str, default=None, help='Serve the HTTP API on this Unix socket instead of the port')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    # A terminated service removes its store like an interrupted one
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    service = Service(get_config())
+    try:
+        asyncio.run(service.serve())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
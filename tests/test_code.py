@@ -0,0 +1,66 @@
+# Path: tests/test_code.py
+# Author: Jiwoon Lee
+# Last Modified: 2026-10-18
+# Description: This script tests the winnowing code comparison.
+# License: MIT License
+#
+# Disclaimer
+# This program is provided as is without any guarantees or warranty. In no event shall the authors be liable for any damages or losses arising from the use of this program.
+# This program does not guarantee the correctness of the comparison results. Please check the results manually.
+
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tools.compare.code import compare_code
+
+code = '''#include <stdio.h>
+
+int add(int a, int b) {
+    return a + b;
+}
+
+int main() {
+    int total = 0;
+    for (int i = 0; i < 100; i++) {
+        total = add(total, i * i);
+        if (total % 7 == 0) {
+            printf("%d is a multiple of 7\\n", total);
+        }
+    }
+    printf("total %d\\n", total);
+    return 0;
+}
+'''
+
+# Shared by every entity, dropped as boilerplate at max_df 0.5
+header = '''#include <stdlib.h>
+
+int clamp(int value, int low, int high) {
+    if (value < low) return low;
+    if (value > high) return high;
+    return value;
+}
+'''
+
+
+def _write(directory, name, text):
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, name)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    return path
+
+
+def test_identical_files_score_one(tmp_path):
+    entities = [(name, False, [_write(str(tmp_path / name), 'main.cpp', header + code)]) for name in ('a', 'b')]
+    results = compare_code(entities, k=10, window_size=4)
+    assert [(a, b, values[0][1]) for a, b, values, _ in results] == [('a', 'b', 1.0)]
+
+
+def test_identical_files_score_one_without_boilerplate(tmp_path):
+    entities = [(name, False, [_write(str(tmp_path / name), 'main.cpp', header + code)]) for name in ('a', 'b')]
+    entities.append(('c', False, [_write(str(tmp_path / 'c'), 'main.cpp', header + 'int unrelated(void) { return 42 * 42 - 1; }\n')]))
+    entities.append(('d', False, [_write(str(tmp_path / 'd'), 'main.cpp', header + 'double other(double x) { return x / 3.0 + 0.5; }\n')]))
+    results = compare_code(entities, k=10, window_size=4, max_df=0.5)
+    scores = {(a, b): values[0][1] for a, b, values, _ in results}
+    assert scores[('a', 'b')] == 1.0
@@ -0,0 +1,56 @@
+# Path: tests/test_startup.py
+# Author: Jiwoon Lee
+# Last Modified: 2026-10-18
+# Description: This script tests that the entry point starts without loading the heavy dependencies.
+# License: MIT License
+#
+# Disclaimer
+# This program is provided as is without any guarantees or warranty. In no event shall the authors be liable for any damages or losses arising from the use of this program.
+# This program does not guarantee the correctness of the comparison results. Please check the results manually.
+
+import os
+import subprocess
+import sys
+import time
+
+src_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+
+# Seconds to import the entry point or print its --help, the fastest of a few fresh interpreters
+startup_budget = 1.0
+heavy_modules = ['numpy', 'cv2', 'skimage', 'fitz']
+
+
+def _fastest(command, repeat=3):
+    seconds = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+        seconds = min(seconds, time.perf_counter() - start)
+    return seconds, output
+
+
+def _loaded(output):
+    # Heavy modules printed by the probe on its last line, after the output of main
+    line = output.splitlines()[-1]
+    assert line.startswith('loaded:')
+    return [m for m in line[len('loaded:'):].split(',') if m]
+
+
+# Printed by the probes once main is done
+report = f'print("loaded:" + ",".join(m for m in {heavy_modules!r} if m in sys.modules))'
+
+
+def test_import_main_is_light():
+    probe = f'import sys; sys.path.insert(0, {src_dir!r}); import main; {report}'
+    seconds, output = _fastest([sys.executable, '-c', probe])
+    assert _loaded(output) == []
+    assert seconds < startup_budget
+
+
+def test_help_is_light():
+    probe = (f'import sys; sys.path.insert(0, {src_dir!r}); sys.argv = ["main.py", "--help"]; import main\n'
+             f'try:\n    main.main()\nexcept SystemExit:\n    pass\n{report}')
+    seconds, output = _fastest([sys.executable, '-c', probe])
+    assert 'usage' in output
+    assert _loaded(output) == []
+    assert seconds < startup_budget
@@ -0,0 +1,65 @@
+# Path: tests/test_text.py
+# Author: Jiwoon Lee
+# Last Modified: 2026-10-18
+# Description: This script tests the shingling of the streamed texts.
+# License: MIT License
+#
+# Disclaimer
+# This program is provided as is without any guarantees or warranty. In no event shall the authors be liable for any damages or losses arising from the use of this program.
+# This program does not guarantee the correctness of the comparison results. Please check the results manually.
+
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import zipfile
+
+import numpy as np
+import pytest
+
+from tools.compare.text import lsh_candidates, shingle_hashes, stream_text, text_signature
+
+text = 'The quick brown fox\njumps over the lazy dog,\nand the dog sleeps on.\n'
+
+
+def _hashes(chunks, k):
+    return np.concatenate(list(shingle_hashes(chunks, k)) + [np.array([], dtype=np.uint64)])
+
+
+def _write_docx(path, paragraphs):
+    # Minimal docx holding the paragraphs, each a list of runs
+    body = ''.join('<w:p>' + ''.join(f'<w:r><w:t>{run}</w:t></w:r>' for run in runs) + '</w:p>' for runs in paragraphs)
+    with zipfile.ZipFile(path, 'w') as docx:
+        docx.writestr('word/document.xml', '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+                                           f'<w:body>{body}</w:body></w:document>')
+    return str(path)
+
+
+def test_chunk_boundaries_do_not_change_the_shingles():
+    for cut in range(len(text) + 1):
+        for k in (1, 3, 5):
+            assert np.array_equal(_hashes([text[:cut], text[cut:]], k), _hashes([text], k))
+
+
+def test_long_word_is_one_word():
+    assert len(_hashes(['a' * 100000 + ' b'], 2)) == 1
+
+
+def test_docx_word_split_across_runs_is_one_word(tmp_path):
+    split = _write_docx(tmp_path / 'split.docx', [['Plagia', 'rism is ', 'found'], ['in two paragraphs']])
+    whole = _write_docx(tmp_path / 'whole.docx', [['Plagiarism is found'], ['in two paragraphs']])
+    assert np.array_equal(_hashes(stream_text(split), 2), _hashes(stream_text(whole), 2))
+    assert len(_hashes(stream_text(whole), 1)) == 6
+
+
+def test_empty_and_corrupt_pdf_have_no_signature(tmp_path):
+    pytest.importorskip('fitz')
+    (tmp_path / 'empty.pdf').write_bytes(b'')
+    (tmp_path / 'corrupt.pdf').write_bytes(b'%PDF-1.4 not a pdf')
+    assert text_signature(str(tmp_path / 'empty.pdf')) is None
+    assert text_signature(str(tmp_path / 'corrupt.pdf')) is None
+
+
+def test_fewer_permutations_than_bands_is_rejected():
+    with pytest.raises(AssertionError):
+        lsh_candidates([np.zeros(16, dtype=np.uint64)] * 2, bands=32)
+
@@ -0,0 +1,411 @@
+# Path: tools/benchmark.py
+# Author: Jiwoon Lee
+# Last Modified: 2026-10-18
+# Description: This script benchmarks the extraction and comparison stages on synthetic submission and reference trees.
+# License: MIT License
+#
+# Disclaimer
+# This program is provided as is without any guarantees or warranty. In no event shall the authors be liable for any damages or losses arising from the use of this program.
+# This program does not guarantee the correctness of the comparison results. Please check the results manually.
+#
+# Usage: python tools/benchmark.py --sizes 8,16,32 --output benchmark.json [--baseline previous.json]
+#        python tools/benchmark.py --startup-only --startup-budget 0.5
+#
+
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+import argparse
+import io
+import json
+import math
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+import fitz
+import numpy as np
+from PIL import Image
+
+import common
+from tools.compare.code import compare_code
+from tools.compare.image import extract_image, compare_image_chunk, is_dummy, _iter_image_bytes
+from tools.compare.phash import hash_directories, find_candidates
+from tools.compare.store import ImageStore
+from tools.compare.text import compare_text
+from tools.schedule import group_tiles, cost_chunks, imap_chunks
+
+# Bump when the stages or the corpus change, results of another version are not compared
+benchmark_version = 1
+
+# Modules the entry point must not load before a file type asks for them
+heavy_modules = ['numpy', 'pandas', 'fitz', 'pymupdf', 'PIL', 'skimage', 'scipy', 'copydetect', 'parmap', 'tqdm']
+
+_words = ('image signal filter sample matrix vector kernel window noise frequency phase response system '
+          'input output result error value model layer network weight gradient loss train test data set '
+          'report figure table equation method analysis experiment measure compare function variable').split()
+
+
+def _smooth_image(rng, height: int, width: int):
+    # Upsampled random grid, closer to a photo or a plot than white noise
+    grid = (rng.random((max(2, height // 16), max(2, width // 16), 3)) * 255).astype(np.uint8)
+    return np.asarray(Image.fromarray(grid).resize((width, height), Image.BICUBIC))
+
+
+def _near_duplicate(rng, image: np.ndarray):
+    noise = rng.integers(-4, 5, size=image.shape)
+    return np.clip(image.astype(np.int16) + noise, 0, 255).astype(np.uint8)
+
+
+def _write_pdf(path: str, images: list):
+    pdf = fitz.open()
+    for image in images:
+        page = pdf.new_page()
+        buf = io.BytesIO()
+        Image.fromarray(image).save(buf, format='PNG')
+        page.insert_image(fitz.Rect(36, 36, 36 + image.shape[1], 36 + image.shape[0]), stream=buf.getvalue())
+    pdf.save(path)
+    pdf.close()
+
+
+def _write_code(path: str, rng, names: list):
+    lines = ['#include <stdio.h>', '']
+    for f in range(4):
+        a, b, c = (names[i] for i in rng.choice(len(names), 3, replace=False))
+        lines += [f'int {a}_{f}(int {b}, int {c}) {{',
+                  f'    int {a} = {int(rng.integers(1, 100))};',
+                  f'    for (int i = 0; i < {b}; i++) {{',
+                  f'        {a} += {c} * i % {int(rng.integers(2, 9))};',
+                  f'        if ({a} > {int(rng.integers(100, 1000))}) {{ {a} -= {b}; }}',
+                  '    }',
+                  f'    return {a};',
+                  '}', '']
+    lines += ['int main() {', f'    printf("%d", {a}_0(10, 3));', '    return 0;', '}']
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def _write_text(path: str, rng, words: int = 400):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(' '.join(rng.choice(_words, words)) + '\n')
+
+
+def make_corpus(root: str, students: int, references: int, images: int = 4, seed: int = 0):
+    '''
+    Generate submission and reference trees with planted similarities.
+    Every document holds a shared logo, a blank dummy image and unique images. A quarter of the students copy a
+    reference image, a quarter copy an image of the previous student with noise, and every third student copies
+    the code and the text of the previous student.
+    Args:
+        root: Directory receiving submission/ and reference/
+        students: Number of students
+        references: Number of references
+        images: Number of unique images per document
+        seed: Seed of the generated content
+    Returns:
+        (submission directory, reference directory)
+    '''
+    rng = np.random.default_rng(seed)
+    logo = _smooth_image(rng, 48, 48)
+    blank = np.full((64, 64, 3), 255, dtype=np.uint8)
+    names = [''.join(rng.choice(list('abcdefghijklmnopqrstuvwxyz'), 6)) for _ in range(32)]
+
+    reference_images = []
+    previous = None
+    for kind, count in (('reference', references), ('submission', students)):
+        for i in range(count):
+            entity_dir = os.path.join(root, kind, f'{kind[:3]}{i:05d}')
+            os.makedirs(entity_dir, exist_ok=True)
+            own = [_smooth_image(rng, int(rng.integers(96, 160)), int(rng.integers(96, 160))) for _ in range(images)]
+            if kind == 'reference':
+                reference_images.append(own[0])
+            elif i % 4 == 1 and len(reference_images) > 0:
+                own[-1] = _near_duplicate(rng, reference_images[i % len(reference_images)])
+            elif i % 4 == 2 and previous is not None:
+                own[-1] = _near_duplicate(rng, previous[0])
+            _write_pdf(os.path.join(entity_dir, 'report.pdf'), [logo, blank] + own)
+
+            code_path = os.path.join(entity_dir, 'main.cpp')
+            text_path = os.path.join(entity_dir, 'notes.txt')
+            if kind == 'submission' and i % 3 == 0 and previous is not None:
+                # Clone of the previous student, copydetect normalizes the names anyway
+                shutil.copyfile(previous[1], code_path)
+                shutil.copyfile(previous[2], text_path)
+            else:
+                _write_code(code_path, rng, names)
+                _write_text(text_path, rng)
+            previous = (own[0], code_path, text_path)
+    return os.path.join(root, 'submission'), os.path.join(root, 'reference')
+
+
+def measure(stage, repeat: int = 1):
+    '''
+    Run a stage repeat times for the time and once more under tracemalloc for the peak memory.
+    The peak only covers the allocations of this process, not of the worker processes.
+    Args:
+        stage: Function returning (number of processed items, result)
+        repeat: Number of timed runs, the fastest is kept
+    Returns:
+        (seconds, items, peak memory in MB, result of the last run)
+    '''
+    seconds = math.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        items, result = stage()
+        seconds = min(seconds, time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        items, result = stage()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return seconds, items, peak / (1 << 20), result
+
+
+def _compare_images(sub_dirs: list, ref_dirs: list, fingerprints: dict, store_dir: str, processes: int = 1,
+                    hash_distance: int = 10, tile_size: int = 32):
+    # Prefiltered comparison like main.compare_files
+    hashes = hash_directories(sub_dirs + ref_dirs, fingerprints)
+    results = []
+    compared = 0
+    groups = [(find_candidates(hashes, sub_dirs, sub_dirs, hash_distance), False, sub_dirs),
+              (find_candidates(hashes, sub_dirs, ref_dirs, hash_distance), True, ref_dirs)]
+    store = ImageStore(store_dir)
+    store.build([os.path.join(d, name) for d in sorted({d for candidates, _, _ in groups for k in candidates for d in k})
+                 for name in os.listdir(d)], processes=processes)
+    for candidates, reference, dirs_b in groups:
+        tiles = group_tiles(candidates, sub_dirs, dirs_b, tile_size)
+        tasks = ([(a, b, reference, candidates[(a, b)]) for a, b in tile] for tile in tiles)
+        task_cost = lambda tile: sum(len(args[3]) for args in tile)
+        total = sum(len(pairs) for pairs in candidates.values())
+        chunks = cost_chunks(tasks, task_cost, max(1, total // (max(1, processes) * 16)))
+        for chunk_results, _ in imap_chunks(compare_image_chunk, chunks, processes=processes, store=store):
+            results += [(result, reference) for result in chunk_results if result is not None]
+        compared += total
+    return compared, results
+
+
+def run_size(root: str, students: int, references: int, images: int, processes: int = 1, repeat: int = 1):
+    '''
+    Benchmark every stage on a generated corpus.
+    Returns:
+        List of {'students', 'stage', 'items', 'seconds', 'throughput', 'peak_mb'}
+    '''
+    # Imported as a module, main() of this script would shadow it
+    import main
+
+    submission_dir, reference_dir = make_corpus(os.path.join(root, 'corpus'), students, references, images)
+    buffer_root = os.path.join(root, 'buffer')
+    rows = []
+
+    def record(stage, func):
+        seconds, items, peak_mb, result = measure(func, repeat)
+        rows.append({'students': students, 'stage': stage, 'items': items, 'seconds': seconds,
+                     'throughput': items / seconds if seconds > 0 else None, 'peak_mb': peak_mb})
+        print(f'{students:>6} students  {stage:<16} {items:>8} items  {seconds:9.3f} s  {peak_mb:9.1f} MB')
+        return result
+
+    def parse():
+        database = common.DB()
+        count = main.parse_filenames(submission_dir, ['pdf'], ['cpp'], ['txt'], database)
+        count += main.parse_filenames(reference_dir, ['pdf'], ['cpp'], ['txt'], database, is_reference=True)
+        return count, database
+    database = record('parse_filenames', parse)
+
+    docs = [(d, False) for s in database.students.values() for d in s.doc_names]
+    docs += [(d, True) for r in database.references.values() for d in r.doc_names]
+
+    def extract():
+        shutil.rmtree(buffer_root, ignore_errors=True)
+        fingerprints = {}
+        for doc_path, is_reference in docs:
+            fingerprints.update(extract_image(doc_path, is_reference, dummy_thumbnail=256, output_root=buffer_root)[0])
+        return len(docs), fingerprints
+    fingerprints = record('extraction', extract)
+
+    # Decoded outside of the timed stage, the dummy filter alone is measured
+    decoded = []
+    for doc_path, _ in docs:
+        for _, image_bytes in _iter_image_bytes(doc_path, []):
+            image = Image.open(io.BytesIO(image_bytes))
+            image.load()
+            decoded.append(image)
+    record('dummy_filter', lambda: (len(decoded), sum(is_dummy(image, 0.95, 256) for image in decoded)))
+    del decoded
+
+    sub_dirs = [os.path.join(buffer_root, s) for s in database.students if os.path.isdir(os.path.join(buffer_root, s))]
+    ref_dirs = [os.path.join(buffer_root, 'ref_' + r) for r in database.references if os.path.isdir(os.path.join(buffer_root, 'ref_' + r))]
+    image_results = record('compare_image', lambda: _compare_images(sub_dirs, ref_dirs, fingerprints, os.path.join(root, 'store'), processes))
+
+    code_entities = [(s.id, False, s.code_names) for s in database.students.values()]
+    code_entities += [('ref_' + r.id, True, r.code_names) for r in database.references.values()]
+    code_results = record('compare_code', lambda: (sum(len(e[2]) for e in code_entities),
+                                                   compare_code(code_entities, max_df=0.5, processes=processes)))
+
+    text_entities = [(s.id, False, s.doc_names + s.etc_names) for s in database.students.values()]
+    text_entities += [('ref_' + r.id, True, r.doc_names + r.etc_names) for r in database.references.values()]
+    text_results = record('compare_text', lambda: (sum(len(e[2]) for e in text_entities),
+                                                   compare_text(text_entities, processes=processes)))
+
+    def export():
+        database = common.DB()
+        for result, reference in image_results:
+            database.add_connection(*result, reference=reference)
+        for kind, results in (('code', code_results), ('text', text_results)):
+            for student_id_a, student_id_b, similarity, reference in results:
+                database.add_connection(student_id_a, student_id_b, similarity, reference=reference, kind=kind)
+        for kind in ('image', 'code', 'text'):
+            database.get_connections(kind).export(os.path.join(root, f'{kind}_result'))
+            database.get_connections(kind, top_k=10, threshold=0.9).export(os.path.join(root, f'{kind}_top'))
+        return len(image_results) + len(code_results) + len(text_results), None
+    record('export', export)
+    return rows
+
+
+def measure_startup(repeat: int = 5):
+    '''
+    Time fresh interpreters importing the entry point and running its --help.
+    Returns:
+        (rows like run_size with 0 students, heavy modules loaded by importing the entry point)
+    '''
+    src_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+    probe = (f'import sys; sys.path.insert(0, {src_dir!r}); import main; '
+             f'print(",".join(m for m in {heavy_modules!r} if m in sys.modules))')
+    commands = [('startup.python', [sys.executable, '-c', 'pass']),
+                ('startup.import', [sys.executable, '-c', probe]),
+                ('startup.help', [sys.executable, os.path.join(src_dir, 'main.py'), '--help'])]
+    rows = []
+    loaded = []
+    for stage, command in commands:
+        seconds = math.inf
+        for _ in range(repeat):
+            start = time.perf_counter()
+            output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+            seconds = min(seconds, time.perf_counter() - start)
+        if stage == 'startup.import':
+            loaded = [m for m in output.strip().split(',') if m]
+        rows.append({'students': 0, 'stage': stage, 'items': 1, 'seconds': seconds, 'throughput': 1 / seconds, 'peak_mb': None})
+        print(f'{stage:<16} {seconds:9.3f} s')
+    return rows, loaded
+
+
+def scaling(rows: list):
+    '''
+    Estimate the exponent of each stage, seconds ~ students^exponent, by a least squares fit in log-log space.
+    Returns:
+        {stage: exponent}, stages measured at fewer than two sizes are left out
+    '''
+    exponents = {}
+    for stage in dict.fromkeys(row['stage'] for row in rows):
+        points = [(math.log(row['students']), math.log(row['seconds'])) for row in rows if row['stage'] == stage and row['students'] > 0 and row['seconds'] > 0]
+        if len({x for x, _ in points}) < 2:
+            continue
+        x, y = np.array(points).T
+        exponents[stage] = float(np.polyfit(x, y, 1)[0])
+    return exponents
+
+
+def compare_runs(current: dict, baseline: dict, tolerance: float = 0.2):
+    '''
+    Compare the stage times with a previous run.
+    Args:
+        current: Results of this run
+        baseline: Results of the previous run, as saved by this script
+        tolerance: Slowdown ratio above which a stage is a regression
+    Returns:
+        List of (students, stage, previous seconds, current seconds, ratio, regression)
+    '''
+    if baseline.get('version') != current['version']:
+        print(f'Baseline version {baseline.get("version")} differs from {current["version"]}, the times are not comparable')
+        return []
+    previous = {(row['students'], row['stage']): row for row in baseline['results']}
+    comparison = []
+    for row in current['results']:
+        old = previous.get((row['students'], row['stage']))
+        if old is None or old['seconds'] <= 0:
+            continue
+        ratio = row['seconds'] / old['seconds']
+        comparison.append((row['students'], row['stage'], old['seconds'], row['seconds'], ratio, ratio > 1 + tolerance))
+    return comparison
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Benchmark the stages of the plagiarism finder on synthetic corpora')
+    parser.add_argument('--sizes', dest='sizes', type=str, default='8,16,32', help='Comma separated numbers of students')
+    parser.add_argument('--references', dest='references', type=float, default=0.5, help='Number of references per student')
+    parser.add_argument('--images', dest='images', type=int, default=4, help='Number of unique images per document')
+    parser.add_argument('--p', dest='p', type=int, default=1, help='Number of processes of the comparison stages')
+    parser.add_argument('--repeat', dest='repeat', type=int, default=1, help='Number of timed runs per stage, the fastest is kept')
+    parser.add_argument('--output', dest='output', type=str, default=None, help='Path of the JSON results, benchmark.json if None, only written with --startup-only if given')
+    parser.add_argument('--baseline', dest='baseline', type=str, default=None, help='JSON results of a previous run to compare with')
+    parser.add_argument('--tolerance', dest='tolerance', type=float, default=0.2, help='Slowdown ratio reported as a regression')
+    parser.add_argument('--work-dir', dest='work_dir', type=str, default=None, help='Directory of the generated corpora, a temporary directory if None')
+    parser.add_argument('--startup-budget', dest='startup_budget', type=float, default=0.5, help='Maximum seconds to import the entry point or print its --help')
+    parser.add_argument('--startup-only', dest='startup_only', action='store_true', help='Only check the startup time, no corpus is generated')
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    sizes = [int(size) for size in args.sizes.split(',')]
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='plagiarism-benchmark-')
+
+    # The startup is checked against its budget on every run
+    rows, loaded = measure_startup(max(3, args.repeat))
+    failures = [f'{row["stage"]} took {row["seconds"]:.3f} s, over the budget of {args.startup_budget} s'
+                for row in rows if row['stage'] != 'startup.python' and row['seconds'] > args.startup_budget]
+    if len(loaded) > 0:
+        failures.append(f'importing the entry point loaded {", ".join(loaded)}')
+    if args.startup_only:
+        sizes = []
+
+    try:
+        for students in sizes:
+            root = os.path.join(work_dir, str(students))
+            shutil.rmtree(root, ignore_errors=True)
+            rows += run_size(root, students, max(1, int(students * args.references)), args.images, args.p, args.repeat)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    exponents = scaling(rows)
+    for stage, exponent in exponents.items():
+        print(f'{stage:<16} time ~ students^{exponent:.2f}')
+
+    results = {'version': benchmark_version,
+               'created': datetime.now(timezone.utc).isoformat(),
+               'python': platform.python_version(),
+               'platform': platform.platform(),
+               'processes': args.p,
+               'repeat': args.repeat,
+               'results': rows,
+               'scaling': exponents,
+               'startup_budget': args.startup_budget}
+    # A startup check does not overwrite the baseline of the full runs
+    if args.output is not None or not args.startup_only:
+        output = args.output or 'benchmark.json'
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        print(f'Saved {output}')
+
+    for failure in failures:
+        print(f'STARTUP REGRESSION: {failure}')
+
+    regressions = len(failures)
+    if args.baseline is not None:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        for students, stage, old, new, ratio, regression in compare_runs(results, baseline, args.tolerance):
+            print(f'{students:>6} students  {stage:<16} {old:9.3f} s -> {new:9.3f} s  x{ratio:.2f}{"  REGRESSION" if regression else ""}')
+            regressions += regression
+    return 1 if regressions > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
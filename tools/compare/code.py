@@ -1,16 +1,250 @@
 # Copydetect by Bryson Lingenfelter(@blingenf)
 # https://github.com/blingenf/copydetect
 #
-# Path: tools/compare/text.py
+# Path: tools/compare/code.py
 # Author: Jiwoon Lee
-# Last Modified: 2024-04-02
-# Description: This script compares the submission texts with the reference texts and saves the result in the output directory.
+# Last Modified: 2026-10-18
+# Description: This script compares the submission codes with each other and with the reference codes using winnowing fingerprints.
 # License: MIT License
 #
 # Disclaimer
 # This program is provided as is without any guarantees or warranty. In no event shall the authors be liable for any damages or losses arising from the use of this program.
 # This program does not guarantee the correctness of the comparison results. Please check the results manually.
 
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-import copydetect
+import numpy as np
+from copydetect.utils import filter_code
+from parmap import parmap
 
+from src.common import code_languages
+from tools import instrument
+from tools.schedule import cost_chunks, imap_chunks
+
+# Odd base of the k-gram rolling hash, its inverse exists modulo 2^64
+_base = 0x100000001B3
+_base_inverse = pow(_base, -1, 1 << 64)
+
+
+def hashed_kgrams(doc: str, k: int):
+    '''
+    Hash every k-gram (in utf-8 bytes) of the document with a rolling hash.
+    Unlike hash(), the values are stable across processes and runs.
+    Args:
+        doc: Filtered code
+        k: Size of the k-grams
+    Returns:
+        int64 array of len(doc) - k + 1 hashes
+    '''
+    data = np.frombuffer(doc.encode('utf-8'), dtype=np.uint8).astype(np.uint64)
+    n = len(data)
+    if n < k:
+        return np.array([], dtype=np.int64)
+
+    # window hash = sum(data[i + t] * base^t), computed from prefix sums of data[j] * base^j
+    powers = np.ones(n, dtype=np.uint64)
+    powers[1:] = np.cumprod(np.full(n - 1, _base, dtype=np.uint64))
+    inverses = np.ones(n - k + 1, dtype=np.uint64)
+    inverses[1:] = np.cumprod(np.full(n - k, _base_inverse, dtype=np.uint64))
+    prefix = np.zeros(n + 1, dtype=np.uint64)
+    np.cumsum(data * powers, out=prefix[1:])
+    hashes = (prefix[k:] - prefix[:-k]) * inverses
+
+    # Mix the bits so the minimum of a window is not biased to the first bytes
+    hashes ^= hashes >> np.uint64(31)
+    hashes *= np.uint64(0x9E3779B97F4A7C15)
+    hashes ^= hashes >> np.uint64(29)
+    return hashes.view(np.int64)
+
+
+def winnow(hashes: np.ndarray, window_size: int):
+    '''
+    Select the minimum hash of every window of window_size hashes.
+    Returns:
+        Unique selected hashes
+    '''
+    if window_size <= 1:
+        return np.unique(hashes)
+    if len(hashes) <= window_size:
+        return hashes[[hashes.argmin()]] if len(hashes) > 0 else hashes
+    windows = np.lib.stride_tricks.sliding_window_view(hashes, window_size)
+    selected = windows.argmin(axis=1) + np.arange(len(windows))
+    return np.unique(hashes[selected])
+
+
+def code_fingerprints(code_path: str, k: int = 25, window_size: int = 6):
+    '''
+    Tokenize a code file and compute its winnowing fingerprints.
+    Variable, function and object names and strings are normalized by copydetect, comments and whitespace are dropped.
+    Args:
+        code_path: Path of the code file
+        k: Size of the k-grams, shorter matches are ignored
+        window_size: Size of the winnowing window, matches of k + window_size - 1 are always detected
+    Returns:
+        Unique int64 fingerprints, empty if the file cannot be tokenized
+    '''
+    extension = os.path.splitext(code_path)[1][1:].lower()
+    language = code_languages.get(extension)
+    if language is None:
+        return np.array([], dtype=np.int64)
+
+    with open(code_path, 'r', encoding='utf-8', errors='ignore') as f:
+        code = f.read()
+    instrument.count('bytes_read', len(code))
+    with instrument.timer('code.tokenize'):
+        filtered, _ = filter_code(code, code_path, language)
+    with instrument.timer('code.winnow'):
+        return winnow(hashed_kgrams(filtered, k), window_size)
+
+
+class CodeIndex:
+    '''
+    Inverted index from fingerprint to the code files containing it.
+    '''
+    def __init__(self):
+        self.files = []         # (entity_id, is_reference, code_path)
+        self.sizes = []         # Number of fingerprints of each file
+        self.postings = {}      # Key: fingerprint, Value: list of file indices
+
+    def add(self, entity_id: str, is_reference: bool, code_path: str, fingerprints: np.ndarray):
+        file_idx = len(self.files)
+        self.files.append((entity_id, is_reference, code_path))
+        self.sizes.append(len(fingerprints))
+        for fingerprint in fingerprints.tolist():
+            self.postings.setdefault(fingerprint, []).append(file_idx)
+
+    def max_entities(self, max_df: float = 1.0, external_entities: int = 0):
+        # Fingerprints held by more entities are boilerplate
+        num_entities = len({(entity_id, is_reference) for entity_id, is_reference, _ in self.files}) + external_entities
+        return max(2, int(max_df * num_entities))
+
+    def candidates(self, max_df: float = 1.0, external_entities: int = 0, external_df: dict = None):
+        '''
+        Count the shared fingerprints of every file pair that shares at least one.
+        Args:
+            max_df: Fingerprints found in more than this ratio of the entities are boilerplate and ignored
+            external_entities: Number of entities outside the index counted in the ratio, the references of a ReferenceIndex
+            external_df: {fingerprint: number of the external entities holding it}
+        Returns:
+            ({(file_idx_a, file_idx_b): shared}, file_idx_a < file_idx_b,
+            number of fingerprints of each file left after dropping the boilerplate, set of the boilerplate fingerprints)
+        '''
+        max_entities = self.max_entities(max_df, external_entities)
+        external_df = external_df or {}
+        sizes = list(self.sizes)
+        boilerplate = set()
+        shared = {}
+        for fingerprint, files in self.postings.items():
+            if len({self.files[f][:2] for f in files}) + external_df.get(fingerprint, 0) > max_entities:
+                boilerplate.add(fingerprint)
+                for f in files:
+                    sizes[f] -= 1
+                continue
+            if len(files) < 2:
+                continue
+            for i, file_a in enumerate(files):
+                for file_b in files[i + 1:]:
+                    entity_a, ref_a, _ = self.files[file_a]
+                    entity_b, ref_b, _ = self.files[file_b]
+                    # Files of the same entity and reference-reference pairs are not compared
+                    if (entity_a, ref_a) == (entity_b, ref_b) or (ref_a and ref_b):
+                        continue
+                    shared[(file_a, file_b)] = shared.get((file_a, file_b), 0) + 1
+        return shared, sizes, boilerplate
+
+
+def fingerprints_chunk(chunk, k: int = 25, window_size: int = 6):
+    # Chunk of code paths scheduled by tools.schedule
+    return [(path, code_fingerprints(path, k, window_size)) for path in chunk]
+
+
+def fingerprint_files(paths: list, k: int = 25, window_size: int = 6, processes: int = 1, cache: dict = None, executor=None):
+    '''
+    Compute the fingerprints of the code files, the files in the cache are not read again.
+    Args:
+        paths: Paths of the code files
+        k: Passed to code_fingerprints
+        window_size: Passed to code_fingerprints
+        processes: Number of processes computing the fingerprints
+        cache: {path: fingerprints} of unchanged files, updated with the new files
+        executor: Pool kept by the caller, passed to imap_chunks instead of forking new processes
+    Returns:
+        Fingerprints of every path, in order
+    '''
+    cache = {} if cache is None else cache
+    missing = [path for path in dict.fromkeys(paths) if path not in cache]
+    instrument.count('code_cache_hits', len(paths) - len(missing))
+    if processes > 1 and len(missing) > 1 and executor is not None:
+        chunks = cost_chunks(missing, lambda path: 1, max(1, len(missing) // (processes * 16)))
+        for results, _ in imap_chunks(fingerprints_chunk, chunks, processes=processes, executor=executor, k=k, window_size=window_size):
+            cache.update(results)
+    elif processes > 1 and len(missing) > 1:
+        cache.update(zip(missing, instrument.collect(parmap.map(instrument.traced, missing, code_fingerprints, k, window_size,
+                                                                pm_pbar=True, pm_processes=processes))))
+    else:
+        cache.update((path, code_fingerprints(path, k, window_size)) for path in missing)
+    return [cache[path] for path in paths]
+
+
+def compare_code(entities: list, k: int = 25, window_size: int = 6, max_df: float = 1.0, processes: int = 1,
+                 changed: set = None, cache: dict = None, reference_index=None, executor=None, boilerplate: set = None):
+    '''
+    Compare the code files of the students with each other and with the references.
+    Args:
+        entities: (entity_id, is_reference, code_paths) of the students and references
+        k: Passed to code_fingerprints
+        window_size: Passed to code_fingerprints
+        max_df: Passed to CodeIndex.candidates
+        processes: Number of processes computing the fingerprints
+        changed: Only the pairs involving these entities are returned, every pair if None
+        cache: {path: fingerprints} of unchanged files, updated with the new files
+        reference_index: ReferenceIndex whose references are counted in the max_df cut like the entities
+        executor: Passed to fingerprint_files
+        boilerplate: Boilerplate fingerprints of the previous run, replaced in place by those of this run.
+            The similarities depend on them, every pair is returned if they changed, whatever changed
+    Returns:
+        List of (entity_id_a, entity_id_b, similarity_values, reference) for DB.add_connection,
+        similarity_values is [(min, max, avg)] of the file pair similarities
+    '''
+    files = [(entity_id, is_reference, path) for entity_id, is_reference, paths in entities for path in paths]
+    fingerprints = fingerprint_files([path for _, _, path in files], k, window_size, processes, cache, executor)
+
+    index = CodeIndex()
+    for (entity_id, is_reference, path), f in zip(files, fingerprints):
+        index.add(entity_id, is_reference, path, f)
+
+    # Similarity of a file pair is the shared ratio of the smaller file, both without the boilerplate
+    similarities = {}
+    external_entities, external_df = 0, None
+    if reference_index is not None:
+        fingerprints = np.fromiter(index.postings, dtype=np.int64, count=len(index.postings))
+        external_entities = reference_index.code_entities
+        external_df = dict(zip(fingerprints.tolist(), reference_index.code_df(fingerprints).tolist()))
+    candidates, sizes, dropped = index.candidates(max_df, external_entities, external_df)
+    if reference_index is not None:
+        # The fingerprints of the index references above the cut are dropped from their files too
+        dropped |= set(reference_index.common_code(index.max_entities(max_df, external_entities)).tolist())
+    if boilerplate is not None:
+        if changed is not None and dropped != boilerplate:
+            instrument.count('code_boilerplate_changed')
+            changed = None
+        boilerplate.clear()
+        boilerplate.update(dropped)
+    for (file_a, file_b), shared in candidates.items():
+        # Keep the submission first, so a reference is always entity b, and order the student pairs
+        if index.files[file_a][1] or (not index.files[file_b][1] and index.files[file_a][0] > index.files[file_b][0]):
+            file_a, file_b = file_b, file_a
+        entity_a = index.files[file_a][:2]
+        entity_b = index.files[file_b][:2]
+        # The other pairs are kept from the previous run
+        if changed is not None and entity_a[0] not in changed and entity_b[0] not in changed:
+            continue
+        similarity = shared / max(1, min(sizes[file_a], sizes[file_b]))
+        similarities.setdefault((entity_a, entity_b), []).append(similarity)
+
+    results = []
+    for ((entity_a, _), (entity_b, ref_b)), values in similarities.items():
+        avg = len(values) / sum(1 / v for v in values)     # Harmonic mean like the images
+        results.append((entity_a, entity_b, [(min(values), max(values), avg)], ref_b))
+    return results
@@ -0,0 +1,256 @@
+# Path: tools/compare/features.py
+# Author: Jiwoon Lee
+# Last Modified: 2026-10-18
+# Description: This script matches the extracted images by ORB keypoints, so rotated, flipped, scaled and cropped copies are found.
+# License: MIT License
+#
+# Disclaimer
+# This program is provided as is without any guarantees or warranty. In no event shall the authors be liable for any damages or losses arising from the use of this program.
+# This program does not guarantee the correctness of the comparison results. Please check the results manually.
+
+import os
+
+import numpy as np
+from PIL import Image
+from skimage.feature import ORB, match_descriptors
+from skimage.measure import ransac
+from skimage.transform import SimilarityTransform
+
+from tools import instrument
+from tools.schedule import cost_chunks, imap_chunks
+
+# Longest side of the images the keypoints are detected on, small figures are upscaled so ORB finds keypoints
+feature_size = 256
+
+# Bit-sampling LSH over the 256-bit descriptors, descriptors agreeing on the sampled bits of a table share a bucket
+lsh_tables = 8
+lsh_bits = 24
+_lsh_positions = np.random.default_rng(0x0B5).permuted(np.tile(np.arange(256), (lsh_tables, 1)), axis=1)[:, :lsh_bits]
+_lsh_weights = np.uint64(1) << np.arange(lsh_bits, dtype=np.uint64)
+
+
+def _empty_features():
+    return np.zeros((0, 2), dtype=np.float32), np.zeros((0, 32), dtype=np.uint8), np.zeros(0, dtype=bool)
+
+
+def orb_features(image_path: str, n_keypoints: int = 200):
+    '''
+    Detect the ORB keypoints of an image and of its mirror image, ORB itself is rotation invariant but not flip invariant.
+    Args:
+        image_path: Path of the image
+        n_keypoints: Maximum number of keypoints per orientation
+    Returns:
+        (keypoints, descriptors, mirrored): (n, 2) float32 (row, col) in the resized image or its mirror,
+        (n, 32) uint8 packed descriptors, (n,) bool whether the keypoint was found on the mirror image
+    '''
+    instrument.count('bytes_read', os.path.getsize(image_path))
+    with Image.open(image_path) as image:
+        image = image.convert('L')
+        scale = feature_size / max(image.size)
+        image = image.resize((max(1, round(image.size[0] * scale)), max(1, round(image.size[1] * scale))), Image.BILINEAR)
+        pixels = np.asarray(image, dtype=np.float64) / 255
+
+    keypoints, descriptors, mirrored = [], [], []
+    with instrument.timer('features.orb'):
+        for mirror in (False, True):
+            orb = ORB(n_keypoints=n_keypoints, fast_threshold=0.05)
+            try:
+                orb.detect_and_extract(pixels[:, ::-1] if mirror else pixels)
+            except (RuntimeError, ValueError, IndexError):
+                # Too small or too flat to have keypoints
+                continue
+            keypoints.append(orb.keypoints.astype(np.float32))
+            descriptors.append(np.packbits(orb.descriptors, axis=1))
+            mirrored.append(np.full(len(orb.keypoints), mirror))
+    if len(keypoints) == 0:
+        return _empty_features()
+    return np.concatenate(keypoints), np.concatenate(descriptors), np.concatenate(mirrored)
+
+
+def features_chunk(chunk, n_keypoints: int = 200):
+    # Chunk of image paths scheduled by tools.schedule
+    return [(image_path, orb_features(image_path, n_keypoints)) for image_path in chunk]
+
+
+def verify(features_a: tuple, features_b: tuple, min_inliers: int = 12, max_ratio: float = 0.8):
+    '''
+    Match the descriptors of two images and count the matches agreeing on one rotation, scale and translation.
+    The upright keypoints of image a are matched with the upright and with the mirrored keypoints of image b.
+    Args:
+        features_a: Output of orb_features
+        features_b: Output of orb_features
+        min_inliers: Fewer geometrically consistent matches are not a match
+        max_ratio: Lowe's ratio of the distances to the best and second best descriptors
+    Returns:
+        (inliers, similarity), similarity is the inlier ratio of the image with fewer keypoints, 0 if not a match
+    '''
+    keypoints_a, descriptors_a, mirrored_a = features_a
+    keypoints_b, descriptors_b, mirrored_b = features_b
+    upright = ~mirrored_a
+    keypoints_a = keypoints_a[upright]
+    descriptors_a = np.unpackbits(descriptors_a[upright], axis=1).astype(bool)
+    best = 0
+    for mirror in (False, True):
+        side = mirrored_b == mirror
+        if upright.sum() < min_inliers or side.sum() < min_inliers:
+            continue
+        with instrument.timer('features.match'):
+            matches = match_descriptors(descriptors_a, np.unpackbits(descriptors_b[side], axis=1).astype(bool),
+                                        metric='hamming', cross_check=True, max_ratio=max_ratio)
+        if len(matches) < min_inliers:
+            continue
+        # (x, y) of the matched keypoints of b mapped onto those of a
+        source = keypoints_b[side][matches[:, 1]][:, ::-1]
+        target = keypoints_a[matches[:, 0]][:, ::-1]
+        with instrument.timer('features.ransac'):
+            _, inliers = ransac((source, target), SimilarityTransform, min_samples=3, residual_threshold=feature_size / 64,
+                                max_trials=200, rng=0)
+        if inliers is not None:
+            best = max(best, int(inliers.sum()))
+    if best < min_inliers:
+        return best, 0.0
+    return best, min(1.0, float(best / min(upright.sum(), (~mirrored_b).sum())))
+
+
+def verify_chunk(chunk, min_inliers: int = 12):
+    # Chunk of (key_a, features_a, key_b, features_b) scheduled by tools.schedule
+    instrument.count('feature_pairs_verified', len(chunk))
+    return [(key_a, key_b, *verify(features_a, features_b, min_inliers)) for key_a, features_a, key_b, features_b in chunk]
+
+
+def lsh_keys(descriptors: np.ndarray):
+    # (lsh_tables, n) bucket keys of the packed descriptors
+    bits = np.unpackbits(descriptors, axis=1)
+    keys = np.empty((lsh_tables, len(descriptors)), dtype=np.uint64)
+    for table, positions in enumerate(_lsh_positions):
+        keys[table] = (bits[:, positions].astype(np.uint64) * _lsh_weights).sum(axis=1)
+    return keys
+
+
+def lsh_candidates(descriptors: np.ndarray, owners: np.ndarray, min_votes: int = 5, max_bucket: int = 256):
+    '''
+    Find the image pairs sharing descriptors that agree on the sampled bits of a table.
+    Args:
+        descriptors: (n, 32) uint8 packed descriptors of every image
+        owners: (n,) image index of each descriptor
+        min_votes: Minimum number of colliding descriptor pairs of a candidate image pair
+        max_bucket: Buckets holding more descriptors are ignored, they are textures shared by many images
+    Returns:
+        {(image_a, image_b): votes}, image_a < image_b
+    '''
+    if len(descriptors) == 0:
+        return {}
+    collisions = []
+    for keys in lsh_keys(descriptors):
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        # Each descriptor is paired with the following descriptors of its bucket
+        start = np.searchsorted(keys, keys, side='left')
+        end = np.searchsorted(keys, keys, side='right')
+        small = (end - start) <= max_bucket
+        first = np.flatnonzero(small)
+        counts = end[first] - first - 1
+        pairs_a = np.repeat(first, counts)
+        pairs_b = np.repeat(first + 1 - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        collisions.append(np.stack([order[pairs_a], order[pairs_b]]))
+    collisions = np.concatenate(collisions, axis=1)
+    collisions = np.unique(np.sort(collisions, axis=0), axis=1)
+
+    image_pairs = np.sort(owners[collisions], axis=0)
+    image_pairs = image_pairs[:, image_pairs[0] != image_pairs[1]]
+    if image_pairs.shape[1] == 0:
+        return {}
+    image_pairs, votes = np.unique(image_pairs, axis=1, return_counts=True)
+    keep = votes >= min_votes
+    return dict(zip(map(tuple, image_pairs[:, keep].T.tolist()), votes[keep].tolist()))
+
+
+def compare_features(sub_dirs: list, ref_dirs: list, boilerplate: set = None, n_keypoints: int = 200, min_inliers: int = 12,
+                     processes: int = 1, changed: set = None, cache: dict = None, executor=None, deadline: float = None,
+                     reference_index=None):
+    '''
+    Compare the images of the students with each other and with the references by their keypoints.
+    The descriptors of every image are computed once, only the image pairs sharing descriptors in the LSH index are verified.
+    Args:
+        sub_dirs: Image directories of the students
+        ref_dirs: Image directories of the references
+        boilerplate: Names of the images that are not compared
+        reference_index: ReferenceIndex holding the descriptors of more references, looked up instead of listing its images
+        n_keypoints: Passed to orb_features
+        min_inliers: Passed to verify
+        processes: Number of processes computing the features and verifying the pairs
+        changed: Only the pairs involving these students and references are verified, every pair if None
+        cache: {image_path: features} of unchanged images, updated with the new images
+        executor: Pool kept by the caller, passed to imap_chunks
+        deadline: time.monotonic() after which no pair is verified, passed to imap_chunks
+    Returns:
+        List of (student_id_a, student_id_b, similarity_values, reference) for DB.add_connection,
+        similarity_values is [(min, max, avg)] of the similarities of the matching image pairs,
+        and whether every candidate pair was verified before the deadline
+    '''
+    boilerplate = boilerplate or set()
+    cache = {} if cache is None else cache
+    images = [(d, name) for d in sub_dirs + ref_dirs for name in sorted(os.listdir(d)) if name not in boilerplate]
+    missing = [os.path.join(d, name) for d, name in images if os.path.join(d, name) not in cache]
+    instrument.count('feature_cache_hits', len(images) - len(missing))
+    chunks = cost_chunks(missing, lambda path: 1, max(1, len(missing) // (max(1, processes) * 16)))
+    for results, _ in imap_chunks(features_chunk, chunks, processes=processes, executor=executor, n_keypoints=n_keypoints):
+        cache.update(results)
+    features = [cache[os.path.join(d, name)] for d, name in images]
+
+    # Candidate image pairs from the descriptor index
+    descriptors = np.concatenate([f[1] for f in features] + [np.zeros((0, 32), dtype=np.uint8)])
+    owners = np.repeat(np.arange(len(images)), [len(f[1]) for f in features])
+    with instrument.timer('features.lsh'):
+        candidates = lsh_candidates(descriptors, owners)
+
+    # Keep the submission first, so a reference is always entity b, and order the student pairs
+    order = {d: i for i, d in enumerate(sub_dirs)}
+    is_reference = {d: d not in order for d in sub_dirs + ref_dirs}
+    scored = []
+    for idx_a, idx_b in candidates:
+        (dir_a, name_a), (dir_b, name_b) = images[idx_a], images[idx_b]
+        if dir_a == dir_b or (is_reference[dir_a] and is_reference[dir_b]):
+            continue
+        if is_reference[dir_a] or (not is_reference[dir_b] and order[dir_a] > order[dir_b]):
+            idx_a, idx_b = idx_b, idx_a
+        entity_a, entity_b = os.path.basename(images[idx_a][0]), os.path.basename(images[idx_b][0])
+        # The other pairs are kept from the previous run
+        if changed is not None and entity_a not in changed and entity_b not in changed:
+            continue
+        scored.append((candidates[idx_a, idx_b], (images[idx_a], features[idx_a], images[idx_b], features[idx_b])))
+
+    # The references of the index are looked up by their stored descriptors, they are never read or detected again
+    if reference_index is not None:
+        with instrument.timer('features.index'):
+            index_candidates = reference_index.query_features(descriptors, owners)
+        for idx_a, image_b, features_b, votes in index_candidates:
+            dir_a = images[idx_a][0]
+            if is_reference[dir_a] or image_b[1] in boilerplate:
+                continue
+            if changed is not None and os.path.basename(dir_a) not in changed:
+                continue
+            is_reference[image_b[0]] = True
+            scored.append((votes, (images[idx_a], features[idx_a], image_b, features_b)))
+
+    # The pairs sharing the most descriptors are verified first
+    tasks = [task for _, task in sorted(scored, key=lambda item: -item[0])]
+    instrument.count('feature_candidates', len(tasks))
+
+    similarities = {}
+    verified = 0
+    chunks = cost_chunks(tasks, lambda task: 1, max(1, len(tasks) // (max(1, processes) * 16)))
+    for results, _ in imap_chunks(verify_chunk, chunks, processes=processes, executor=executor, deadline=deadline, min_inliers=min_inliers):
+        verified += len(results)
+        for (dir_a, _), (dir_b, _), _, similarity in results:
+            if similarity > 0:
+                similarities.setdefault((dir_a, dir_b), []).append(similarity)
+
+    results = []
+    for (dir_a, dir_b), values in sorted(similarities.items()):
+        avg = len(values) / sum(1 / v for v in values)     # Harmonic mean like the SSIM comparison
+        results.append((os.path.basename(dir_a), os.path.basename(dir_b), [(min(values), max(values), avg)], is_reference[dir_b]))
+    if verified < len(tasks):
+        instrument.count('pairs_skipped_budget', len(tasks) - verified)
+        print(f'Time budget exhausted, {len(tasks) - verified} of {len(tasks)} candidate image pairs not verified')
+    return results, verified == len(tasks)
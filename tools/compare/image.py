@@ -8,39 +8,189 @@
 # This program is provided as is without any guarantees or warranty. In no event shall the authors be liable for any damages or losses arising from the use of this program.
 # This program does not guarantee the correctness of the comparison results. Please check the results manually.
 #
-# TODO: Seperate the docx to pdf conversion, image extraction, and image comparison functions
+# TODO: Seperate the image extraction and image comparison functions
 #
 
+import hashlib
 import io
 import os, sys
+import threading
+import zipfile
+from collections import OrderedDict
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 import fitz
 from PIL import Image
 
 import numpy as np
-import pandas as pd
 
-from skimage.metrics import structural_similarity as ssim
-from skimage.metrics import peak_signal_noise_ratio as psnr
-from skimage import io as skio
-
-from tqdm import tqdm
-
-from src.common import Student, Reference
-
-def compare_image_wrapper(args):
-    return compare_image(*args)
-
-def compare_image_wrapper_ref(args):
-    return compare_image(*args, reference=True)
-
-def compare_image(submission_dir_a: str, submission_dir_b: str, reference: bool = False):
+from src.common import buffer_dir
+from tools import instrument
+from tools.compare.phash import phash
+from tools.compare.metrics import batch_compare, query_statistics
+from tools.compare.store import ImageStore, load_image
+from tools.extract.cache import ExtractionCache
+from tools.extract.pipeline import run_pipeline
+
+# Number of float64 pixels compared in one batch, bounds the memory of batch_compare
+batch_elements = 1 << 21
+
+# Side of the smallest thumbnail of the pyramid comparison, doubled at each level
+pyramid_min_size = 32
+
+# Image pair results remembered by a process across its tiles, the least recently used are dropped
+# An entry takes about 1 KB, so the memo stays within about 16 MB per worker
+pair_memo_size = 1 << 14
+_pair_memo = OrderedDict()
+
+def _recall(key: tuple):
+    result = _pair_memo.get(key)
+    if result is not None:
+        _pair_memo.move_to_end(key)
+    return result
+
+def _remember(key: tuple, result):
+    _pair_memo[key] = result
+    if len(_pair_memo) > pair_memo_size:
+        _pair_memo.popitem(last=False)
+
+def _row_cache(tile_cache: dict = None):
+    # Arrays kept for the pairs of one row of a tile only, so the memory of a tile does not grow with its images
+    return None if tile_cache is None else tile_cache.setdefault('row', {})
+
+def _load_image(image_path: str, store: ImageStore = None, tile_cache: dict = None):
+    # The stored images are views of the shards, the others are kept in the LRU of the store
+    if store is not None:
+        return store.get(image_path)
+    row_cache = _row_cache(tile_cache)
+    if row_cache is not None and image_path in row_cache:
+        instrument.count('tile_cache_hits')
+        return row_cache[image_path]
+    with instrument.timer('compare.load_image'):
+        image = load_image(image_path)
+    if row_cache is not None:
+        row_cache[image_path] = image
+    return image
+
+def _list_images(image_dir: str, tile_cache: dict = None):
+    if tile_cache is None:
+        return os.listdir(image_dir)
+    key = ('listdir', image_dir)
+    if key not in tile_cache:
+        tile_cache[key] = os.listdir(image_dir)
+    return tile_cache[key]
+
+def _pad_image(image: np.ndarray, shape: tuple):
+    if image.shape == shape:
+        return image
+    return np.pad(image, ((0, shape[0] - image.shape[0]), (0, shape[1] - image.shape[1]), (0, 0)), mode='constant')
+
+def _query_statistics(query: np.ndarray, image_path: str, tile_cache: dict = None):
+    if tile_cache is None:
+        return query_statistics(query, win_size=11)
+    row_cache = _row_cache(tile_cache)
+    key = ('statistics', image_path, query.shape)
+    if key not in row_cache:
+        row_cache[key] = query_statistics(query, win_size=11)
+    return row_cache[key]
+
+def _thumbnail(image: np.ndarray, image_path: str, size: int, tile_cache: dict = None):
+    # Box filter, so the MSE of two thumbnails never exceeds much the MSE of the images
+    key = ('thumbnail', image_path, size)
+    row_cache = _row_cache(tile_cache)
+    if row_cache is not None and key in row_cache:
+        return row_cache[key]
+    thumbnail = np.asarray(Image.fromarray(image).resize((size, size), Image.BOX), dtype=np.float64) / 255
+    if row_cache is not None:
+        row_cache[key] = thumbnail
+    return thumbnail
+
+def pyramid_reject(image_a: np.ndarray, image_path_a: str, candidates: list, shape_threshold: int, error_threshold: float,
+                   tile_cache: dict = None):
+    '''
+    Compare an image with its candidates from coarse to fine, and reject the candidates as soon as they differ.
+    A candidate is rejected if its shape differs by more than shape_threshold pixels, then if the MSE (in [0, 1])
+    of the size x size thumbnails exceeds error_threshold, from pyramid_min_size up to the size of the images.
+    Args:
+        image_a: (H, W, C) image
+        image_path_a: Path of image_a, the key of its thumbnails in tile_cache
+        candidates: (key, image_b, image_path_b) of the candidate images
+        shape_threshold: Maximum difference of height and width
+        error_threshold: Maximum MSE of the thumbnails
+        tile_cache: Thumbnails shared with the other pairs of the row of the tile
+    Returns:
+        {key: level} of the rejected candidates, level is 'shape' or the side of the thumbnail
+    '''
+    rejected = {}
+    alive = []
+    for key, image_b, image_path_b in candidates:
+        if abs(image_a.shape[0] - image_b.shape[0]) > shape_threshold or abs(image_a.shape[1] - image_b.shape[1]) > shape_threshold:
+            rejected[key] = 'shape'
+        else:
+            alive.append((key, image_b, image_path_b))
+
+    size = pyramid_min_size
+    while len(alive) > 0:
+        # Levels below the size of the images, the full resolution is left to batch_compare
+        level = [c for c in alive if size < max(image_a.shape[:2] + c[1].shape[:2])]
+        if len(level) == 0:
+            break
+        query = _thumbnail(image_a, image_path_a, size, tile_cache)
+        thumbnails = np.stack([_thumbnail(image_b, image_path_b, size, tile_cache) for _, image_b, image_path_b in level])
+        diff = thumbnails - query
+        mse = (diff * diff).mean(axis=(1, 2, 3))
+        for (key, _, _), error in zip(level, mse):
+            if error > error_threshold:
+                rejected[key] = size
+        alive = [c for c in alive if c[0] not in rejected]
+        size *= 2
+    return rejected
+
+def compare_image_wrapper(args, **kwargs):
+    return compare_image(*args, **kwargs)
+
+def compare_image_wrapper_ref(args, **kwargs):
+    return compare_image(*args, reference=True, **kwargs)
+
+def compare_image_tile(tile: list, store: ImageStore = None, boilerplate: set = None, pyramid: tuple = None):
+    '''
+    Compare every pair of a tile of the pair matrix.
+    The statistics and thumbnails of the images are computed once per row and dropped after it, the images come from the LRU of the store.
+    Args:
+        tile: compare_image arguments (submission_dir_a, submission_dir_b, reference, pairs)
+        store: Passed to compare_image
+        boilerplate: Passed to compare_image
+        pyramid: Passed to compare_image
+    '''
+    tile_cache = {}
+    results = []
+    row = None
+    for args in sorted(tile, key=lambda args: args[0]):
+        if args[0] != row:
+            row = args[0]
+            tile_cache['row'] = {}
+        results.append(compare_image(*args, store=store, tile_cache=tile_cache, boilerplate=boilerplate, pyramid=pyramid))
+    return results
+
+def compare_image_chunk(chunk, **kwargs):
+    # Chunk of tiles scheduled by tools.schedule
+    return [result for tile in chunk for result in compare_image_tile(tile, **kwargs)]
+
+def compare_image(submission_dir_a: str, submission_dir_b: str, reference: bool = False, pairs: list = None,
+                  store: ImageStore = None, tile_cache: dict = None, boilerplate: set = None, pyramid: tuple = None):
     '''
     Compare two images from two different directories.
     Args:
         submission_dir_a: Directory of the first student's image
         submission_dir_b: Directory of the second student's image
+        pairs: (image_name_a, image_name_b) pairs to compare, all image pairs are compared if None
+        store: ImageStore holding the decoded images, the images are read from disk if None
+        tile_cache: Directory listings shared with the other pairs of the tile,
+            statistics, thumbnails and the images read without a store shared with the pairs of the row
+        boilerplate: Names of the images shared by most submissions, they are not compared
+        pyramid: (shape_threshold, error_threshold) to reject the image pairs from coarse to fine with pyramid_reject,
+                 only the image pairs within the thresholds at full resolution are reported.
+                 The rejections [(image_name_a, image_name_b, level)] are appended to the result, level is '' if not rejected
     '''
     # Check if the directories are the same
     if not reference and (submission_dir_a == submission_dir_b):
@@ -51,13 +201,29 @@ def compare_image(submission_dir_a: str, submission_dir_b: str, reference: bool
     student_id_b = os.path.basename(submission_dir_b)
 
     # Load list of images
-    images_a = os.listdir(submission_dir_a)
-    images_b = os.listdir(submission_dir_b)
+    images_a = _list_images(submission_dir_a, tile_cache)
+    images_b = _list_images(submission_dir_b, tile_cache)
 
     # Return if the number of images is 0
     if len(images_a) == 0 or len(images_b) == 0:
         return
 
+    # Compare only the prefiltered candidates if given
+    if pairs is None:
+        pairs = [(img_name_a, img_name_b) for img_name_a in images_a for img_name_b in images_b]
+    if boilerplate:
+        total = len(pairs)
+        pairs = [(img_name_a, img_name_b) for img_name_a, img_name_b in pairs
+                 if img_name_a not in boilerplate and img_name_b not in boilerplate]
+        instrument.count('pairs_pruned_boilerplate', total - len(pairs))
+    if len(pairs) == 0:
+        return
+
+    # Group the candidates of each image, so the image is loaded and analysed once
+    grouped = {}
+    for img_name_a, img_name_b in pairs:
+        grouped.setdefault(img_name_a, []).append(img_name_b)
+
     # Compare each image
     mse_values = []
     ssim_values = []
@@ -75,86 +241,170 @@ def compare_image(submission_dir_a: str, submission_dir_b: str, reference: bool
     psnr_max = 0
     psnr_avg = []
 
-    # TODO: Check rotation, flip, other loss, etc.
-    for img_name_a in images_a:
-        for img_name_b in images_b:
-            # Load paths
-            image_path_a = os.path.join(submission_dir_a, img_name_a)
-            image_path_b = os.path.join(submission_dir_b, img_name_b)
-
-            # Load the images
-            image_a = skio.imread(image_path_a)
-            image_b = skio.imread(image_path_b)
-
-            # Zero pad if the images are different sizes
-            if image_a.shape != image_b.shape:
-                pad_x = max(image_a.shape[0], image_b.shape[0])
-                pad_y = max(image_a.shape[1], image_b.shape[1])
-                image_a = np.pad(image_a, ((0, pad_x - image_a.shape[0]), (0, pad_y - image_a.shape[1]), (0, 0)), mode='constant')
-                image_b = np.pad(image_b, ((0, pad_x - image_b.shape[0]), (0, pad_y - image_b.shape[1]), (0, 0)), mode='constant')
-            
-            # Remove alpha channel if it exists
-            if image_a.shape[2] == 4:
-                image_a = image_a[:, :, :3]
-            if image_b.shape[2] == 4:
-                image_b = image_b[:, :, :3]
-
-            # Compare the images
-            mse = np.mean((image_a - image_b) ** 2)
-            ssim_value = ssim(image_a, image_b, multichannel=True, win_size=11, channel_axis=2)
-            psnr_value = psnr(image_a, image_b)
-
-            mse_min = min(mse_min, mse)
-            mse_max = max(mse_max, mse)
-            mse_avg.append(mse)
-
-            ssim_min = min(ssim_min, ssim_value)
-            ssim_max = max(ssim_max, ssim_value)
-            ssim_avg.append(ssim_value)
-
-            psnr_min = min(psnr_min, psnr_value)
-            psnr_max = max(psnr_max, psnr_value)
-            psnr_avg.append(psnr_value)
+    # The images are named by content hash, so a pair of names gives the same result in every directory pair and tile
+    # of the process, rejected pairs are kept as their rejection level
+    settings = (None if store is None else store.compare_size, pyramid)
+    rejections = []
+
+    # Rotated, flipped and cropped copies are found by the ORB matcher of tools/compare/features.py, see --matcher
+    for img_name_a, img_names_b in grouped.items():
+        image_path_a = os.path.join(submission_dir_a, img_name_a)
+        image_a = None
+
+        # Zero pad if the images are different sizes, candidates padded to the same shape form one batch
+        batches = {}
+        results = []
+        candidates = []
+        for img_name_b in img_names_b:
+            if img_name_a == img_name_b:
+                # Identical images
+                instrument.count('pairs_identical')
+                results.append((np.array([0.0]), np.array([np.inf]), np.array([1.0])))
+                rejections.append((img_name_a, img_name_b, ''))
+                continue
+            result = _recall((img_name_a, img_name_b, settings))
+            if result is not None:
+                instrument.count('pairs_reused')
+                if isinstance(result, tuple):
+                    results.append(result)
+                rejections.append((img_name_a, img_name_b, '' if isinstance(result, tuple) else result))
+                continue
+            if image_a is None:
+                image_a = _load_image(image_path_a, store, tile_cache)
+            image_b = _load_image(os.path.join(submission_dir_b, img_name_b), store, tile_cache)
+            candidates.append((img_name_b, image_b, os.path.join(submission_dir_b, img_name_b)))
+
+        # Most pairs are rejected on small thumbnails before the full resolution comparison
+        if pyramid is not None and len(candidates) > 0:
+            with instrument.timer('compare.pyramid'):
+                rejected = pyramid_reject(image_a, image_path_a, candidates, *pyramid, tile_cache=tile_cache)
+            instrument.count('pairs_pruned_pyramid', len(rejected))
+            for img_name_b, level in rejected.items():
+                _remember((img_name_a, img_name_b, settings), level)
+                rejections.append((img_name_a, img_name_b, level))
+            candidates = [c for c in candidates if c[0] not in rejected]
+
+        for img_name_b, image_b, _ in candidates:
+            shape = (max(image_a.shape[0], image_b.shape[0]), max(image_a.shape[1], image_b.shape[1]), 3)
+            batches.setdefault(shape, []).append((img_name_b, _pad_image(image_b, shape)))
+
+        for shape, candidates in batches.items():
+            query = _pad_image(image_a, shape)
+            statistics = _query_statistics(query, image_path_a, tile_cache)
+            batch_size = max(1, batch_elements // int(np.prod(shape)))
+            for i in range(0, len(candidates), batch_size):
+                # Compare the images
+                names_b, images_b = zip(*candidates[i:i + batch_size])
+                with instrument.timer('compare.ssim'):
+                    mse, psnr, ssim = batch_compare(query, np.stack(images_b), win_size=11, statistics=statistics)
+                instrument.count('pairs_compared', len(names_b))
+                for j, img_name_b in enumerate(names_b):
+                    if pyramid is not None and mse[j] / 255 ** 2 > pyramid[1]:
+                        _remember((img_name_a, img_name_b, settings), 'full')
+                        rejections.append((img_name_a, img_name_b, 'full'))
+                        continue
+                    result = (mse[j:j + 1], psnr[j:j + 1], ssim[j:j + 1])
+                    _remember((img_name_a, img_name_b, settings), result)
+                    results.append(result)
+                    if pyramid is not None:
+                        rejections.append((img_name_a, img_name_b, ''))
+
+        for mse, psnr, ssim in results:
+            mse_min = min(mse_min, mse.min())
+            mse_max = max(mse_max, mse.max())
+            mse_avg.extend(mse)
+
+            ssim_min = min(ssim_min, ssim.min())
+            ssim_max = max(ssim_max, ssim.max())
+            ssim_avg.extend(ssim)
+
+            psnr_min = min(psnr_min, psnr.min())
+            psnr_max = max(psnr_max, psnr.max())
+            psnr_avg.extend(psnr)
     
+    if pyramid is not None and len(mse_avg) == 0:
+        # Every image pair was rejected
+        return student_id_a, student_id_b, mse_values, ssim_values, psnr_values, rejections
+
     # Use harmonic mean
-    mse_avg = len(mse_avg) / sum([1 / mse for mse in mse_avg])
-    ssim_avg = len(ssim_avg) / sum([1 / ssim for ssim in ssim_avg])
-    psnr_avg = len(psnr_avg) / sum([1 / psnr for psnr in psnr_avg])
+    with np.errstate(divide='ignore'):
+        mse_avg = len(mse_avg) / np.sum(1 / np.array(mse_avg))
+        ssim_avg = len(ssim_avg) / np.sum(1 / np.array(ssim_avg))
+        psnr_avg = len(psnr_avg) / np.sum(1 / np.array(psnr_avg))
 
     mse_values.append((mse_min, mse_max, mse_avg))
     ssim_values.append((ssim_min, ssim_max, ssim_avg))
     psnr_values.append((psnr_min, psnr_max, psnr_avg))
 
+    if pyramid is not None:
+        return student_id_a, student_id_b, mse_values, ssim_values, psnr_values, rejections
     return student_id_a, student_id_b, mse_values, ssim_values, psnr_values
 
-def extract_image(doc_path: str, is_reference: bool = False):
-    # Check if docx or pdf
-    # If docx, convert to pdf
-    # If pdf, extract images
-    if doc_path.endswith('.docx'):
-        # Convert docx to pdf
-        doc = fitz.open()
-        doc.insert_pdf(doc_path)
-        pdf_path = doc_path.replace('.docx', '.pdf')
-        doc.save(pdf_path)
-        doc.close()
-    else:
-        pdf_path = doc_path
-
-    # Extract images from the pdf
-    images = []
-    pdf = fitz.open(pdf_path)
-    for page_num in range(pdf.page_count):
-        page = pdf.load_page(page_num)
-        image_list = page.get_images(full=True)
-        for image in image_list:
-            xref = image[0]
-            base_image = pdf.extract_image(xref)
-            image_bytes = base_image["image"]
-            image = Image.open(io.BytesIO(image_bytes))
-            images.append(image)
-    pdf.close()
-
+def _iter_image_bytes(pdf_path: str, occurrences: list):
+    # Only this generator touches the fitz document, fitz objects are not shared between threads
+    # An image embedded on many pages shares one xref, it is extracted once and every (page, xref) is recorded
+    seen = set()
+    try:
+        pdf = fitz.open(pdf_path)
+    except RuntimeError:
+        # Corrupt and empty pdf files raise RuntimeErrors, they have no image
+        print(f'Skipping the images of an unreadable pdf: {pdf_path}')
+        return
+    with pdf:
+        for page in pdf:
+            for image in page.get_images(full=True):
+                xref = image[0]
+                occurrences.append((page.number, xref))
+                if xref not in seen:
+                    seen.add(xref)
+                    with instrument.timer('extract.fitz'):
+                        image_bytes = pdf.extract_image(xref)["image"]
+                    instrument.count('images_extracted')
+                    yield xref, image_bytes
+
+def _iter_docx_image_bytes(docx_path: str, occurrences: list, aliases: dict):
+    # The media entries are read one at a time from the zip, the rest of the archive is not decompressed
+    # A docx has no pages, an occurrence is (None, media entry), entries with the same CRC and size are read once
+    # and aliases maps each later entry to the first one
+    seen = {}
+    with zipfile.ZipFile(docx_path) as docx:
+        for info in docx.infolist():
+            if not info.filename.startswith('word/media/') or info.is_dir():
+                continue
+            key = (info.CRC, info.file_size)
+            if key in seen:
+                instrument.count('images_duplicate')
+                occurrences.append((None, info.filename))
+                aliases[info.filename] = seen[key]
+                continue
+            seen[key] = info.filename
+            occurrences.append((None, info.filename))
+            with instrument.timer('extract.zip'):
+                image_bytes = docx.read(info)
+            instrument.count('images_extracted')
+            yield info.filename, image_bytes
+
+def extract_image_chunk(chunk, **kwargs):
+    # Chunk of (doc_path, is_reference[, sha256]) scheduled by tools.schedule
+    return [extract_image(*task, **kwargs) for task in chunk]
+
+def extract_image(doc_path: str, is_reference: bool = False, sha256: str = None, cache_dir: str = None,
+                  dummy_ratio: float = 0.95, dummy_thumbnail: int = 0, output_root: str = None):
+    '''
+    Extract the images of a document into the buffer directory of its student.
+    Args:
+        doc_path: Path of the pdf or docx file
+        is_reference: Whether the document belongs to the reference set
+        sha256: Content hash of the document from the manifest, computed for the cache if None
+        cache_dir: Directory of the extraction cache, the cache is disabled if None
+        dummy_ratio: Passed to is_dummy as ratio
+        dummy_thumbnail: Passed to is_dummy as thumbnail_size
+        output_root: Directory holding the image directories of the students, the buffer directory if None
+    Returns:
+        {image_path: fingerprint} of the saved images,
+        {image_path: [(doc_path, page, xref), ...]} where each saved image occurs in the document,
+        (doc_path, None, media entry) for a docx
+    '''
     # Extract the student ID from the doc_path
     student_id = os.path.basename(os.path.dirname(doc_path))
 
@@ -163,55 +413,141 @@ def extract_image(doc_path: str, is_reference: bool = False):
         student_id = 'ref_' + buf
 
     # Create the output directory for the student if it doesn't exist
-    output_dir = f'./buffer/{student_id}'
+    output_dir = os.path.join(buffer_dir if output_root is None else output_root, student_id)
     os.makedirs(output_dir, exist_ok=True)
 
-    # Save the images
-    for idx, image in enumerate(images):
+    # Unchanged documents are restored from the cache
+    if cache_dir is not None:
+        cache = ExtractionCache(cache_dir)
+        key = cache.key(doc_path, params=f'{dummy_ratio}:{dummy_thumbnail}', sha256=sha256)
+        manifest = cache.get(key)
+        if manifest is not None:
+            instrument.count('extraction_cache_hits')
+            return cache.restore(key, manifest, output_dir, doc_path)
+        instrument.count('extraction_cache_misses')
+    instrument.count('bytes_read', os.path.getsize(doc_path))
+
+    # The media of a docx are read from its zip container, nothing is written next to the submission
+    aliases = {}
+    if doc_path.lower().endswith('.docx'):
+        image_bytes = lambda docx_path, occurrences: _iter_docx_image_bytes(docx_path, occurrences, aliases)
+    else:
+        image_bytes = _iter_image_bytes
+
+    # Extract images from the document, one stage per thread so only a few images are in memory at once
+    # The images are named by content hash, so identical images are stored once and compared once per worker process
+    xref_names = {}
+    names = set()       # Values of xref_names, only the decode stage adds to it
+    page_xrefs = []
+
+    def decode(item):
+        xref, image_bytes = item
+        name = f'{hashlib.sha256(image_bytes).hexdigest()[:32]}.png'
+        xref_names[xref] = name
+        if name in names:
+            instrument.count('images_duplicate')
+            return None
+        names.add(name)
+        with instrument.timer('extract.decode'):
+            try:
+                image = Image.open(io.BytesIO(image_bytes))
+                image.load()
+            except OSError:
+                # e.g. EMF or WMF drawings of a docx, Pillow cannot decode them
+                instrument.count('images_unreadable')
+                return None
+        instrument.count('images_decoded')
+        return name, image
+
+    def drop_dummy(item):
         # Save if not dummy image
-        if not is_dummy(image):
-            image.save(os.path.join(output_dir, f'{idx}.png'))
+        with instrument.timer('extract.dummy'):
+            dummy = is_dummy(item[1], dummy_ratio, dummy_thumbnail)
+        instrument.count('images_dummy', int(dummy))
+        return None if dummy else item
+
+    def fingerprint(item):
+        name, image = item
+        with instrument.timer('extract.phash'):
+            return name, image, phash(image)
+
+    def persist(item):
+        name, image, image_hash = item
+        image_path = os.path.join(output_dir, name)
+        # Another document of the student may hold the same image, the file is replaced atomically
+        tmp_path = f'{image_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with instrument.timer('extract.png_write'):
+            image.save(tmp_path, format='PNG')
+        os.replace(tmp_path, image_path)
+        return os.path.abspath(image_path), image_hash
+
+    fingerprints = dict(run_pipeline(image_bytes(doc_path, page_xrefs), [decode, drop_dummy, fingerprint, persist]))
+    # The media entries read once share the image of the first entry
+    xref_names.update({alias: xref_names[xref] for alias, xref in aliases.items() if xref in xref_names})
+
+    occurrences = {}
+    for page, xref in page_xrefs:
+        image_path = os.path.abspath(os.path.join(output_dir, xref_names[xref]))
+        if image_path in fingerprints:
+            occurrences.setdefault(image_path, []).append((doc_path, page, xref))
+
+    if cache_dir is not None:
+        cache.put(key, doc_path, fingerprints, occurrences)
+    return fingerprints, occurrences
+
+
+def find_boilerplate(image_dirs: list, ratio: float = 0.5, min_count: int = 3):
+    '''
+    Find the images shared by a large part of the submissions, like course templates and university seals.
+    Args:
+        image_dirs: Image directories of the submissions
+        ratio: Images found in more than this ratio of the submissions are boilerplate
+        min_count: Images found in fewer submissions are never boilerplate
+    Returns:
+        Set of image names, the extracted images are named by content hash
+    '''
+    counts = {}
+    for image_dir in image_dirs:
+        for name in os.listdir(image_dir):
+            counts[name] = counts.get(name, 0) + 1
+    return {name for name, count in counts.items() if count >= min_count and count > ratio * len(image_dirs)}
 
 
-def is_dummy(image: Image):
-    # Input: PIL Image
-    # Check if the image is a dummy image
-    # All white, all black, mostly white, mostly black, mostly transparent (threshold 0.9)
-    
-    # Check the ratio of transparent pixels
-    image = image.convert('RGBA')
-    data = image.getdata()
-    transparent = 0
-    for pixel in data:
-        if pixel[3] == 0:
-            transparent += 1
-    transparent_ratio = transparent / len(data)
-
-    if transparent_ratio > 0.95:
-        return True
-    
-    # Check the ratio of white pixels
-    white = 0
-    for pixel in data:
-        if pixel[:3] == (255, 255, 255):
-            white += 1
-    white_ratio = white / len(data)
-
-    if white_ratio > 0.95:
-        return True
-    
-    # Check the ratio of black pixels
-    black = 0
-    for pixel in data:
-        if pixel[:3] == (0, 0, 0):
-            black += 1
-    black_ratio = black / len(data)
-
-    if black_ratio > 0.95:
-        return True
-    
-    # Check if the image is smaller than 11x11
+def dummy_ratios(image: Image, thumbnail_size: int = 0):
+    '''
+    Compute the ratios of transparent, white and black pixels in one pass.
+    Args:
+        image: PIL Image
+        thumbnail_size: Downsample the longer side to this size before counting, 0 uses every pixel
+    Returns:
+        (transparent_ratio, white_ratio, black_ratio)
+    '''
+    if thumbnail_size > 0 and max(image.size) > thumbnail_size:
+        # Nearest keeps the pixel values exact, so pure white and black survive the downsampling
+        scale = thumbnail_size / max(image.size)
+        size = (max(1, round(image.size[0] * scale)), max(1, round(image.size[1] * scale)))
+        image = image.resize(size, Image.NEAREST)
+
+    # View each RGBA pixel as one little-endian uint32, 0xAABBGGRR
+    pixels = np.asarray(image.convert('RGBA')).view('<u4')
+    rgb = pixels & 0x00FFFFFF
+    transparent = np.count_nonzero(pixels < 0x01000000)
+    white = np.count_nonzero(rgb == 0x00FFFFFF)
+    black = np.count_nonzero(rgb == 0)
+    return transparent / pixels.size, white / pixels.size, black / pixels.size
+
+
+def is_dummy(image: Image, ratio: float = 0.95, thumbnail_size: int = 0):
+    '''
+    Check if the image is a dummy image.
+    All white, all black, mostly white, mostly black, mostly transparent or smaller than 11x11.
+    Args:
+        image: PIL Image
+        ratio: Ratio of transparent, white or black pixels above which the image is a dummy
+        thumbnail_size: Passed to dummy_ratios
+    '''
+    # Images smaller than the SSIM window cannot be compared, skip the pixel work
     if image.size[0] < 11 or image.size[1] < 11:
         return True
-    
-    return False
+
+    return max(dummy_ratios(image, thumbnail_size)) > ratio
@@ -0,0 +1,409 @@
+# Path: tools/compare/index.py
+# Author: Jiwoon Lee
+# Last Modified: 2026-10-18
+# Description: This script keeps the fingerprints of the reference set in a persistent memory-mapped index, so a run only looks up what its submissions need.
+# License: MIT License
+#
+# Disclaimer
+# This program is provided as is without any guarantees or warranty. In no event shall the authors be liable for any damages or losses arising from the use of this program.
+# This program does not guarantee the correctness of the comparison results. Please check the results manually.
+
+import json
+import os
+import shutil
+import uuid
+
+import numpy as np
+
+from tools import instrument
+
+index_version = 3
+
+# Settings of the index, the fingerprints of a run must be computed with the same values
+index_settings = ['hash_distance', 'dummy_ratio', 'dummy_thumbnail', 'code_k', 'code_window', 'text_shingle', 'text_perm', 'text_bands']
+
+# Number of set bits of every byte
+_popcount = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+# Odd multipliers mixing the rows of an LSH band into one key
+_band_mix = np.random.default_rng(0xBA4D).integers(1, 1 << 63, size=1024, dtype=np.uint64) | np.uint64(1)
+
+
+def _hamming(hashes_a: np.ndarray, hashes_b: np.ndarray):
+    # Hamming distances of two uint64 arrays, element by element
+    return _popcount[np.ascontiguousarray(hashes_a ^ hashes_b).view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+def _hash_blocks(num_blocks: int):
+    # (shift, mask) of the bit blocks of a 64-bit fingerprint, the blocks are as even as possible
+    bounds = [64 * b // num_blocks for b in range(num_blocks + 1)]
+    return [(np.uint64(lo), np.uint64((1 << (hi - lo)) - 1)) for lo, hi in zip(bounds[:-1], bounds[1:])]
+
+
+def _band_keys(signatures: np.ndarray, bands: int):
+    # (bands, len(signatures)) keys, signatures agreeing on every row of a band share its key
+    rows = signatures.shape[1] // bands
+    keys = np.empty((bands, len(signatures)), dtype=np.uint64)
+    for band in range(bands):
+        keys[band] = (signatures[:, band * rows:(band + 1) * rows] * _band_mix[:rows]).sum(axis=1)
+    return keys
+
+
+def _ranges(lo: np.ndarray, hi: np.ndarray):
+    '''
+    Expand the ranges [lo[i], hi[i]) of a sorted table.
+    Returns:
+        (owner, position), the index i of the range and a position in it, for every position of every range
+    '''
+    counts = hi - lo
+    owner = np.repeat(np.arange(len(lo)), counts)
+    position = np.repeat(lo - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+    return owner, position
+
+
+def _lookup(keys: np.ndarray, order: np.ndarray, queries: np.ndarray):
+    # (query index, table index) of every table entry whose key equals a query, keys is sorted and order maps it back to the table
+    lo = np.searchsorted(keys, queries, side='left')
+    hi = np.searchsorted(keys, queries, side='right')
+    owner, position = _ranges(lo, hi)
+    return owner, np.asarray(order[position], dtype=np.int64)
+
+
+def _group(entity_pairs: dict):
+    # {(entity_a, entity_b): [similarity]} to the results of compare_code and compare_text, entity_b is a reference
+    results = []
+    for (entity_a, entity_b), values in entity_pairs.items():
+        avg = len(values) / sum(1 / v for v in values)     # Harmonic mean like the images
+        results.append((entity_a, entity_b, [(min(values), max(values), avg)], True))
+    return results
+
+
+def build_index(index_dir: str, reference_ids: list, images: list, code_files: list, text_files: list, settings: dict,
+                features: list = None):
+    '''
+    Write the index of a reference set, replacing the index already in index_dir.
+    The extracted images are expected in index_dir/images/<reference_id>.
+    Args:
+        index_dir: Directory of the index
+        reference_ids: Ids of the references, 'ref_<name>' like the rest of the pipeline
+        images: (reference index, image name, fingerprint) of every extracted image
+        code_files: (reference index, winnowing fingerprints) of every code file
+        text_files: (reference index, MinHash signature) of every text, documents and etc files alike
+        settings: Values of index_settings the fingerprints were computed with, and orb_keypoints if features is given
+        features: ORB features (keypoints, descriptors, mirrored) of each image of images, for --matcher orb
+    Returns:
+        ReferenceIndex of the new index
+    '''
+    os.makedirs(index_dir, exist_ok=True)
+    # The index is valid once meta.json is written
+    meta_path = os.path.join(index_dir, 'meta.json')
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+
+    def save(name, array):
+        np.save(os.path.join(index_dir, f'{name}.npy'), array)
+
+    # Images: a sorted table per bit block, by the pigeonhole principle a fingerprint within hash_distance
+    # agrees with the query on at least one of hash_distance + 1 blocks
+    num_blocks = min(64, settings['hash_distance'] + 1)
+    fingerprints = np.array([fingerprint for _, _, fingerprint in images], dtype=np.uint64)
+    save('image_fingerprints', fingerprints)
+    save('image_owner', np.array([ref_idx for ref_idx, _, _ in images], dtype=np.int32))
+    save('image_names', np.array([name.encode() for _, name, _ in images], dtype=bytes) if images else np.array([], dtype='S1'))
+    blocks = np.stack([(fingerprints >> shift) & mask for shift, mask in _hash_blocks(num_blocks)]) if images else np.zeros((num_blocks, 0), dtype=np.uint64)
+    order = np.argsort(blocks, axis=1, kind='stable').astype(np.int32)
+    save('image_blocks', np.take_along_axis(blocks, order, axis=1))
+    save('image_block_order', order)
+
+    # ORB features: the descriptors of every image in CSR form, with a sorted table of the keys of every LSH table
+    if features is not None:
+        from tools.compare.features import lsh_keys
+        counts = [len(d) for _, d, _ in features]
+        descriptors = np.concatenate([d for _, d, _ in features] + [np.zeros((0, 32), dtype=np.uint8)])
+        save('feature_offsets', np.append(0, np.cumsum(counts)).astype(np.int64))
+        save('feature_keypoints', np.concatenate([k for k, _, _ in features] + [np.zeros((0, 2), dtype=np.float32)]))
+        save('feature_descriptors', descriptors)
+        save('feature_mirrored', np.concatenate([m for _, _, m in features] + [np.zeros(0, dtype=bool)]))
+        save('feature_image', np.repeat(np.arange(len(features), dtype=np.int32), counts))
+        keys = lsh_keys(descriptors)
+        order = np.argsort(keys, axis=1, kind='stable').astype(np.int32)
+        save('feature_lsh_keys', np.take_along_axis(keys, order, axis=1))
+        save('feature_lsh_order', order)
+
+    # Code: postings of every fingerprint in CSR form, with the number of references holding it
+    owners = np.array([ref_idx for ref_idx, _ in code_files], dtype=np.int32)
+    hashes = np.concatenate([f for _, f in code_files] + [np.array([], dtype=np.int64)])
+    files = np.repeat(np.arange(len(code_files), dtype=np.int32), [len(f) for _, f in code_files])
+    order = np.lexsort((files, hashes))
+    hashes, files = hashes[order], files[order]
+    unique, starts = np.unique(hashes, return_index=True)
+    entity_pairs = np.unique(np.stack([hashes, owners[files].astype(np.int64)]), axis=1) if len(hashes) > 0 else np.zeros((2, 0), dtype=np.int64)
+    save('code_hashes', unique)
+    save('code_offsets', np.append(starts, len(hashes)).astype(np.int64))
+    save('code_postings', files)
+    save('code_df', np.unique(entity_pairs[0], return_counts=True)[1].astype(np.int32))
+    save('code_owner', owners)
+    save('code_sizes', np.array([len(f) for _, f in code_files], dtype=np.int64))
+
+    # Text: the signatures and a sorted table of the keys of every LSH band
+    assert settings['text_perm'] >= settings['text_bands'], f'--text-perm {settings["text_perm"]} is smaller than --text-bands {settings["text_bands"]}'
+    text_files = [(ref_idx, signature) for ref_idx, signature in text_files if signature is not None]
+    signatures = np.array([signature for _, signature in text_files], dtype=np.uint64).reshape(len(text_files), settings['text_perm'])
+    keys = _band_keys(signatures, settings['text_bands'])
+    order = np.argsort(keys, axis=1, kind='stable').astype(np.int32)
+    save('text_signatures', signatures)
+    save('text_owner', np.array([ref_idx for ref_idx, _ in text_files], dtype=np.int32))
+    save('text_band_keys', np.take_along_axis(keys, order, axis=1))
+    save('text_band_order', order)
+
+    image_counts = np.bincount(np.array([ref_idx for ref_idx, _, _ in images], dtype=np.int64), minlength=len(reference_ids))
+    meta = {'version': index_version,
+            'id': uuid.uuid4().hex,
+            'references': list(reference_ids),
+            'settings': {k: settings[k] for k in index_settings},
+            'orb_keypoints': settings['orb_keypoints'] if features is not None else None,
+            'image_counts': {reference_ids[i]: int(c) for i, c in enumerate(image_counts) if c > 0},
+            'code_entities': len(set(owners.tolist()))}
+    with open(meta_path, 'w', encoding='utf-8') as f:
+        json.dump(meta, f, indent=2)
+    return ReferenceIndex(index_dir)
+
+
+def clear_index(index_dir: str):
+    '''
+    Remove the files of an index, other files in index_dir are kept.
+    '''
+    shutil.rmtree(os.path.join(index_dir, 'images'), ignore_errors=True)
+    if os.path.isdir(index_dir):
+        for name in os.listdir(index_dir):
+            if name == 'meta.json' or name.endswith('.npy'):
+                os.remove(os.path.join(index_dir, name))
+
+
+class ReferenceIndex:
+    '''
+    Read-only view of an index written by build_index.
+    The tables are memory-mapped, a query only reads the pages of the entries it looks up.
+    '''
+    def __init__(self, index_dir: str):
+        meta_path = os.path.join(index_dir, 'meta.json')
+        assert os.path.exists(meta_path), f'No reference index in {index_dir}, build it with --build-reference-index'
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        assert meta['version'] == index_version, f'The reference index in {index_dir} has version {meta["version"]}, build it again'
+        self.index_dir = index_dir
+        self.id = meta['id']
+        self.references = meta['references']
+        self.settings = meta['settings']
+        self.code_entities = meta['code_entities']
+        self.orb_keypoints = meta['orb_keypoints']
+        self._image_counts = meta['image_counts']
+        self._arrays = {}
+
+    def __getstate__(self):
+        # Workers map the tables again
+        state = self.__dict__.copy()
+        state['_arrays'] = {}
+        return state
+
+    def _array(self, name: str):
+        if name not in self._arrays:
+            self._arrays[name] = np.load(os.path.join(self.index_dir, f'{name}.npy'), mmap_mode='r')
+        return self._arrays[name]
+
+    def mismatches(self, settings: dict):
+        '''
+        Names of the settings the index cannot serve, a larger hash_distance than the index was built with included.
+        --matcher orb needs the descriptors of the index, detected with the same orb_keypoints.
+        '''
+        mismatches = [k for k in index_settings if k in settings and
+                      (settings[k] > self.settings[k] if k == 'hash_distance' else settings[k] != self.settings[k])]
+        if settings.get('matcher') == 'orb' and settings.get('orb_keypoints') != self.orb_keypoints:
+            mismatches.append('orb_keypoints' if self.orb_keypoints is not None else 'matcher')
+        return mismatches
+
+    def image_dirs(self):
+        # Directories of the references with images
+        return [os.path.join(self.index_dir, 'images', entity_id) for entity_id in self._image_counts]
+
+    def image_counts(self):
+        # {image directory: number of images}, without listing the directories
+        return {os.path.join(self.index_dir, 'images', entity_id): count for entity_id, count in self._image_counts.items()}
+
+    def query_images(self, hashes: dict, max_distance: int):
+        '''
+        Find the reference images within max_distance of the submission images.
+        Args:
+            hashes: {image_dir: {image_name: fingerprint}} of the submissions, as returned by hash_directories
+            max_distance: Maximum Hamming distance, at most the hash_distance of the index
+        Returns:
+            {(submission image_dir, reference image_dir): [(image_name_a, image_name_b), ...]} like find_candidates
+        '''
+        assert max_distance <= self.settings['hash_distance'], 'The reference index was built with a smaller hash distance'
+        queries = [(image_dir, name, fingerprint) for image_dir, names in hashes.items() for name, fingerprint in names.items()]
+        if len(queries) == 0 or len(self._image_counts) == 0:
+            return {}
+        fingerprints = np.array([fingerprint for _, _, fingerprint in queries], dtype=np.uint64)
+
+        # Entries sharing a block with a query, then the exact distance of the distinct pairs
+        found = []
+        block_keys = self._array('image_blocks')
+        block_order = self._array('image_block_order')
+        for b, (shift, mask) in enumerate(_hash_blocks(len(block_keys))):
+            found.append(np.stack(_lookup(block_keys[b], block_order[b], (fingerprints >> shift) & mask)))
+        pairs = np.unique(np.concatenate(found, axis=1), axis=1)
+        pairs = pairs[:, _hamming(fingerprints[pairs[0]], np.asarray(self._array('image_fingerprints')[pairs[1]])) <= max_distance]
+        instrument.count('index_image_matches', pairs.shape[1])
+
+        owners = self._array('image_owner')[pairs[1]]
+        names = self._array('image_names')[pairs[1]]
+        candidates = {}
+        for query, owner, name in zip(pairs[0].tolist(), owners.tolist(), names.tolist()):
+            image_dir, name_a, _ = queries[query]
+            ref_dir = os.path.join(self.index_dir, 'images', self.references[owner])
+            candidates.setdefault((image_dir, ref_dir), set()).add((name_a, name.decode()))
+        return {key: sorted(pairs) for key, pairs in candidates.items()}
+
+    def query_features(self, descriptors: np.ndarray, owners: np.ndarray, min_votes: int = 5, max_bucket: int = 256):
+        '''
+        Find the reference images sharing descriptors with the submission images, like lsh_candidates.
+        Args:
+            descriptors: (n, 32) uint8 packed descriptors of the submission images
+            owners: (n,) image index of each descriptor
+            min_votes: Minimum number of colliding descriptor pairs of a candidate image pair
+            max_bucket: Buckets holding more descriptors of the submissions and the index together are ignored
+        Returns:
+            List of (image index, (reference image_dir, image_name), features of the reference image, votes)
+        '''
+        from tools.compare.features import lsh_keys
+        index_keys = self._array('feature_lsh_keys')
+        if len(descriptors) == 0 or index_keys.shape[1] == 0:
+            return []
+        index_order = self._array('feature_lsh_order')
+        found = []
+        for table, keys in enumerate(lsh_keys(descriptors)):
+            lo = np.searchsorted(index_keys[table], keys, side='left')
+            hi = np.searchsorted(index_keys[table], keys, side='right')
+            _, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+            small = np.flatnonzero(hi - lo + counts[inverse] <= max_bucket)
+            owner, position = _ranges(lo[small], hi[small])
+            found.append(np.stack([small[owner], np.asarray(index_order[table][position], dtype=np.int64)]))
+        collisions = np.unique(np.concatenate(found, axis=1), axis=1)
+        if collisions.shape[1] == 0:
+            return []
+        image_pairs = np.stack([owners[collisions[0]], np.asarray(self._array('feature_image')[collisions[1]], dtype=np.int64)])
+        image_pairs, votes = np.unique(image_pairs, axis=1, return_counts=True)
+        keep = votes >= min_votes
+        instrument.count('index_feature_matches', int(keep.sum()))
+
+        offsets = self._array('feature_offsets')
+        image_owner = self._array('image_owner')
+        image_names = self._array('image_names')
+        candidates = []
+        for image_a, image_b, n in zip(image_pairs[0, keep].tolist(), image_pairs[1, keep].tolist(), votes[keep].tolist()):
+            start, end = offsets[image_b], offsets[image_b + 1]
+            features = tuple(np.array(self._array(name)[start:end]) for name in ('feature_keypoints', 'feature_descriptors', 'feature_mirrored'))
+            ref_dir = os.path.join(self.index_dir, 'images', self.references[image_owner[image_b]])
+            candidates.append((image_a, (ref_dir, image_names[image_b].decode()), features, n))
+        return candidates
+
+    def code_df(self, fingerprints: np.ndarray):
+        '''
+        Number of references holding each fingerprint, 0 for the fingerprints not in the index.
+        '''
+        hashes = self._array('code_hashes')
+        fingerprints = np.asarray(fingerprints, dtype=np.int64)
+        if len(hashes) == 0:
+            return np.zeros(len(fingerprints), dtype=np.int64)
+        idx = np.minimum(np.searchsorted(hashes, fingerprints), len(hashes) - 1)
+        return np.where(hashes[idx] == fingerprints, self._array('code_df')[idx], 0).astype(np.int64)
+
+    def common_code(self, max_entities: int):
+        # Fingerprints held by more than max_entities references
+        return np.asarray(self._array('code_hashes')[np.asarray(self._array('code_df')) > max_entities])
+
+    def query_code(self, entities: list, cache: dict, max_df: float = 1.0, changed: set = None):
+        '''
+        Compare the code files of the students with the references of the index.
+        The boilerplate and the similarities are the same as comparing the students with the references of --reference-dir.
+        Args:
+            entities: (entity_id, is_reference, code_paths) of the students
+            cache: {path: fingerprints} holding every file of the students, as filled by compare_code
+            max_df: Fingerprints found in more than this ratio of the students and references are boilerplate and ignored
+            changed: Only these students are compared, every student if None
+        Returns:
+            List of (entity_id_a, entity_id_b, similarity_values, reference) like compare_code
+        '''
+        entities = [(entity_id, paths) for entity_id, _, paths in entities if len(paths) > 0]
+        hashes = self._array('code_hashes')
+        if len(entities) == 0 or len(hashes) == 0:
+            return []
+        # Number of students and references holding each fingerprint of the students
+        student_hashes = np.concatenate([np.unique(np.concatenate([cache[path] for path in paths])) for _, paths in entities])
+        student_hashes, student_df = np.unique(student_hashes, return_counts=True)
+        max_entities = max(2, int(max_df * (len(entities) + self.code_entities)))
+        df = student_df + self.code_df(student_hashes)
+        boilerplate = student_hashes[df > max_entities]
+
+        # Fingerprints of each reference file left after the cut, boilerplate by the references alone or with the students
+        offsets = self._array('code_offsets')
+        postings = self._array('code_postings')
+        owners = self._array('code_owner')
+        sizes = self._array('code_sizes')
+        common = np.union1d(np.flatnonzero(np.asarray(self._array('code_df')) > max_entities),
+                            np.searchsorted(hashes, boilerplate[np.isin(boilerplate, hashes)]))
+        _, position = _ranges(offsets[common], offsets[common + 1])
+        reference_sizes = sizes - np.bincount(np.asarray(postings[position]), minlength=len(sizes))
+
+        similarities = {}
+        for entity_id, paths in entities:
+            if changed is not None and entity_id not in changed:
+                continue
+            for path in paths:
+                fingerprints = cache[path]
+                fingerprints = fingerprints[~np.isin(fingerprints, boilerplate, assume_unique=True)]
+                idx = np.minimum(np.searchsorted(hashes, fingerprints), len(hashes) - 1)
+                idx = idx[hashes[idx] == fingerprints]
+                _, position = _ranges(offsets[idx], offsets[idx + 1])
+                files, shared = np.unique(np.asarray(postings[position]), return_counts=True)
+                for file_idx, n in zip(files.tolist(), shared.tolist()):
+                    similarity = n / max(1, min(len(fingerprints), int(reference_sizes[file_idx])))
+                    similarities.setdefault((entity_id, self.references[owners[file_idx]]), []).append(similarity)
+        return _group(similarities)
+
+    def query_text(self, entities: list, cache: dict, changed: set = None):
+        '''
+        Compare the texts of the students with the references of the index.
+        Args:
+            entities: (entity_id, is_reference, paths) of the students
+            cache: {path: signature} holding every file of the students, as filled by compare_text
+            changed: Only these students are compared, every student if None
+        Returns:
+            List of (entity_id_a, entity_id_b, similarity_values, reference) like compare_text
+        '''
+        files = [(entity_id, cache[path]) for entity_id, _, paths in entities for path in paths
+                 if cache[path] is not None and (changed is None or entity_id in changed)]
+        reference_signatures = self._array('text_signatures')
+        if len(files) == 0 or len(reference_signatures) == 0:
+            return []
+        signatures = np.stack([signature for _, signature in files])
+        bands = self.settings['text_bands']
+        rows = signatures.shape[1] // bands
+
+        # Entries sharing a band key, then the bands are checked row by row
+        found = []
+        band_keys = self._array('text_band_keys')
+        band_order = self._array('text_band_order')
+        for band, keys in enumerate(_band_keys(signatures, bands)):
+            found.append(np.stack(_lookup(band_keys[band], band_order[band], keys)))
+        pairs = np.unique(np.concatenate(found, axis=1), axis=1)
+        equal = signatures[pairs[0]] == np.asarray(reference_signatures[pairs[1]])
+        pairs = pairs[:, equal[:, :bands * rows].reshape(-1, bands, rows).all(axis=2).any(axis=1)]
+        instrument.count('index_text_matches', pairs.shape[1])
+
+        owners = self._array('text_owner')
+        similarities = {}
+        for query, ref_file in zip(pairs[0].tolist(), pairs[1].tolist()):
+            similarity = float(np.mean(signatures[query] == reference_signatures[ref_file]))
+            similarities.setdefault((files[query][0], self.references[owners[ref_file]]), []).append(similarity)
+        return _group(similarities)
@@ -0,0 +1,84 @@
+# Path: tools/compare/metrics.py
+# Author: Jiwoon Lee
+# Last Modified: 2026-10-18
+# Description: This script computes MSE, PSNR and SSIM between one query image and a batch of candidate images.
+# License: MIT License
+#
+# Disclaimer
+# This program is provided as is without any guarantees or warranty. In no event shall the authors be liable for any damages or losses arising from the use of this program.
+# This program does not guarantee the correctness of the comparison results. Please check the results manually.
+
+import numpy as np
+from scipy.ndimage import uniform_filter
+
+# Same constants as skimage.metrics.structural_similarity
+K1 = 0.01
+K2 = 0.03
+
+
+def _data_range(image: np.ndarray):
+    if image.dtype == np.uint8:
+        return 255.0
+    return 1.0
+
+
+def query_statistics(query: np.ndarray, win_size: int = 11):
+    '''
+    Compute the local statistics of the query image, shared by every candidate of the batch.
+    Args:
+        query: (H, W, C) image
+        win_size: Side of the uniform SSIM window
+    Returns:
+        (query as float64, local mean, local variance)
+    '''
+    x = query.astype(np.float64)
+    size = (win_size, win_size, 1)
+    ux = uniform_filter(x, size=size)
+    uxx = uniform_filter(x * x, size=size)
+    return x, ux, uxx - ux * ux
+
+
+def batch_compare(query: np.ndarray, candidates: np.ndarray, win_size: int = 11, statistics: tuple = None):
+    '''
+    Compare one query image against a stack of candidates of the same shape.
+    The SSIM matches skimage.metrics.structural_similarity(channel_axis=2, win_size=win_size),
+    PSNR and MSE match skimage.metrics.peak_signal_noise_ratio and mean_squared_error.
+    Args:
+        query: (H, W, C) image
+        candidates: (N, H, W, C) images
+        win_size: Side of the uniform SSIM window
+        statistics: Output of query_statistics(query, win_size), computed here if None
+    Returns:
+        (mse, psnr, ssim), each an array of N values
+    '''
+    data_range = _data_range(query)
+    if statistics is None:
+        statistics = query_statistics(query, win_size)
+    x, ux, vx = statistics
+
+    y = candidates.astype(np.float64)
+    size = (1, win_size, win_size, 1)
+    uy = uniform_filter(y, size=size)
+    uyy = uniform_filter(y * y, size=size)
+    uxy = uniform_filter(y * x, size=size)
+
+    # Sample covariance like skimage
+    np_window = win_size ** 2
+    cov_norm = np_window / (np_window - 1)
+    vy = cov_norm * (uyy - uy * uy)
+    vxy = cov_norm * (uxy - uy * ux)
+    vx = cov_norm * vx
+
+    c1 = (K1 * data_range) ** 2
+    c2 = (K2 * data_range) ** 2
+    ssim_map = ((2 * ux * uy + c1) * (2 * vxy + c2)) / ((ux * ux + uy * uy + c1) * (vx + vy + c2))
+
+    # Ignore the borders affected by the filter padding
+    pad = (win_size - 1) // 2
+    ssim = ssim_map[:, pad:ssim_map.shape[1] - pad, pad:ssim_map.shape[2] - pad, :].mean(axis=(1, 2, 3))
+
+    diff = y - x
+    mse = (diff * diff).mean(axis=(1, 2, 3))
+    with np.errstate(divide='ignore'):
+        psnr = 10 * np.log10((data_range ** 2) / mse)
+    return mse, psnr, ssim
@@ -0,0 +1,154 @@
+# Path: tools/compare/phash.py
+# Author: Jiwoon Lee
+# Last Modified: 2026-10-18
+# Description: This script computes perceptual fingerprints of the extracted images and indexes them by Hamming distance.
+# License: MIT License
+#
+# Disclaimer
+# This program is provided as is without any guarantees or warranty. In no event shall the authors be liable for any damages or losses arising from the use of this program.
+# This program does not guarantee the correctness of the comparison results. Please check the results manually.
+
+import os
+
+import numpy as np
+from PIL import Image
+
+hash_size = 8           # 8x8 = 64-bit fingerprint
+highfreq_factor = 4     # pHash is computed from a 32x32 thumbnail
+
+
+def _dct_matrix(n: int):
+    # Orthonormal DCT-II basis, so pHash does not need scipy
+    k = np.arange(n)
+    basis = np.cos(np.pi * (2 * k[None, :] + 1) * k[:, None] / (2 * n))
+    basis[0] /= np.sqrt(2)
+    return basis * np.sqrt(2 / n)
+
+_dct = _dct_matrix(hash_size * highfreq_factor)
+
+
+def phash(image: Image.Image) -> int:
+    '''
+    Compute the 64-bit perceptual hash of an image.
+    Args:
+        image: PIL Image
+    Returns:
+        Fingerprint as a python int
+    '''
+    size = hash_size * highfreq_factor
+    pixels = np.asarray(image.convert('L').resize((size, size), Image.BILINEAR), dtype=np.float64)
+    dct = _dct @ pixels @ _dct.T
+    low = dct[:hash_size, :hash_size]
+    # Exclude the DC term from the median, it dominates the other coefficients
+    bits = (low > np.median(low.flatten()[1:])).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def phash_file(image_path: str) -> int:
+    with Image.open(image_path) as image:
+        return phash(image)
+
+
+def hamming(hash_a: int, hash_b: int) -> int:
+    return (hash_a ^ hash_b).bit_count()
+
+
+class BKTree:
+    '''
+    Burkhard-Keller tree over 64-bit fingerprints.
+    Each node keeps the items sharing its fingerprint, so duplicated images cost one node.
+    '''
+    def __init__(self):
+        self.root = None    # [fingerprint, items, {distance: child}]
+        self.size = 0
+
+    def add(self, fingerprint: int, item):
+        self.size += 1
+        if self.root is None:
+            self.root = [fingerprint, [item], {}]
+            return
+        node = self.root
+        while True:
+            distance = hamming(fingerprint, node[0])
+            if distance == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [fingerprint, [item], {}]
+                return
+            node = child
+
+    def query(self, fingerprint: int, max_distance: int):
+        '''
+        Return (distance, item) for every item within max_distance of the fingerprint.
+        '''
+        found = []
+        if self.root is None:
+            return found
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            distance = hamming(fingerprint, node[0])
+            if distance <= max_distance:
+                found.extend((distance, item) for item in node[1])
+            # Triangle inequality: only children in [d - r, d + r] can hold matches
+            for child_distance, child in node[2].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+        return found
+
+
+def hash_directories(image_dirs: list, fingerprints: dict = None):
+    '''
+    Collect the fingerprints of every image in the directories.
+    Args:
+        image_dirs: Directories of extracted images (one per student or reference)
+        fingerprints: Precomputed {image_path: fingerprint}, images missing from it are hashed here
+    Returns:
+        {image_dir: {image_name: fingerprint}}
+    '''
+    fingerprints = fingerprints or {}
+    hashes = {}
+    for image_dir in image_dirs:
+        hashes[image_dir] = {}
+        for name in os.listdir(image_dir):
+            path = os.path.join(image_dir, name)
+            fingerprint = fingerprints.get(path)
+            if fingerprint is None:
+                fingerprint = phash_file(path)
+            hashes[image_dir][name] = fingerprint
+    return hashes
+
+
+def find_candidates(hashes: dict, dirs_a: list, dirs_b: list, max_distance: int):
+    '''
+    Find image pairs whose fingerprints are within max_distance of each other.
+    Args:
+        hashes: Output of hash_directories covering dirs_a and dirs_b
+        dirs_a: Image directories on one side of the comparison
+        dirs_b: Image directories on the other side, may be the same list as dirs_a
+        max_distance: Maximum Hamming distance of a candidate pair
+    Returns:
+        {(dir_a, dir_b): [(image_name_a, image_name_b), ...]}, only directory pairs with candidates are included
+    '''
+    same_side = dirs_a is dirs_b or dirs_a == dirs_b
+    order = {d: i for i, d in enumerate(dirs_a)}
+
+    tree = BKTree()
+    for image_dir in dirs_b:
+        for name, fingerprint in hashes[image_dir].items():
+            tree.add(fingerprint, (image_dir, name))
+
+    candidates = {}
+    for dir_a in dirs_a:
+        for name_a, fingerprint in hashes[dir_a].items():
+            for _, (dir_b, name_b) in tree.query(fingerprint, max_distance):
+                if dir_a == dir_b:
+                    continue
+                # Keep each submission pair once, in the order compare_files enumerates them
+                if same_side and order[dir_a] > order[dir_b]:
+                    candidates.setdefault((dir_b, dir_a), set()).add((name_b, name_a))
+                else:
+                    candidates.setdefault((dir_a, dir_b), set()).add((name_a, name_b))
+    return {key: sorted(pairs) for key, pairs in candidates.items()}
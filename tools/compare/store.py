@@ -0,0 +1,249 @@
+# Path: tools/compare/store.py
+# Author: Jiwoon Lee
+# Last Modified: 2026-10-18
+# Description: This script decodes the extracted images once and shares them with the comparison workers through a memory-mapped shard.
+# License: MIT License
+#
+# Disclaimer
+# This program is provided as is without any guarantees or warranty. In no event shall the authors be liable for any damages or losses arising from the use of this program.
+# This program does not guarantee the correctness of the comparison results. Please check the results manually.
+
+import json
+import os
+import shutil
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+from parmap import parmap
+
+from tools import instrument
+from tools.schedule import imap_chunks
+
+
+def load_image(image_path: str, compare_size: int = 0):
+    '''
+    Decode an image into an RGB uint8 array, the alpha channel is dropped.
+    Args:
+        image_path: Path of the image
+        compare_size: Resize to compare_size x compare_size if > 0
+    '''
+    instrument.count('images_loaded')
+    instrument.count('bytes_read', os.path.getsize(image_path))
+    with Image.open(image_path) as image:
+        image = image.convert('RGB')
+        if compare_size > 0:
+            image = image.resize((compare_size, compare_size), Image.BILINEAR)
+        return np.asarray(image)
+
+
+def _image_shape(image_path: str, compare_size: int = 0):
+    if compare_size > 0:
+        return compare_size, compare_size, 3
+    # Only the header is read here
+    with Image.open(image_path) as image:
+        return image.size[1], image.size[0], 3
+
+
+def _fill_shard(entries: list, shard_path: str = None, compare_size: int = 0):
+    # Each worker writes its own disjoint slices of the shard
+    shard = np.load(shard_path, mmap_mode='r+')
+    for image_path, offset, shape in entries:
+        shard[offset:offset + int(np.prod(shape))] = load_image(image_path, compare_size).reshape(-1)
+    shard.flush()
+
+
+class ImageStore:
+    '''
+    Normalized images packed into memory-mapped shards (images_<n>.npy) with an index (index.json).
+    The shards are opened read-only in every process, so the workers share the decoded pixels through the page cache.
+    The images not in the store are decoded on demand and kept in a bounded in-process LRU.
+    A store directory belongs to one run or service, build and remove delete its shards.
+    '''
+    def __init__(self, store_dir: str, compare_size: int = 0, cache_size: int = 256 << 20):
+        self.store_dir = store_dir
+        self.compare_size = compare_size
+        self.cache_size = cache_size
+        self.index_path = os.path.join(store_dir, 'index.json')
+        self.index = {}     # Key: image_path, Value: (shard, offset, shape)
+        self.shards = 0     # Number of shards written, the number of the next shard
+        self._shards = {}
+        self._cache = OrderedDict()
+        self._cache_bytes = 0
+
+    def __getstate__(self):
+        # The memmaps and the LRU are per process
+        state = self.__dict__.copy()
+        state['_shards'] = {}
+        state['_cache'] = OrderedDict()
+        state['_cache_bytes'] = 0
+        return state
+
+    def _shard_path(self, shard: int):
+        return os.path.join(self.store_dir, f'images_{shard}.npy')
+
+    def build(self, image_paths: list, processes: int = 1, executor=None):
+        '''
+        Decode every image once and write it into the store, replacing the stored images.
+        Args:
+            image_paths: Paths of the images to store
+            processes: Number of processes decoding the images
+            executor: Passed to extend
+        '''
+        os.makedirs(self.store_dir, exist_ok=True)
+        for name in os.listdir(self.store_dir):
+            if name.startswith('images') and name.endswith('.npy'):
+                os.remove(os.path.join(self.store_dir, name))
+        self.index = {}
+        self.shards = 0
+        self._shards = {}
+        self.extend(image_paths, processes, executor)
+
+    def extend(self, image_paths: list, processes: int = 1, executor=None):
+        '''
+        Decode the images that are not stored yet into a new shard, the stored images are kept.
+        A long-running process extends one store rather than decoding the images of every run again.
+        Args:
+            image_paths: Paths of the images to store
+            processes: Number of processes decoding the images
+            executor: Pool kept by the caller, passed to imap_chunks instead of forking new processes
+        '''
+        os.makedirs(self.store_dir, exist_ok=True)
+        entries = []
+        offset = 0
+        # The extracted images are named by content hash, an image shared by many students is stored once
+        stored = {os.path.basename(path): entry for path, entry in self.index.items()}
+        for image_path in image_paths:
+            image_path = os.path.abspath(image_path)
+            name = os.path.basename(image_path)
+            if name in stored:
+                self.index[image_path] = stored[name]
+                continue
+            shape = _image_shape(image_path, self.compare_size)
+            stored[name] = (self.shards, offset, shape)
+            self.index[image_path] = stored[name]
+            entries.append((image_path, offset, shape))
+            offset += int(np.prod(shape))
+
+        if len(entries) > 0:
+            shard_path = self._shard_path(self.shards)
+            np.lib.format.open_memmap(shard_path, mode='w+', dtype=np.uint8, shape=(offset,)).flush()
+            processes = min(processes, len(entries))
+            chunks = [entries[i::processes] for i in range(processes)] if processes > 1 else [entries]
+            if processes > 1 and executor is not None:
+                for _ in imap_chunks(_fill_shard, ((chunk, len(chunk)) for chunk in chunks), processes=processes, executor=executor,
+                                     shard_path=shard_path, compare_size=self.compare_size):
+                    pass
+            elif processes > 1:
+                instrument.collect(parmap.map(instrument.traced, chunks, _fill_shard, shard_path, self.compare_size, pm_processes=processes))
+            else:
+                _fill_shard(entries, shard_path, self.compare_size)
+            self.shards += 1
+
+        self._save_index()
+
+    def _save_index(self):
+        with open(self.index_path, 'w', encoding='utf-8') as f:
+            json.dump({'compare_size': self.compare_size, 'shards': self.shards, 'index': self.index}, f)
+
+    def _remove_unused(self):
+        # Delete the shards no image refers to
+        used = {shard for shard, _, _ in self.index.values()}
+        for shard in range(self.shards):
+            if shard not in used:
+                self._shards.pop(shard, None)
+                if os.path.exists(self._shard_path(shard)):
+                    os.remove(self._shard_path(shard))
+
+    def drop(self, image_paths: list):
+        '''
+        Forget the images, e.g. of a student submitting again, the shards left without images are deleted.
+        '''
+        for image_path in image_paths:
+            self.index.pop(os.path.abspath(image_path), None)
+        self._remove_unused()
+        self._save_index()
+
+    def compact(self, max_shards: int = 8):
+        '''
+        Copy the images of every shard but the largest into one new shard once there are more than max_shards.
+        Each extend adds a shard, a long-running process compacts them so the workers map a few files.
+        The pixels are copied from shard to shard, nothing is decoded again.
+        '''
+        sizes = {}
+        for shard, offset, shape in self.index.values():
+            sizes[shard] = max(sizes.get(shard, 0), offset + int(np.prod(shape)))
+        if len(sizes) <= max_shards:
+            return
+        largest = max(sizes, key=sizes.get)
+        moved = {}
+        offset = 0
+        for entry in sorted({entry for entry in self.index.values() if entry[0] != largest}):
+            moved[entry] = (self.shards, offset, entry[2])
+            offset += int(np.prod(entry[2]))
+
+        merged = np.lib.format.open_memmap(self._shard_path(self.shards), mode='w+', dtype=np.uint8, shape=(offset,))
+        for (shard, offset, shape), (_, new_offset, _) in moved.items():
+            if shard not in self._shards:
+                self._shards[shard] = np.load(self._shard_path(shard), mmap_mode='r')
+            size = int(np.prod(shape))
+            merged[new_offset:new_offset + size] = self._shards[shard][offset:offset + size]
+        merged.flush()
+        del merged
+        self.index = {path: moved.get(entry, entry) for path, entry in self.index.items()}
+        self.shards += 1
+        self._remove_unused()
+        self._save_index()
+
+    def load(self):
+        '''
+        Load the index of a previously built store.
+        '''
+        with open(self.index_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        self.compare_size = data['compare_size']
+        self.shards = data['shards']
+        self.index = {path: (shard, offset, tuple(shape)) for path, (shard, offset, shape) in data['index'].items()}
+        self._shards = {}
+        return self
+
+    def get(self, image_path: str):
+        '''
+        Return the normalized array of an image, decoding it only if it is not in the store.
+        A stored image is a read-only view of its shard, nothing is copied, the callers copy before writing to it.
+        '''
+        image_path = os.path.abspath(image_path)
+        if image_path in self.index:
+            instrument.count('store_views')
+            shard, offset, shape = self.index[image_path]
+            if shard not in self._shards:
+                self._shards[shard] = np.load(self._shard_path(shard), mmap_mode='r')
+            return self._shards[shard][offset:offset + int(np.prod(shape))].reshape(shape)
+
+        image = self._cache.get(image_path)
+        if image is not None:
+            instrument.count('store_cache_hits')
+            self._cache.move_to_end(image_path)
+            return image
+
+        instrument.count('store_cache_misses')
+        with instrument.timer('compare.load_image'):
+            image = load_image(image_path, self.compare_size)
+
+        self._cache[image_path] = image
+        self._cache_bytes += image.nbytes
+        while self._cache_bytes > self.cache_size and len(self._cache) > 1:
+            _, evicted = self._cache.popitem(last=False)
+            self._cache_bytes -= evicted.nbytes
+        return image
+
+    def remove(self):
+        '''
+        Delete the store directory with its shards and index, the store is empty afterwards.
+        '''
+        self._shards = {}
+        self._cache = OrderedDict()
+        self._cache_bytes = 0
+        self.index = {}
+        self.shards = 0
+        shutil.rmtree(self.store_dir, ignore_errors=True)
@@ -1,12 +1,230 @@
-# Copydetect by Bryson Lingenfelter(@blingenf)
-# https://github.com/blingenf/copydetect
-#
 # Path: tools/compare/text.py
 # Author: Jiwoon Lee
-# Last Modified: 2024-04-02
-# Description: This script compares the submission texts with the reference texts and saves the result in the output directory.
+# Last Modified: 2026-10-18
+# Description: This script compares the submission texts with each other and with the reference texts using MinHash signatures.
 # License: MIT License
 #
 # Disclaimer
 # This program is provided as is without any guarantees or warranty. In no event shall the authors be liable for any damages or losses arising from the use of this program.
 # This program does not guarantee the correctness of the comparison results. Please check the results manually.
+
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import re
+import zipfile
+import zlib
+import xml.etree.ElementTree as ET
+
+import numpy as np
+from parmap import parmap
+
+from tools import instrument
+from tools.schedule import cost_chunks, imap_chunks
+
+_word = re.compile(r'\w+')
+_docx_text = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}t'
+_docx_paragraph = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}p'
+
+# Multiply-add hash functions of the MinHash, a fixed seed keeps the signatures comparable across runs
+_max_perm = 1024
+_rng = np.random.default_rng(0x5EED)
+_perm_a = _rng.integers(1, 1 << 63, size=_max_perm, dtype=np.uint64) | np.uint64(1)
+_perm_b = _rng.integers(0, 1 << 63, size=_max_perm, dtype=np.uint64)
+
+# Version of the signatures, the signatures of another version are not comparable
+signature_version = 2
+
+# Number of shingles hashed at once, bounds the (shingles x num_perm) buffer
+_shingle_batch = 4096
+
+
+def stream_text(path: str, chunk_size: int = 1 << 16):
+    '''
+    Yield the text of a file chunk by chunk, page by page for pdf and paragraph by paragraph for docx.
+    Args:
+        path: Path of the document or text file
+        chunk_size: Number of characters per chunk of plain text files
+    '''
+    extension = os.path.splitext(path)[1][1:].lower()
+    if extension == 'pdf':
+        # Only the runs comparing pdf files load PyMuPDF
+        import fitz
+        with fitz.open(path) as pdf:
+            for page in pdf:
+                yield page.get_text()
+    elif extension == 'docx':
+        # Word splits the words of a paragraph across runs, so the runs are joined and only the paragraphs separated
+        runs = []
+        with zipfile.ZipFile(path) as docx, docx.open('word/document.xml') as f:
+            for _, element in ET.iterparse(f):
+                if element.tag == _docx_text and element.text:
+                    runs.append(element.text)
+                elif element.tag == _docx_paragraph:
+                    yield ''.join(runs) + ' '
+                    runs = []
+                element.clear()
+        if len(runs) > 0:
+            yield ''.join(runs) + ' '
+    else:
+        with open(path, 'r', encoding='utf-8', errors='ignore') as f:
+            for chunk in iter(lambda: f.read(chunk_size), ''):
+                yield chunk
+
+
+def shingle_hashes(chunks, k: int = 5):
+    '''
+    Yield the hashes of the k-word shingles of a stream of text chunks.
+    Words cut at a chunk boundary are joined, and shingles span the chunk boundaries.
+    Args:
+        chunks: Iterable of text
+        k: Number of words per shingle
+    '''
+    powers = np.cumprod(np.full(k, 0x100000001B3, dtype=np.uint64))
+    tail = np.array([], dtype=np.uint64)
+    partial = ''
+    for chunk in chunks:
+        text = partial + chunk
+        words = _word.findall(text)
+        # The last word may continue in the next chunk, it ends the text if the text ends with a word character
+        partial = words.pop() if len(words) > 0 and _word.match(text[-1]) else ''
+
+        words = np.array([zlib.crc32(w.lower().encode()) for w in words], dtype=np.uint64)
+        words = np.concatenate([tail, words])
+        if len(words) >= k:
+            yield (np.lib.stride_tricks.sliding_window_view(words, k) * powers).sum(axis=1)
+        tail = words[-(k - 1):] if k > 1 else words[:0]
+
+    if partial:
+        words = np.concatenate([tail, np.array([zlib.crc32(partial.lower().encode())], dtype=np.uint64)])
+        if len(words) >= k:
+            yield (np.lib.stride_tricks.sliding_window_view(words, k) * powers).sum(axis=1)
+
+
+def text_signature(path: str, k: int = 5, num_perm: int = 128):
+    '''
+    Compute the MinHash signature of a file without holding its text in memory.
+    Returns:
+        uint64 array of num_perm values, None if the file has no shingle
+    '''
+    a = _perm_a[:num_perm]
+    b = _perm_b[:num_perm]
+    signature = np.full(num_perm, np.iinfo(np.uint64).max, dtype=np.uint64)
+    empty = True
+    try:
+        instrument.count('bytes_read', os.path.getsize(path))
+        with instrument.timer('text.minhash'):
+            for hashes in shingle_hashes(stream_text(path), k):
+                for i in range(0, len(hashes), _shingle_batch):
+                    batch = hashes[i:i + _shingle_batch, None]
+                    np.minimum(signature, (batch * a + b).min(axis=0), out=signature)
+                    empty = False
+    except (OSError, ValueError, KeyError, RuntimeError, zipfile.BadZipFile, ET.ParseError):
+        # Unreadable files, PyMuPDF raises RuntimeErrors for corrupt and empty pdf files
+        return None
+    return None if empty else signature
+
+
+def lsh_candidates(signatures: list, bands: int = 32):
+    '''
+    Find the signature pairs that agree on every row of at least one band.
+    Args:
+        signatures: MinHash signatures of the same length
+        bands: Number of bands, each band has len(signature) // bands rows
+    Returns:
+        Set of (idx_a, idx_b), idx_a < idx_b
+    '''
+    candidates = set()
+    if len(signatures) == 0:
+        return candidates
+    assert len(signatures[0]) >= bands, f'--text-perm {len(signatures[0])} is smaller than --text-bands {bands}, the bands would have no rows'
+    rows = len(signatures[0]) // bands
+    for band in range(bands):
+        buckets = {}
+        for idx, signature in enumerate(signatures):
+            key = signature[band * rows:(band + 1) * rows].tobytes()
+            buckets.setdefault(key, []).append(idx)
+        for members in buckets.values():
+            for i, idx_a in enumerate(members):
+                for idx_b in members[i + 1:]:
+                    candidates.add((idx_a, idx_b))
+    return candidates
+
+
+def signatures_chunk(chunk, k: int = 5, num_perm: int = 128):
+    # Chunk of paths scheduled by tools.schedule
+    return [(path, text_signature(path, k, num_perm)) for path in chunk]
+
+
+def sign_files(paths: list, k: int = 5, num_perm: int = 128, processes: int = 1, cache: dict = None, executor=None):
+    '''
+    Compute the signatures of the files, the files in the cache are not read again.
+    Args:
+        paths: Paths of the documents and text files
+        k: Passed to text_signature
+        num_perm: Passed to text_signature
+        processes: Number of processes computing the signatures
+        cache: {path: signature} of unchanged files, updated with the new files
+        executor: Pool kept by the caller, passed to imap_chunks instead of forking new processes
+    Returns:
+        Signature of every path, in order, None for the files without text
+    '''
+    cache = {} if cache is None else cache
+    missing = [path for path in dict.fromkeys(paths) if path not in cache]
+    instrument.count('text_cache_hits', len(paths) - len(missing))
+    if processes > 1 and len(missing) > 1 and executor is not None:
+        chunks = cost_chunks(missing, lambda path: 1, max(1, len(missing) // (processes * 16)))
+        for results, _ in imap_chunks(signatures_chunk, chunks, processes=processes, executor=executor, k=k, num_perm=num_perm):
+            cache.update(results)
+    elif processes > 1 and len(missing) > 1:
+        cache.update(zip(missing, instrument.collect(parmap.map(instrument.traced, missing, text_signature, k, num_perm,
+                                                                pm_pbar=True, pm_processes=processes))))
+    else:
+        cache.update((path, text_signature(path, k, num_perm)) for path in missing)
+    return [cache[path] for path in paths]
+
+
+def compare_text(entities: list, k: int = 5, num_perm: int = 128, bands: int = 32, processes: int = 1,
+                 changed: set = None, cache: dict = None, executor=None):
+    '''
+    Compare the texts of the students with each other and with the references.
+    Args:
+        entities: (entity_id, is_reference, paths) of the students and references
+        k: Passed to text_signature
+        num_perm: Passed to text_signature
+        bands: Passed to lsh_candidates
+        processes: Number of processes computing the signatures
+        changed: Only the pairs involving these entities are returned, every pair if None
+        cache: {path: signature} of unchanged files, updated with the new files
+        executor: Passed to sign_files
+    Returns:
+        List of (entity_id_a, entity_id_b, similarity_values, reference) for DB.add_connection,
+        similarity_values is [(min, max, avg)] of the estimated Jaccard similarities of the file pairs
+    '''
+    files = [(entity_id, is_reference, path) for entity_id, is_reference, paths in entities for path in paths]
+    signatures = sign_files([path for _, _, path in files], k, num_perm, processes, cache, executor)
+
+    # Files without text are not indexed
+    indexed = [i for i, signature in enumerate(signatures) if signature is not None]
+    similarities = {}
+    for idx_a, idx_b in lsh_candidates([signatures[i] for i in indexed], bands):
+        file_a, file_b = indexed[idx_a], indexed[idx_b]
+        # Keep the submission first, so a reference is always entity b, and order the student pairs
+        if files[file_a][1] or (not files[file_b][1] and files[file_a][0] > files[file_b][0]):
+            file_a, file_b = file_b, file_a
+        entity_a = files[file_a][:2]
+        entity_b = files[file_b][:2]
+        # Files of the same entity and reference-reference pairs are not compared
+        if entity_a == entity_b or (entity_a[1] and entity_b[1]):
+            continue
+        # The other pairs are kept from the previous run
+        if changed is not None and entity_a[0] not in changed and entity_b[0] not in changed:
+            continue
+        similarity = float(np.mean(signatures[file_a] == signatures[file_b]))
+        similarities.setdefault((entity_a, entity_b), []).append(similarity)
+
+    results = []
+    for ((entity_a, _), (entity_b, ref_b)), values in similarities.items():
+        avg = len(values) / sum(1 / v for v in values)     # Harmonic mean like the images
+        results.append((entity_a, entity_b, [(min(values), max(values), avg)], ref_b))
+    return results
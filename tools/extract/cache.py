@@ -0,0 +1,147 @@
+# Path: tools/extract/cache.py
+# Author: Jiwoon Lee
+# Last Modified: 2026-10-18
+# Description: This script caches the images extracted from the documents across runs, keyed by the content hash of the document.
+# License: MIT License
+#
+# Disclaimer
+# This program is provided as is without any guarantees or warranty. In no event shall the authors be liable for any damages or losses arising from the use of this program.
+# This program does not guarantee the correctness of the comparison results. Please check the results manually.
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+# Bump when the extraction output changes, so stale entries are not reused
+cache_version = 4
+
+
+def file_hash(path: str, chunk_size: int = 1 << 20):
+    '''
+    Compute the sha256 of a file without reading it into memory at once.
+    '''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ExtractionCache:
+    '''
+    Content-addressed cache of extracted images.
+    Each document gets <cache_dir>/<key[:2]>/<key>/ holding manifest.json and the image blobs.
+    The manifest mtime is the last access time used for LRU eviction.
+    '''
+    def __init__(self, cache_dir: str, max_size: int = 1024 << 20):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, doc_path: str, params: str = '', sha256: str = None):
+        # params holds the extraction settings that change the output, sha256 is the hash of the document if already known
+        return hashlib.sha256(f'{cache_version}:{params}:{sha256 or file_hash(doc_path)}'.encode()).hexdigest()
+
+    def entry_dir(self, key: str):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def get(self, key: str):
+        '''
+        Return the manifest of the document or None on a miss.
+        '''
+        manifest_path = os.path.join(self.entry_dir(key), 'manifest.json')
+        try:
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return None
+        # Mark as recently used
+        os.utime(manifest_path)
+        return manifest
+
+    def restore(self, key: str, manifest: dict, output_dir: str, doc_path: str):
+        '''
+        Copy the cached images into output_dir.
+        Returns:
+            {image_path: fingerprint} and {image_path: [(doc_path, page, xref), ...]} like extract_image
+        '''
+        entry_dir = self.entry_dir(key)
+        os.makedirs(output_dir, exist_ok=True)
+        fingerprints = {}
+        occurrences = {}
+        for image in manifest['images']:
+            image_path = os.path.abspath(os.path.join(output_dir, image['name']))
+            shutil.copyfile(os.path.join(entry_dir, image['blob']), image_path)
+            fingerprints[image_path] = image['fingerprint']
+            occurrences[image_path] = [(doc_path, page, xref) for page, xref in image['occurrences']]
+        return fingerprints, occurrences
+
+    def put(self, key: str, doc_path: str, fingerprints: dict, occurrences: dict):
+        '''
+        Store the images extracted from a document.
+        Args:
+            key: Cache key of the document
+            doc_path: Path of the document, kept in the manifest for debugging
+            fingerprints: {image_path: fingerprint} returned by the extraction
+            occurrences: {image_path: [(doc_path, page, xref), ...]} returned by the extraction
+        '''
+        entry_dir = self.entry_dir(key)
+        if os.path.exists(entry_dir):
+            return
+        os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+
+        # Build the entry in a temporary directory so other workers never see a partial entry
+        tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(entry_dir))
+        images = []
+        size = 0
+        for image_path, fingerprint in fingerprints.items():
+            blob = file_hash(image_path)
+            if not os.path.exists(os.path.join(tmp_dir, f'{blob}.png')):
+                shutil.copyfile(image_path, os.path.join(tmp_dir, f'{blob}.png'))
+                size += os.path.getsize(image_path)
+            images.append({'name': os.path.basename(image_path), 'blob': f'{blob}.png', 'sha256': blob, 'fingerprint': fingerprint,
+                           'occurrences': [(page, xref) for _, page, xref in occurrences.get(image_path, [])]})
+        manifest = {'document': os.path.basename(doc_path), 'size': size, 'images': images}
+        with open(os.path.join(tmp_dir, 'manifest.json'), 'w', encoding='utf-8') as f:
+            json.dump(manifest, f)
+
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # Another worker stored the same document first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def evict(self):
+        '''
+        Remove the least recently used entries until the cache fits in max_size.
+        Returns:
+            Number of removed entries
+        '''
+        entries = []
+        total = 0
+        for prefix in os.scandir(self.cache_dir):
+            if not prefix.is_dir():
+                continue
+            for entry in os.scandir(prefix.path):
+                manifest_path = os.path.join(entry.path, 'manifest.json')
+                try:
+                    with open(manifest_path, 'r', encoding='utf-8') as f:
+                        size = json.load(f)['size']
+                    atime = os.path.getmtime(manifest_path)
+                except (OSError, ValueError, KeyError):
+                    # Leftover of an interrupted put
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                    continue
+                entries.append((atime, size, entry.path))
+                total += size
+
+        removed = 0
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            removed += 1
+        return removed
@@ -1,7 +1,7 @@
-# Path: tools/compare/text.py
+# Path: tools/extract/parse_files.py
 # Author: Jiwoon Lee
-# Last Modified: 2024-04-02
-# Description: This script parses the text files in the specified directory and compares the submission texts with the reference texts.
+# Last Modified: 2026-10-18
+# Description: This script lists the files of one extension in the specified directory, with the scanner of tools/extract/scan.py.
 # License: MIT License
 #
 # Disclaimer
@@ -9,12 +9,9 @@
 # This program does not guarantee the correctness of the comparison results. Please check the results manually.
 
 
-import os
+from tools.extract.scan import scan_tree
 
-def parse_filenames(dir_name: str, ext: str):
-    filenames = []
-    for root, dirs, files in os.walk(dir_name):
-        if len(files) > 0:
-            # Append only files with the specified extension
-            filenames.extend([os.path.join(root, f) for f in files if f.endswith(ext)])
-    return filenames
+def parse_filenames(dir_name: str, ext: str, threads: int = 16):
+    # Files whose last extension is ext, in the order of the scan
+    manifest, _ = scan_tree(dir_name, {ext.lower().lstrip('.'): ext}, threads)
+    return list(manifest)
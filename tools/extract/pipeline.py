@@ -0,0 +1,86 @@
+# Path: tools/extract/pipeline.py
+# Author: Jiwoon Lee
+# Last Modified: 2026-10-18
+# Description: This script runs the extraction stages in threads connected by bounded queues.
+# License: MIT License
+#
+# Disclaimer
+# This program is provided as is without any guarantees or warranty. In no event shall the authors be liable for any damages or losses arising from the use of this program.
+# This program does not guarantee the correctness of the comparison results. Please check the results manually.
+
+import queue
+import threading
+
+_done = object()
+
+
+def run_pipeline(source, stages: list, maxsize: int = 4):
+    '''
+    Pass every item of source through the stages, each stage running in its own thread.
+    The stages are connected by queues of maxsize items, so at most about (len(stages) + 1) x maxsize items are in memory.
+    Args:
+        source: Iterable of items, consumed in its own thread
+        stages: Functions taking an item and returning the item for the next stage, or None to drop it
+        maxsize: Size of the queues between the stages
+    Returns:
+        List of the items returned by the last stage
+    '''
+    queues = [queue.Queue(maxsize) for _ in range(len(stages) + 1)]
+    errors = []
+    stop = threading.Event()
+
+    # Once a stage failed, every thread gives up instead of blocking on a queue forever
+    def put(q, item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def get(q):
+        while True:
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                if stop.is_set():
+                    return _done
+
+    def produce():
+        try:
+            for item in source:
+                if stop.is_set():
+                    break
+                put(queues[0], item)
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            put(queues[0], _done)
+
+    def work(stage, q_in, q_out):
+        try:
+            while (item := get(q_in)) is not _done:
+                item = stage(item)
+                if item is not None:
+                    put(q_out, item)
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            put(q_out, _done)
+
+    threads = [threading.Thread(target=produce, daemon=True)]
+    threads += [threading.Thread(target=work, args=(stage, queues[i], queues[i + 1]), daemon=True) for i, stage in enumerate(stages)]
+    for thread in threads:
+        thread.start()
+
+    results = []
+    while (item := get(queues[-1])) is not _done:
+        results.append(item)
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+    return results
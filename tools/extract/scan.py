@@ -0,0 +1,104 @@
+# Path: tools/extract/scan.py
+# Author: Jiwoon Lee
+# Last Modified: 2026-10-18
+# Description: This script scans the submission and reference trees once, classifying, stating and hashing the files in threads, into the manifest used by the later stages.
+# License: MIT License
+#
+# Disclaimer
+# This program is provided as is without any guarantees or warranty. In no event shall the authors be liable for any damages or losses arising from the use of this program.
+# This program does not guarantee the correctness of the comparison results. Please check the results manually.
+
+import os
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from tools.extract.cache import file_hash
+
+# Entry of the manifest, kind is 'doc', 'code' or 'etc', sha256 is None until hash_files
+FileEntry = namedtuple('FileEntry', ['entity_id', 'kind', 'size', 'mtime_ns', 'sha256'])
+
+
+def extension_table(check_doc_types: list, check_code_types: list, check_etc_types: list):
+    '''
+    Map each checked extension to its kind, a file is classified by its last extension only.
+    Unlike suffix matching, file.cpp.pdf is a document and x.mat is not an x.m code.
+    Returns:
+        {extension: kind}, extensions in lower case without the dot
+    '''
+    table = {}
+    for kind, types in (('doc', check_doc_types), ('code', check_code_types), ('etc', check_etc_types)):
+        for t in types:
+            table.setdefault(t.lower().lstrip('.'), kind)
+    return table
+
+
+def _scan_dir(path: str, table: dict):
+    # Classified files and subdirectories of one directory, the files are stated in the thread of the directory
+    files, subdirs, count = [], [], 0
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+            elif entry.is_file():
+                count += 1
+                kind = table.get(os.path.splitext(entry.name)[1][1:].lower())
+                if kind is not None:
+                    stat = entry.stat()
+                    files.append((entry.path, kind, stat.st_size, stat.st_mtime_ns))
+    return files, subdirs, count
+
+
+def scan_tree(directory: str, table: dict, threads: int = 16):
+    '''
+    Walk a tree with os.scandir, the directories of a level are listed in parallel.
+    Every directory holding files is an entity named after the directory, like the student and reference directories.
+    Args:
+        directory: Root of the tree
+        table: Output of extension_table
+        threads: Number of threads listing and stating the directories
+    Returns:
+        ({path: FileEntry} of the classified files without their hash, number of files including the unclassified ones)
+    '''
+    manifest = {}
+    file_count = 0
+    level = [directory] if os.path.isdir(directory) else []
+    with ThreadPoolExecutor(max(1, threads)) as pool:
+        while len(level) > 0:
+            next_level = []
+            for path, (files, subdirs, count) in zip(level, pool.map(lambda d: _scan_dir(d, table), level)):
+                file_count += count
+                entity_id = os.path.basename(path)
+                for file_path, kind, size, mtime_ns in sorted(files):
+                    manifest[file_path] = FileEntry(entity_id, kind, size, mtime_ns, None)
+                next_level += sorted(subdirs)
+            level = next_level
+    return manifest, file_count
+
+
+def hash_files(manifest: dict, paths: list = None, known: dict = None, threads: int = 16):
+    '''
+    Fill in the sha256 of the files in threads, the files already hashed are not read again.
+    Args:
+        manifest: {path: FileEntry}, updated in place
+        paths: Files to hash, every file of the manifest if None
+        known: {path: (size, mtime_ns, sha256)} of a previous run, reused if the size and mtime did not change
+        threads: Number of threads reading the files
+    Returns:
+        The manifest
+    '''
+    known = known or {}
+    missing = []
+    for path in (manifest if paths is None else paths):
+        entry = manifest[path]
+        if entry.sha256 is not None:
+            continue
+        old = known.get(path)
+        if old is not None and tuple(old[:2]) == (entry.size, entry.mtime_ns):
+            manifest[path] = entry._replace(sha256=old[2])
+        else:
+            missing.append(path)
+    if len(missing) > 0:
+        with ThreadPoolExecutor(max(1, threads)) as pool:
+            for path, digest in zip(missing, pool.map(file_hash, missing)):
+                manifest[path] = manifest[path]._replace(sha256=digest)
+    return manifest
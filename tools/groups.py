@@ -0,0 +1,131 @@
+# Path: tools/groups.py
+# Author: Jiwoon Lee
+# Last Modified: 2026-10-18
+# Description: This script groups the students and references connected by similar images, codes or texts, and ranks the groups.
+# License: MIT License
+#
+# Disclaimer
+# This program is provided as is without any guarantees or warranty. In no event shall the authors be liable for any damages or losses arising from the use of this program.
+# This program does not guarantee the correctness of the comparison results. Please check the results manually.
+
+import csv
+
+import numpy as np
+
+from tools import instrument
+
+# Column ranking the pairs of each kind of connection
+score_columns = {'image': 'ssim_max', 'code': 'similarity_max', 'text': 'similarity_max', 'feature': 'similarity_max'}
+group_columns = ['group', 'size', 'students', 'references', 'edges', 'density', 'score_max', 'score_mean', 'kinds', 'members']
+
+
+def connected_components(n: int, a: np.ndarray, b: np.ndarray):
+    '''
+    Union-find over the edges (a[i], b[i]) of n nodes, all edges of a round are united at once.
+    Each round hooks the larger root of every edge under the smaller one, then compresses the paths,
+    the edges inside one component are dropped, so the rounds get cheaper.
+    Returns:
+        (n,) label of each node, the smallest node of its component
+    '''
+    parent = np.arange(n)
+    a, b = np.asarray(a, dtype=np.int64), np.asarray(b, dtype=np.int64)
+    while len(a) > 0:
+        root_a, root_b = parent[a], parent[b]
+        active = root_a != root_b
+        a, b, root_a, root_b = a[active], b[active], root_a[active], root_b[active]
+        if len(a) == 0:
+            break
+        np.minimum.at(parent, np.maximum(root_a, root_b), np.minimum(root_a, root_b))
+        # Every node points to its root again
+        while True:
+            grandparent = parent[parent]
+            if np.array_equal(grandparent, parent):
+                break
+            parent = grandparent
+    return parent
+
+
+def similarity_edges(stores: dict, threshold: float):
+    '''
+    Collect the pairs of every kind scoring at least threshold.
+    Args:
+        stores: {kind: SimilarityStore}, kind in score_columns
+        threshold: Minimum score of an edge
+    Returns:
+        (names, a, b, scores, kinds): sorted node names, node indices of the edges, their scores and the index of their kind in stores
+    '''
+    parts = []
+    for kind_idx, (kind, store) in enumerate(stores.items()):
+        table = store.table()
+        table = table[table[score_columns[kind]] >= threshold]
+        ids = np.array(store.ids, dtype=object)
+        parts.append((ids[table['a']], ids[table['b']], table[score_columns[kind]], np.full(len(table), kind_idx)))
+    if len(parts) == 0 or sum(len(part[0]) for part in parts) == 0:
+        return np.array([], dtype=object), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0, dtype=np.int64)
+    names_a, names_b, scores, kinds = (np.concatenate(column) for column in zip(*parts))
+    # Intern the ids of every kind into one node space
+    names, nodes = np.unique(np.concatenate([names_a, names_b]).astype(str), return_inverse=True)
+    return names, nodes[:len(names_a)], nodes[len(names_a):], scores.astype(np.float64), kinds
+
+
+def find_groups(stores: dict, threshold: float, is_reference=lambda name: name.startswith('ref_')):
+    '''
+    Find the groups of students and references connected by pairs scoring at least threshold in any kind.
+    Args:
+        stores: {kind: SimilarityStore}, as returned by DB.get_connections
+        threshold: Minimum score of an edge
+        is_reference: Whether a node is a reference
+    Returns:
+        List of dicts with the columns of group_columns, largest group first, then by maximum score
+    '''
+    kind_names = list(stores)
+    names, a, b, scores, kinds = similarity_edges(stores, threshold)
+    instrument.count('group_edges', len(a))
+    if len(a) == 0:
+        return []
+    with instrument.timer('groups.union_find'):
+        labels = connected_components(len(names), a, b)
+
+    # Each pair once, whatever its kinds and directions
+    edge_labels = labels[a]
+    pairs = np.unique(np.stack([np.minimum(a, b), np.maximum(a, b)]), axis=1)
+    pair_counts = np.bincount(labels[pairs[0]], minlength=len(names))
+    score_max = np.full(len(names), -np.inf)
+    np.maximum.at(score_max, edge_labels, scores)
+    score_sum = np.bincount(edge_labels, weights=scores, minlength=len(names))
+    edge_counts = np.bincount(edge_labels, minlength=len(names))
+    kind_mask = np.zeros(len(names), dtype=np.int64)
+    np.bitwise_or.at(kind_mask, edge_labels, 1 << kinds)
+
+    # Members of each group from one sort of the nodes by label
+    order = np.argsort(labels, kind='stable')
+    roots, starts = np.unique(labels[order], return_index=True)
+    groups = []
+    for root, members in zip(roots.tolist(), np.split(names[order], starts[1:])):
+        if len(members) < 2:
+            continue
+        members = sorted(members.tolist())
+        references = [m for m in members if is_reference(m)]
+        size = len(members)
+        groups.append({'size': size, 'students': size - len(references), 'references': len(references),
+                       'edges': int(pair_counts[root]), 'density': float(pair_counts[root] / (size * (size - 1) / 2)),
+                       'score_max': float(score_max[root]), 'score_mean': float(score_sum[root] / edge_counts[root]),
+                       'kinds': ';'.join(k for i, k in enumerate(kind_names) if kind_mask[root] >> i & 1),
+                       'members': ';'.join(members)})
+    groups.sort(key=lambda group: (-group['size'], -group['score_max'], group['members']))
+    for rank, group in enumerate(groups, 1):
+        group['group'] = rank
+    return groups
+
+
+def export_groups(groups: list, path: str):
+    '''
+    Write the ranked groups to path + '.csv'.
+    Returns:
+        Path of the written file
+    '''
+    with open(path + '.csv', 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, group_columns, lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(groups)
+    return path + '.csv'
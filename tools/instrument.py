@@ -0,0 +1,170 @@
+# Path: tools/instrument.py
+# Author: Jiwoon Lee
+# Last Modified: 2026-10-18
+# Description: This script keeps named timers and counters of the pipeline, aggregated across the worker processes, and profiles a chosen stage.
+# License: MIT License
+#
+# Disclaimer
+# This program is provided as is without any guarantees or warranty. In no event shall the authors be liable for any damages or losses arising from the use of this program.
+# This program does not guarantee the correctness of the comparison results. Please check the results manually.
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Stages of main.compare_files that can be profiled
+stages = ['extraction', 'prefilter', 'store', 'compare_image', 'compare_features', 'compare_code', 'compare_text', 'export', 'groups']
+
+_lock = threading.Lock()
+_timers = {}        # Key: name, Value: [seconds, calls], seconds of concurrent threads add up
+_counters = {}      # Key: name, Value: count
+_stage_order = []   # Stages in the order they ran
+_profile = {'stage': None, 'profiler': 'cprofile', 'path': None, 'session': None}
+
+
+def count(name: str, value: int = 1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def add_time(name: str, seconds: float, calls: int = 1):
+    with _lock:
+        timer = _timers.setdefault(name, [0.0, 0])
+        timer[0] += seconds
+        timer[1] += calls
+
+
+@contextmanager
+def timer(name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_time(name, time.perf_counter() - start)
+
+
+def snapshot():
+    # Copy of the timers and counters, picklable so the workers can return it
+    with _lock:
+        return {'timers': {name: list(timer) for name, timer in _timers.items()}, 'counters': dict(_counters)}
+
+
+def reset():
+    with _lock:
+        _timers.clear()
+        _counters.clear()
+        _stage_order.clear()
+
+
+def delta(before: dict, after: dict):
+    # What happened between two snapshots, a forked worker starts with a copy of the parent's values
+    timers = {}
+    for name, (seconds, calls) in after['timers'].items():
+        old = before['timers'].get(name, [0.0, 0])
+        if calls > old[1]:
+            timers[name] = [seconds - old[0], calls - old[1]]
+    counters = {name: value - before['counters'].get(name, 0) for name, value in after['counters'].items()
+                if value != before['counters'].get(name, 0)}
+    return {'timers': timers, 'counters': counters}
+
+
+def merge(stats: dict):
+    '''
+    Add the timers and counters of a worker.
+    '''
+    for name, (seconds, calls) in stats['timers'].items():
+        add_time(name, seconds, calls)
+    for name, value in stats['counters'].items():
+        count(name, value)
+
+
+def traced(item, func, *args):
+    '''
+    Call func(item, *args) and return (result, (pid, stats of the call)), for parmap.map(traced, items, func, ...).
+    '''
+    before = snapshot()
+    result = func(item, *args)
+    return result, (os.getpid(), delta(before, snapshot()))
+
+
+def collect(results: list):
+    '''
+    Merge the stats of the traced calls run in other processes and return their results.
+    The calls run in this process already counted here.
+    '''
+    for _, (pid, stats) in results:
+        if pid != os.getpid():
+            merge(stats)
+    return [result for result, _ in results]
+
+
+def configure_profile(stage: str = None, profiler: str = 'cprofile', path: str = None):
+    '''
+    Profile one stage of the pipeline.
+    Args:
+        stage: Name of the stage in stages, nothing is profiled if None
+        profiler: 'cprofile' or 'pyinstrument', pyinstrument must be installed
+        path: Output file, a pstats dump for cProfile, text or html (by extension) for pyinstrument
+    '''
+    if profiler == 'pyinstrument':
+        # Fail now rather than at the stage
+        import pyinstrument     # noqa: F401
+    _profile.update(stage=stage, profiler=profiler, path=path)
+
+
+@contextmanager
+def stage(name: str):
+    '''
+    Time a stage as 'stage.<name>', and profile it if it is the configured stage.
+    A stage entered several times adds up, in its timer and in its profile.
+    Only this process is profiled, run with one process to profile the work of the workers.
+    '''
+    profiler = None
+    if name == _profile['stage']:
+        if _profile['session'] is None:
+            if _profile['profiler'] == 'pyinstrument':
+                from pyinstrument import Profiler
+                _profile['session'] = Profiler()
+            else:
+                import cProfile
+                _profile['session'] = cProfile.Profile()
+        profiler = _profile['session']
+        if _profile['profiler'] == 'pyinstrument':
+            profiler.start()
+        else:
+            profiler.enable()
+
+    with _lock:
+        if name not in _stage_order:
+            _stage_order.append(name)
+    try:
+        with timer('stage.' + name):
+            yield
+    finally:
+        if profiler is not None:
+            if _profile['profiler'] == 'pyinstrument':
+                profiler.stop()
+                with open(_profile['path'], 'w', encoding='utf-8') as f:
+                    f.write(profiler.output_html() if _profile['path'].endswith('.html') else profiler.output_text())
+            else:
+                profiler.disable()
+                profiler.dump_stats(_profile['path'])
+            print(f'Saved the profile of {name} to {_profile["path"]}')
+
+
+def save_trace(path: str, extra: dict = None):
+    '''
+    Write the timers and counters as JSON.
+    Args:
+        path: Output file
+        extra: Other fields of the trace, e.g. the arguments of the run
+    '''
+    stats = snapshot()
+    trace = {'stages': [{'name': name, 'seconds': stats['timers'].get('stage.' + name, [0.0])[0]} for name in _stage_order],
+             'timers': {name: {'seconds': seconds, 'calls': calls} for name, (seconds, calls) in sorted(stats['timers'].items())},
+             'counters': dict(sorted(stats['counters'].items()))}
+    trace.update(extra or {})
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(trace, f, indent=2, default=str)
@@ -0,0 +1,168 @@
+# Path: tools/plan.py
+# Author: Jiwoon Lee
+# Last Modified: 2026-10-18
+# Description: This script estimates the cost of the comparison tasks, orders them so the expensive and suspicious pairs run first, and logs the estimated and actual cost.
+# License: MIT License
+#
+# Disclaimer
+# This program is provided as is without any guarantees or warranty. In no event shall the authors be liable for any damages or losses arising from the use of this program.
+# This program does not guarantee the correctness of the comparison results. Please check the results manually.
+
+import csv
+import os
+import time
+
+plan_columns = ['stage', 'order', 'pairs', 'heaviest_pair', 'image_pairs', 'suspicion', 'estimated_cost', 'seconds', 'status']
+
+
+def image_pixels(index: dict):
+    '''
+    Pixels of each decoded image and of each image directory, from the shapes of the ImageStore index.
+    Args:
+        index: {image_path: (shard, offset, shape)} of ImageStore
+    Returns:
+        ({image_path: pixels}, {image_dir: (images, pixels)})
+    '''
+    pixels = {}
+    dirs = {}
+    for path, (_, _, shape) in index.items():
+        count = 1
+        for side in shape:
+            count *= side
+        pixels[path] = count
+        images, total = dirs.get(os.path.dirname(path), (0, 0))
+        dirs[os.path.dirname(path)] = (images + 1, total + count)
+    return pixels, dirs
+
+
+def pair_cost(task: tuple, pixels: dict, dirs: dict):
+    '''
+    Estimate the cost of comparing two image directories in pixels.
+    An image pair is padded to the larger image, so it costs the pixels of the larger image.
+    Args:
+        task: compare_image arguments (dir_a, dir_b, reference, pairs), every image pair is compared if pairs is None
+        pixels: {image_path: pixels} of image_pixels
+        dirs: {image_dir: (images, pixels)} of image_pixels
+    Returns:
+        (estimated cost, image pairs)
+    '''
+    dir_a, dir_b, _, pairs = task
+    if pairs is not None:
+        cost = sum(max(pixels.get(os.path.join(dir_a, a), 0), pixels.get(os.path.join(dir_b, b), 0)) for a, b in pairs)
+        return cost + len(pairs), len(pairs)
+    images_a, pixels_a = dirs.get(dir_a, (0, 0))
+    images_b, pixels_b = dirs.get(dir_b, (0, 0))
+    # Between the sum of the smaller and of the larger image of every pair
+    return max(images_b * pixels_a, images_a * pixels_b) + images_a * images_b, images_a * images_b
+
+
+def count_pairs(counts_a: dict, counts_b: dict = None, is_changed=lambda image_dir: True):
+    '''
+    Count the image pairs of the directory pairs involving a changed directory, without generating the pairs.
+    Args:
+        counts_a: {image_dir: images}
+        counts_b: {image_dir: images}, the pairs within counts_a, each directory pair once, if None
+        is_changed: Whether the pairs of a directory are compared
+    Returns:
+        Number of image pairs
+    '''
+    def total(counts, unchanged=False):
+        return sum(c for d, c in counts.items() if not (unchanged and is_changed(d)))
+
+    def squares(counts, unchanged=False):
+        return sum(c * c for d, c in counts.items() if not (unchanged and is_changed(d)))
+
+    if counts_b is None:
+        # Every pair of the upper triangle, minus the pairs of two unchanged directories
+        return (total(counts_a) ** 2 - squares(counts_a)) // 2 - (total(counts_a, True) ** 2 - squares(counts_a, True)) // 2
+    return total(counts_a) * total(counts_b) - total(counts_a, True) * total(counts_b, True)
+
+
+def plan_tiles(tiles, cost, suspicion, max_cost: float, window: int = None):
+    '''
+    Order the tiles so the most suspicious and then the most expensive run first.
+    A pair costing more than max_cost is taken out of its tile, so it starts early on its own
+    instead of holding the other pairs of its tile back.
+    The tiles are planned lazily and ordered within windows, only the tiles of one window are in memory.
+    Args:
+        tiles: Iterable of lists of compare_image arguments
+        cost: Function returning (estimated cost, image pairs) of a pair, see pair_cost
+        suspicion: Function returning the suspicion of a pair, higher runs first
+        max_cost: Cost above which a pair gets a tile of its own, about the cost of a chunk
+        window: Number of planned tiles ordered together, every tile at once if None, e.g. when a time budget may stop the run
+    Yields:
+        Planned tiles (tile, estimated cost, image pairs, suspicion, heaviest task), in the order to run
+    '''
+    planned = []
+    for tile in tiles:
+        rest = []
+        for task in tile:
+            estimate, image_pairs = cost(task)
+            if estimate > max_cost:
+                planned.append(([task], estimate, image_pairs, suspicion(task), task))
+            else:
+                rest.append((task, estimate, image_pairs))
+        if len(rest) > 0:
+            planned.append(([task for task, _, _ in rest], sum(e for _, e, _ in rest), sum(p for _, _, p in rest),
+                            max(suspicion(task) for task, _, _ in rest), max(rest, key=lambda item: item[1])[0]))
+        if window is not None and len(planned) >= window:
+            planned.sort(key=lambda plan: (-plan[3], -plan[1]))
+            yield from planned
+            planned = []
+    planned.sort(key=lambda plan: (-plan[3], -plan[1]))
+    yield from planned
+
+
+def timed_chunk(chunk, tile_func=None, **kwargs):
+    '''
+    Run tile_func on each planned tile of a chunk alone and time it, for imap_chunks.
+    Args:
+        chunk: List of (order, tile)
+        tile_func: Module level function taking a chunk of tiles
+        kwargs: Passed to tile_func
+    Returns:
+        List of (order, seconds, results of tile_func)
+    '''
+    timed = []
+    for order, tile in chunk:
+        start = time.perf_counter()
+        results = tile_func([tile], **kwargs)
+        timed.append((order, time.perf_counter() - start, results))
+    return timed
+
+
+class PlanLog:
+    '''
+    Estimated and actual cost of every planned tile, the tiles not run before the time budget are 'skipped'.
+    '''
+    def __init__(self):
+        self.rows = []
+
+    def add(self, stage: str, planned: list, seconds: dict):
+        '''
+        Args:
+            stage: Name of the stage
+            planned: (pairs, estimated cost, image pairs, suspicion, heaviest task) of the tiles planned by plan_tiles, in order
+            seconds: {order: seconds} of the tiles that ran
+        '''
+        for order, (pairs, estimate, image_pairs, suspicion, heaviest) in enumerate(planned):
+            ran = order in seconds
+            self.rows.append({'stage': stage, 'order': order, 'pairs': pairs,
+                              'heaviest_pair': f'{os.path.basename(heaviest[0])}:{os.path.basename(heaviest[1])}',
+                              'image_pairs': image_pairs, 'suspicion': suspicion,
+                              'estimated_cost': estimate, 'seconds': seconds[order] if ran else '', 'status': 'done' if ran else 'skipped'})
+
+    def summary(self):
+        # Seconds per unit of estimated cost of the tiles that ran, the estimate is good if it is stable across runs
+        done = [row for row in self.rows if row['status'] == 'done']
+        cost = sum(row['estimated_cost'] for row in done)
+        seconds = sum(row['seconds'] for row in done)
+        return {'tiles': len(self.rows), 'done': len(done), 'estimated_cost': cost, 'seconds': seconds,
+                'seconds_per_cost': seconds / cost if cost > 0 else None}
+
+    def export(self, path: str):
+        with open(path + '.csv', 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, plan_columns, lineterminator='\n')
+            writer.writeheader()
+            writer.writerows(self.rows)
+        return path + '.csv'
@@ -0,0 +1,154 @@
+# Path: tools/schedule.py
+# Author: Jiwoon Lee
+# Last Modified: 2026-10-18
+# Description: This script generates the comparison pairs lazily and streams them through a process pool in cost-balanced chunks.
+# License: MIT License
+#
+# Disclaimer
+# This program is provided as is without any guarantees or warranty. In no event shall the authors be liable for any damages or losses arising from the use of this program.
+# This program does not guarantee the correctness of the comparison results. Please check the results manually.
+
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from tools import instrument
+
+# Keyword arguments shared by every task of a worker, set once by the pool initializer
+_worker_kwargs = {}
+
+
+def upper_tiles(items: list, block_size: int = 32):
+    '''
+    Yield the tiles of the upper-triangular pair matrix, each a list of (items[i], items[j]) with i < j.
+    '''
+    for row in range(0, len(items), block_size):
+        for col in range(row, len(items), block_size):
+            tile = [(items[i], items[j])
+                    for i in range(row, min(row + block_size, len(items)))
+                    for j in range(max(col, i + 1), min(col + block_size, len(items)))]
+            if len(tile) > 0:
+                yield tile
+
+
+def cross_tiles(items_a: list, items_b: list, block_size: int = 32):
+    '''
+    Yield the tiles of the items_a x items_b pair matrix, each a list of (a, b).
+    '''
+    for row in range(0, len(items_a), block_size):
+        for col in range(0, len(items_b), block_size):
+            yield [(a, b) for a in items_a[row:row + block_size] for b in items_b[col:col + block_size]]
+
+
+def group_tiles(pairs, items_a: list, items_b: list, block_size: int = 32):
+    '''
+    Group a sparse set of (a, b) pairs into the tiles of the items_a x items_b pair matrix.
+    Returns:
+        List of tiles, each a list of (a, b)
+    '''
+    order_a = {item: i for i, item in enumerate(items_a)}
+    order_b = {item: i for i, item in enumerate(items_b)}
+    tiles = {}
+    for a, b in pairs:
+        tiles.setdefault((order_a[a] // block_size, order_b[b] // block_size), []).append((a, b))
+    return [tiles[key] for key in sorted(tiles)]
+
+
+def cost_chunks(tasks, cost, chunk_cost: float):
+    '''
+    Group tasks lazily into chunks of about chunk_cost.
+    Args:
+        tasks: Iterable of sized tasks, empty tasks are skipped
+        cost: Function estimating the cost of a task
+        chunk_cost: Target cost of a chunk
+    Yields:
+        (chunk, cost of the chunk)
+    '''
+    chunk = []
+    total = 0
+    for task in tasks:
+        # Nothing to run, e.g. a tile without a pair left to compare
+        if len(task) == 0:
+            continue
+        chunk.append(task)
+        total += cost(task)
+        if total >= chunk_cost:
+            yield chunk, total
+            chunk = []
+            total = 0
+    if len(chunk) > 0:
+        yield chunk, total
+
+
+def _init_worker(kwargs):
+    global _worker_kwargs
+    _worker_kwargs = kwargs
+
+
+def _run_chunk(func, chunk, kwargs=None):
+    # The timers and counters of the chunk are sent back with its result
+    before = instrument.snapshot()
+    result = func(chunk, **(_worker_kwargs if kwargs is None else kwargs))
+    return result, instrument.delta(before, instrument.snapshot())
+
+
+def _chunk_result(future):
+    result, stats = future.result()
+    instrument.merge(stats)
+    return result
+
+
+def _expired(deadline: float = None):
+    return deadline is not None and time.monotonic() >= deadline
+
+
+def _submit_chunks(executor, func, chunks, max_in_flight: int, kwargs: dict = None, deadline: float = None):
+    pending = {}
+    for chunk, cost in chunks:
+        if len(pending) >= max_in_flight:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield _chunk_result(future), pending.pop(future)
+        if _expired(deadline):
+            break
+        pending[executor.submit(_run_chunk, func, chunk, kwargs)] = cost
+    if _expired(deadline):
+        # The chunks not started yet are dropped, the running ones finish
+        for future in list(pending):
+            if future.cancel():
+                pending.pop(future)
+    while pending:
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            yield _chunk_result(future), pending.pop(future)
+
+
+def imap_chunks(func, chunks, processes: int = 1, max_in_flight: int = None, executor: ProcessPoolExecutor = None, deadline: float = None,
+                **kwargs):
+    '''
+    Run func(chunk, **kwargs) on every chunk and yield the results as they complete.
+    At most max_in_flight chunks are submitted at once, so neither the tasks nor the results pile up in memory.
+    The timers and counters of the workers are added to those of this process.
+    Args:
+        func: Module level function taking a chunk
+        chunks: Iterable of (chunk, cost), as yielded by cost_chunks
+        processes: Number of processes, the chunks run in this process if 1
+        max_in_flight: Maximum number of submitted chunks, 2 x processes if None
+        executor: Pool kept by the caller across calls, a pool is started for this call if None
+        deadline: time.monotonic() after which no chunk is started, the results of the chunks that ran are still yielded
+        kwargs: Passed to func, sent once to each worker, or with every chunk to the pool of the caller
+    Yields:
+        (result, cost of the chunk)
+    '''
+    if processes <= 1:
+        for chunk, cost in chunks:
+            if _expired(deadline):
+                return
+            yield func(chunk, **kwargs), cost
+        return
+
+    max_in_flight = max_in_flight or 2 * processes
+    if executor is not None:
+        yield from _submit_chunks(executor, func, chunks, max_in_flight, kwargs, deadline)
+        return
+    with ProcessPoolExecutor(processes, initializer=_init_worker, initargs=(kwargs,)) as executor:
+        yield from _submit_chunks(executor, func, chunks, max_in_flight, deadline=deadline)